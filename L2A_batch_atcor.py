@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+##############################################################################
+#
+# MODULE:       L2A_batch_atcor.py
+#
+# AUTHOR(S):    Tomas Brunclik, brunclik(at)atlas.cz
+#
+# PURPOSE:      Batch driver running L2A_grass_atcor.sh for many L2A scenes
+#               (reflective bands files created with L2A_vrt-img.sh). The
+#               reference maps in PERMANENT and the scripts are checked once
+#               for the whole batch, then the scenes are processed by a pool
+#               of concurrent jobs (each in its own temporary mapset, all of
+#               them sharing the reference maps in PERMANENT), without any
+#               interactive prompts. The log of each scene is written next to
+#               the scene, the summary of succeeded and failed scenes is
+#               printed in the end.
+#               Runs outside GRASS GIS session (the L2A_grass_atcor.sh starts
+#               GRASS itself).
+#
+# DATE:         2023
+#
+##############################################################################
+
+from __future__ import print_function
+
+import sys
+import os
+import glob
+import json
+import argparse
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+def Scenes(inputs, suffix):
+    """Returns sorted list of the input files, directories are searched for
+    files with the suffix (not recursively)."""
+    scenes = []
+    for name in inputs:
+        if os.path.isdir(name):
+            scenes.extend(glob.glob(os.path.join(name, "*" + suffix)))
+        elif os.path.isfile(name):
+            scenes.append(name)
+        else:
+            print("WARNING: " + name + " not found, skipped.")
+    # the same scene given twice would be processed twice concurrently
+    return sorted(set([os.path.abspath(scene) for scene in scenes]))
+
+def RunScene(task):
+    """Runs L2A_grass_atcor.sh for single scene, returns (scene, exit code,
+    log file name, seconds elapsed, list of the run reports of the
+    i.grid.correl.atcor.py jobs written by this run)."""
+    script, scene, suffix, atcorparms, bandjobs, reports, resume = task
+    logfile = scene[:-len(suffix)] + "_batch.log" if scene.endswith(suffix) else scene + "_batch.log"
+    cmd = ["bash", script, "-y", "--skip-ref-check", "-j", str(bandjobs)]
+    if reports:
+        cmd.append("--report")
+    if resume:
+        cmd.append("--resume")
+    if atcorparms:
+        cmd.extend(["-a", atcorparms])
+    cmd.append(scene)
+    started = time.time()
+    with open(logfile, "w") as log, open(os.devnull) as devnull:
+        # the logs of L2A_grass_atcor.sh are written into the scene directory
+        code = subprocess.call(cmd, stdout = log, stderr = subprocess.STDOUT, stdin = devnull, cwd = os.path.dirname(scene))
+    return scene, code, logfile, time.time() - started, RunReports(scene, suffix, started) if reports else []
+
+def RunReports(scene, suffix, started):
+    """Returns list of the run reports (dicts) of the i.grid.correl.atcor.py
+    jobs of the scene written since started (<output file>_job<N>.json next
+    to the scene, the output suffix being set in L2A_grass_atcor.sh)."""
+    base = scene[:-len(suffix)] if scene.endswith(suffix) else scene
+    reports = []
+    for filename in sorted(glob.glob(base + "*_job*.json")):
+        if os.path.getmtime(filename) < started:
+            continue
+        try:
+            with open(filename) as f:
+                reports.append(json.load(f))
+        except (IOError, OSError, ValueError):
+            print("WARNING: Can not read run report " + filename + ".")
+    return reports
+
+def main():
+    argparser = argparse.ArgumentParser(description = "Runs L2A_grass_atcor.sh for multiple L2A scenes by a pool of concurrent jobs, with reference maps checked once for all of them.")
+    argparser.add_argument("inputs", nargs = "+", help = "Input reflective bands files and/or directories to search for them.")
+    argparser.add_argument("-j", "--jobs", type = int, default = 1, help = "Number of scenes processed concurrently (default: 1).")
+    argparser.add_argument("-b", "--band-jobs", type = int, default = 1, help = "Number of concurrent i.grid.correl.atcor.py runs per scene, passed to L2A_grass_atcor.sh -j (default: 1).")
+    argparser.add_argument("-a", "--atcor_parms", default = "", help = "Parameters passed to i.grid.correl.atcor.py (replace the defaults set in L2A_grass_atcor.sh), as single quoted string.")
+    argparser.add_argument("-s", "--suffix", default = "_20m.img", help = "Suffix of the input reflective bands files searched for in directories (default: _20m.img).")
+    argparser.add_argument("-r", "--report", help = "JSON file to write the batch report to (exit code, time and the run reports of the i.grid.correl.atcor.py jobs of every scene).")
+    argparser.add_argument("--resume", action = "store_true", help = "Resume the scenes interrupted by a previous batch run with --resume (passed to L2A_grass_atcor.sh, the scenes finished are redone unless left out of the inputs).")
+    argparser.add_argument("--script", default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "L2A_grass_atcor.sh"), help = "Path to L2A_grass_atcor.sh (default: the directory of this script).")
+    args = argparser.parse_args()
+    if args.jobs < 1 or args.band_jobs < 1:
+        argparser.error("number of jobs must be a positive integer")
+    if not os.path.isfile(args.script):
+        print("ERROR: " + args.script + " not found. Please use the --script option.")
+        return 1
+    scenes = Scenes(args.inputs, args.suffix)
+    if not scenes:
+        print("ERROR: No input scenes found.")
+        return 1
+    # reference maps and scripts checked once for the whole batch
+    print("Checking the reference maps and scripts...")
+    if subprocess.call(["bash", args.script, "--check-only"]) != 0:
+        print("ERROR: Check failed, no scene processed.")
+        return 1
+    print("Processing " + str(len(scenes)) + " scenes by " + str(args.jobs) + " concurrent jobs...")
+    tasks = [(args.script, scene, args.suffix, args.atcor_parms, args.band_jobs, bool(args.report), args.resume) for scene in scenes]
+    pool = ThreadPool(min(args.jobs, len(scenes)))
+    failed = 0
+    batchreport = []
+    try:
+        for scene, code, logfile, elapsed, reports in pool.imap_unordered(RunScene, tasks):
+            if code != 0:
+                failed += 1
+            batchreport.append({'scene': scene, 'status': "ok" if code == 0 else "failed", 'exit_code': code, 'seconds': elapsed, 'log': logfile, 'reports': reports})
+            print("%-6s %s (%.0f s, log: %s)" % ("OK" if code == 0 else "FAILED", os.path.basename(scene), elapsed, logfile))
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({'scenes': sorted(batchreport, key = lambda item: item['scene'])}, f, indent = 1, sort_keys = True)
+        print("Batch report written to " + args.report)
+    print("All done: " + str(len(scenes) - failed) + " scenes OK, " + str(failed) + " failed.")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+#
+##############################################################################
+#
+# MODULE:       L2A_gdal_atcor.py
+#
+# AUTHOR(S):    Tomas Brunclik, brunclik(at)atlas.cz
+#
+# PURPOSE:      GRASS-free alternative of L2A_grass_atcor.sh. Runs the
+#               i.atcor.mask.py and i.grid.correl.atcor.py algorithm (array
+#               engine, grid interpolator) directly on the files created by
+#               L2A_vrt-img.sh, read and written by blocks of rows through
+#               GDAL, so there is no import into a GRASS mapset and no export
+#               of the output, and no GRASS location is needed. The reference
+#               image is given as L2A_vrt-img.sh files as well (on the same
+#               pixel grid as the input, i.e. the same tile).
+#               Processing steps (the same as in the GRASS path):
+#               1. the no-data areas (SCL 0) of the input are masked
+#                  out (the MASK of L2A_grass_atcor.sh),
+#               2. the pseudo-invariant pixels mask is built (as
+#                  i.atcor.mask.py does) and the per tile sums of the
+#                  regression are accumulated by blocks of whole grid tile
+#                  rows, together with the footprint of the input and
+#                  reference overlap,
+#               3. the regression of the tiles is computed and the a, b
+#                  parameters of the accepted tiles are interpolated and
+#                  applied by blocks of rows, writing the corrected bands
+#                  directly into the output multiband file.
+#               The results are equivalent to L2A_grass_atcor.sh with
+#               engine=array interpolator=grid passed to i.grid.correl.atcor.py.
+#               Needs the GDAL python bindings and gridcorrel.py in the same
+#               directory.
+#
+# DATE:         2023
+#
+##############################################################################
+
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import os
+import argparse
+import multiprocessing
+
+import numpy as np
+try:
+    from osgeo import gdal
+except ImportError:
+    sys.exit("ERROR: GDAL python bindings (osgeo.gdal) needed. Please install them (python-gdal, python3-gdal package or similar).")
+
+import gridcorrel
+
+# Suffixes of the files created with L2A_vrt-img.sh
+INPUTSX = "_20m.img"
+CLOUDSX = "_cloud_mask_20m.img"
+NDMISX = "_ndmi_20m.img"
+SCLSX = "_SCL_20m.vrt"
+
+def SceneFiles(filename, suffix):
+    """Returns dict of the file names of the L2A_vrt-img.sh outputs of the
+    scene of the reflective bands file filename (with the suffix)."""
+    if not filename.endswith(suffix):
+        sys.exit("ERROR: File " + filename + " does not end with " + suffix + ".")
+    base = filename[:-len(suffix)]
+    return {'bands': filename, 'scl': base + SCLSX, 'ndmi': base + NDMISX, 'cloud': base + CLOUDSX}
+
+def OpenRaster(filename):
+    """Returns the GDAL dataset of the file opened read only."""
+    if not os.path.isfile(filename):
+        sys.exit("ERROR: File " + filename + " not found.")
+    dataset = gdal.Open(filename)
+    if dataset is None:
+        sys.exit("ERROR: Can not open " + filename + ".")
+    return dataset
+
+def CheckGrid(datasets):
+    """Exits with error if the dict of GDAL datasets do not have the same
+    size and geotransform (the GRASS path would resample them into the region
+    of the input, here they have to be on the same grid already)."""
+    names = sorted(datasets)
+    first = datasets[names[0]]
+    for name in names[1:]:
+        dataset = datasets[name]
+        if (dataset.RasterXSize, dataset.RasterYSize) != (first.RasterXSize, first.RasterYSize) or not np.allclose(dataset.GetGeoTransform(), first.GetGeoTransform()):
+            sys.exit("ERROR: " + dataset.GetDescription() + " is not on the same pixel grid as " + first.GetDescription() + ". Resample it with gdalwarp first.")
+
+def ReadBlock(dataset, start, end):
+    """Returns the rows start:end of all the bands of the GDAL dataset as
+    float64 array of shape (bands, rows, cols) with the no-data values set to
+    NaN. The raw values are read, the band scale and offset are not applied,
+    the same as r.in.gdal imports them in L2A_grass_atcor.sh."""
+    values = np.empty((dataset.RasterCount, end - start, dataset.RasterXSize))
+    for k in range(dataset.RasterCount):
+        band = dataset.GetRasterBand(k + 1)
+        raw = band.ReadAsArray(0, start, dataset.RasterXSize, end - start)
+        values[k] = raw
+        nodata = band.GetNoDataValue()
+        if nodata is not None:
+            values[k][raw == nodata] = np.nan
+    return values
+
+def ReadInputs(datasets, start, end):
+    """Returns dict of the arrays of the rows start:end of the datasets (the
+    multiband inputs as 3D arrays, the others 2D), with the no-data areas of
+    the input (SCL 0) set to NaN in all of them."""
+    inputs = {}
+    for name in datasets:
+        values = ReadBlock(datasets[name], start, end)
+        inputs[name] = values if name in ('bands', 'refbands') else values[0]
+    # the same as 'r.mask -i raster=<input SCL> maskcats=0' in L2A_grass_atcor.sh (null SCL is not masked out by it)
+    nodata = inputs['scl'] == 0
+    for name in inputs:
+        inputs[name][..., nodata] = np.nan
+    return inputs
+
+def TheilSenTask(task):
+    """Theil-Sen regression of the (x, y) arrays tuple, to be run by the
+    worker processes of the pool. Only the pixels with x > 0 and y > 0 are
+    used, as in the tiles engine of i.grid.correl.atcor.py."""
+    x, y = task
+    valid = (x > 0) & (y > 0)
+    return gridcorrel.TheilSen(x[valid], y[valid])
+
+def TileStatistics(datasets, grid_shape, args, nsres, ewres):
+    """Builds the pseudo-invariant pixels mask and accumulates the per tile
+    moments of every band (see gridcorrel.TileMoments), by blocks of whole
+    grid tile rows read with the overlap needed by the mask filters. Returns
+    the list of moments arrays, the a, b arrays of the Theil-Sen or robust
+    regression (None for the other methods) and the (first, last) column arrays of the
+    input and reference overlap in every row (see gridcorrel.RowExtents)."""
+    rows = datasets['scl'].RasterYSize
+    cols = datasets['scl'].RasterXSize
+    nbands = datasets['bands'].RasterCount
+    grid_rows, grid_cols = grid_shape
+    ntiles = grid_rows * grid_cols
+    moments = [np.zeros((len(gridcorrel.MOMENTS), ntiles)) for k in range(nbands)]
+    avalues = bvalues = pool = None
+    # the methods fitted from the pixel values, not from the sums
+    pixelfit = args.regression == "theil_sen" or args.regression in gridcorrel.ROBUST_METHODS
+    if pixelfit:
+        avalues = np.full((nbands, ntiles), np.nan)
+        bvalues = np.full((nbands, ntiles), np.nan)
+        if args.regression == "theil_sen" and args.nprocs > 1:
+            pool = multiprocessing.Pool(args.nprocs)
+    # R threshold of the tiles to fit, lower in the adaptive mode
+    fitminr = args.minr if args.minrfloor is None else min(args.minr, args.minrfloor)
+    first = np.empty(rows, dtype = int)
+    last = np.empty(rows, dtype = int)
+    # overlap of the blocks: the cloud filter radius plus the buffer radius in rows
+    halo = args.circlesize // 2 + int(args.buffsize // nsres) + 1
+    # the bands, mask inputs and about 14 arrays of the mask filters held at once
+    maxrows = max(gridcorrel.MemoryRows(args.memory, cols, 2 * nbands + 20) - 2 * halo, 1)
+    blocks = gridcorrel.TileRowBlocks(rows, grid_rows, maxrows)
+    print("Computing mask and statistics of grid tiles in " + str(len(blocks)) + " block(s) of rows...")
+    try:
+        for start, end in blocks:
+            top = max(start - halo, 0)
+            inputs = ReadInputs(datasets, top, min(end + halo, rows))
+            mask = gridcorrel.MaskBits(inputs, start - top, end - start, args.maxndmidiff, args.maxndmi, args.buffsize, args.circlesize, nsres, ewres)
+            block = slice(start - top, end - top)
+            x = inputs['bands'][:, block]
+            y = inputs['refbands'][:, block]
+            # overlap of the valid input and reference pixels of all the bands
+            overlap = ~(np.isnan(x).any(axis = 0) | np.isnan(y).any(axis = 0))
+            first[start:end], last[start:end] = gridcorrel.RowExtents(overlap)
+            valid = overlap & (mask == gridcorrel.MASK_ALL)
+            if args.sample:
+                valid = gridcorrel.SampleTiles(valid, rows, cols, grid_rows, grid_cols, args.sample, args.seed, start)
+            tiles = gridcorrel.TileIndex(rows, cols, grid_rows, grid_cols, start, end)[valid]
+            if pixelfit:
+                blocktiles = np.unique(tiles)
+            if args.regression == "theil_sen":
+                order, firstpixel = gridcorrel.GroupByTile(tiles, ntiles)
+            for k in range(nbands):
+                xvalid = x[k][valid]
+                yvalid = y[k][valid]
+                gridcorrel.TileMoments(tiles, xvalid, yvalid, ntiles, moments[k])
+                if pixelfit:
+                    rblock = gridcorrel.Correlation(moments[k][:, blocktiles])
+                    fittiles = blocktiles[(moments[k][0, blocktiles] > args.pixels) & (rblock >= fitminr)]
+                if args.regression in gridcorrel.ROBUST_METHODS:
+                    fit = np.zeros(ntiles, dtype = bool)
+                    fit[fittiles] = True
+                    fit = fit[tiles]
+                    robusta, robustb = gridcorrel.RobustFit(tiles[fit], xvalid[fit], yvalid[fit], ntiles, args.regression)
+                    avalues[k, fittiles] = robusta[fittiles]
+                    bvalues[k, fittiles] = robustb[fittiles]
+                elif args.regression == "theil_sen":
+                    tasks = [(xvalid[order[firstpixel[tile]:firstpixel[tile + 1]]], yvalid[order[firstpixel[tile]:firstpixel[tile + 1]]]) for tile in fittiles]
+                    if pool is not None:
+                        fits = pool.map(TheilSenTask, tasks)
+                    else:
+                        fits = [TheilSenTask(task) for task in tasks]
+                    for tile, fit in zip(fittiles, fits):
+                        avalues[k, tile], bvalues[k, tile] = fit
+            del inputs, mask, x, y
+    finally:
+        # the workers are stopped also when the tile loop fails
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return moments, avalues, bvalues, (first, last)
+
+def CoefGrids(moments, avalues, bvalues, grid_shape, args, names):
+    """Returns list of the gap filled (2, grid rows, grid cols) arrays of the
+    a, b parameters of the bands (None for the bands without any accepted
+    tile), the same as CoefGrid of i.grid.correl.atcor.py does. With
+    minrfloor (adaptive mode) the R threshold of the bands with fewer than
+    mintiles accepted tiles is lowered as by i.grid.correl.atcor.py."""
+    coefgrids = []
+    for k in range(len(moments)):
+        rvalues = gridcorrel.Correlation(moments[k])
+        if avalues is not None:
+            coefs = np.array([avalues[k], bvalues[k]])
+        else:
+            coefs = np.array(gridcorrel.FitMoments(moments[k], args.regression))
+        minr = args.minr
+        if args.minrfloor is not None and args.minrfloor < args.minr:
+            minr = gridcorrel.AdaptiveMinr(rvalues, moments[k][0], args.pixels, args.minr, args.minrfloor, args.mintiles)
+            if minr < args.minr:
+                print(names[k] + ": Only " + str(int(((moments[k][0] > args.pixels) & (rvalues >= args.minr)).sum())) + " tiles with R >= " + str(args.minr) + ", adaptive minr=" + str(minr) + " used.")
+        accepted = (moments[k][0] > args.pixels) & (rvalues >= minr)
+        print(names[k] + ": Regression computed in " + str(int(accepted.sum())) + " of " + str(accepted.size) + " grid tiles. (method: " + args.regression + ")")
+        # only the tiles with b > 0 are used
+        coefs[:, ~(accepted & (coefs[1] > 0))] = np.nan
+        if np.isnan(coefs[1]).all():
+            print("WARNING: There were no tiles with valid correlation (" + names[k] + "). The source band will be copied to corrected output as is.")
+            coefgrids.append(None)
+        else:
+            coefgrids.append(gridcorrel.FillGaps(coefs.reshape(2, grid_shape[0], grid_shape[1])))
+    return coefgrids
+
+def WriteOutput(datasets, output, grid_shape, coefgrids, hullspans, args):
+    """Writes the corrected bands b * input + a within the hull of the
+    overlap (the input band as is for the bands without coefficients) into
+    the output file (HFA Float32, compressed, as r.out.gdal in
+    L2A_grass_atcor.sh) by blocks of rows. With args.type UInt16 or Int16
+    the reflectance is stored as scaled integers (see
+    gridcorrel.EncodeReflectance) with the scale and offset set on the
+    bands. The COG format has no direct writing, the blocks are written into
+    a temporary tiled GeoTIFF copied to the COG in the end (see
+    TranslateCOG)."""
+    inp = datasets['bands']
+    rows = inp.RasterYSize
+    cols = inp.RasterXSize
+    nbands = inp.RasterCount
+    if args.format == "COG":
+        target = output + ".tmp.tif"
+        driver = gdal.GetDriverByName("GTiff")
+        createopt = ["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "BIGTIFF=IF_SAFER"]
+    else:
+        target = output
+        driver = gdal.GetDriverByName(args.format)
+        createopt = args.createopt
+    out = driver.Create(target, cols, rows, nbands, gdal.GetDataTypeByName(args.type), createopt)
+    if out is None:
+        sys.exit("ERROR: Can not create " + target + ".")
+    out.SetGeoTransform(inp.GetGeoTransform())
+    out.SetProjection(inp.GetProjection())
+    for k in range(nbands):
+        band = out.GetRasterBand(k + 1)
+        if args.type == "Float32":
+            band.SetNoDataValue(float('nan'))
+        else:
+            band.SetNoDataValue(gridcorrel.SCALED_TYPES[args.type][3])
+            band.SetScale(1.0 / args.quantification)
+            band.SetOffset(args.boaoffset / args.quantification)
+        band.SetDescription(inp.GetRasterBand(k + 1).GetDescription())
+    # input bands, a, b blocks and the temporary arrays
+    blockrows = min(args.blockrows, gridcorrel.MemoryRows(args.memory, cols, 3 * nbands + 4))
+    rowweights = gridcorrel.AxisWeights(rows, grid_shape[0], args.interpolation)
+    colweights = gridcorrel.AxisWeights(cols, grid_shape[1], args.interpolation)
+    colindex = np.arange(cols)
+    print("Creating corrected output " + output + "...")
+    for start in range(0, rows, blockrows):
+        end = min(start + blockrows, rows)
+        x = ReadInputs({'bands': inp, 'scl': datasets['scl']}, start, end)['bands']
+        inside = (colindex[np.newaxis, :] >= hullspans[0][start:end, np.newaxis]) & (colindex[np.newaxis, :] < hullspans[1][start:end, np.newaxis])
+        for k in range(nbands):
+            if coefgrids[k] is None:
+                values = x[k]
+            else:
+                ka, kb = gridcorrel.InterpolateGrid(coefgrids[k], rowweights, colweights, start, end)
+                values = np.where(inside, kb * x[k] + ka, np.nan)
+            if args.type == "Float32":
+                values = values.astype(np.float32)
+            else:
+                values = gridcorrel.EncodeReflectance(values, args.type, args.quantification, args.boaoffset)
+            out.GetRasterBand(k + 1).WriteArray(values, 0, start)
+    out.FlushCache()
+    out = None
+    if args.format == "COG":
+        TranslateCOG(target, output, args.createopt)
+
+def TranslateCOG(source, output, createopt):
+    """Copies the tiled GeoTIFF source into the Cloud-Optimized GeoTIFF
+    output (the overviews built and the tiles compressed by the threads set
+    in createopt) and removes the source."""
+    print("Creating Cloud-Optimized GeoTIFF " + output + "...")
+    try:
+        if gdal.Translate(output, source, format = "COG", creationOptions = createopt) is None:
+            sys.exit("ERROR: Can not create " + output + ".")
+    finally:
+        os.remove(source)
+
+def main():
+    argparser = argparse.ArgumentParser(description = "Spatially variable correlation based radiometric normalization of L2A_vrt-img.sh outputs through GDAL, without GRASS GIS.")
+    argparser.add_argument("input", help = "Input reflective bands file (<base>_20m.img); the SCL, NDMI and cloud mask files of the scene are found by their suffixes.")
+    argparser.add_argument("reference", help = "Reference reflective bands file (<base>_20m.img) on the same pixel grid; its SCL and NDMI files are found by their suffixes.")
+    argparser.add_argument("-o", "--output", help = "Output file (default: <input base>_20m_corr.img, .tif for the COG and GTiff formats).")
+    argparser.add_argument("--refcloud", help = "Cloud mask of the reference image (0 - cloud or snow, 1 - clear). Leave out for clear reference image.")
+    # the defaults are those of ATCOR_PARMS in L2A_grass_atcor.sh, so both paths give the same results
+    argparser.add_argument("--gridsize", type = float, default = 4000, help = "Approx. grid tile size in map units (default: 4000).")
+    argparser.add_argument("--pixels", type = int, default = 300, help = "Minimal number of valid pixels in tile (default: 300).")
+    argparser.add_argument("--minr", type = float, default = 0.88, help = "Minimal correlation coefficient R to accept (default: 0.88).")
+    argparser.add_argument("--minrfloor", type = float, default = None, help = "Lowest minimal R of the adaptive mode: if fewer than mintiles tiles pass minr, the highest threshold down to minrfloor accepting mintiles tiles is used.")
+    argparser.add_argument("--mintiles", type = int, default = 1, help = "Target number of accepted tiles of the adaptive mode (default: 1).")
+    argparser.add_argument("--sample", type = int, default = None, help = "Maximum number of valid pixels per tile the R and regression are computed from (stratified sample spread over the tile), must be greater than pixels.")
+    argparser.add_argument("--seed", type = int, default = 0, help = "Seed of the pixel sample (default: 0).")
+    argparser.add_argument("--regression", choices = ("theil_sen", "orthogonal", "least_sq", "huber", "tukey"), default = "orthogonal", help = "Regression method, huber and tukey are robust orthogonal regressions of all the tiles at once (default: orthogonal).")
+    argparser.add_argument("--interpolation", choices = ("bilinear", "bicubic"), default = "bicubic", help = "Interpolation of the regression parameters (default: bicubic).")
+    argparser.add_argument("--maxndmidiff", type = float, default = 0.1, help = "Max difference of the smoothed (3x3 average) NDMI of input and reference (default: 0.1).")
+    argparser.add_argument("--maxndmi", type = float, default = 0.15, help = "Max NDMI of input and reference, 1.0 effectively disables the rule (default: 0.15).")
+    argparser.add_argument("--buffsize", type = float, default = 300, help = "Cloud buffer size in meters (default: 300).")
+    argparser.add_argument("--circlesize", type = int, default = 9, help = "Size of circular area to filter out few pixel-sized clouds and holes before buffering, odd number >= 3 (default: 9).")
+    argparser.add_argument("--nprocs", type = int, default = 1, help = "Number of processes to compute the Theil-Sen regression of the tiles in parallel (default: 1).")
+    argparser.add_argument("--blockrows", type = int, default = 512, help = "Number of rows interpolated and corrected at once (default: 512).")
+    argparser.add_argument("--memory", type = int, default = 1024, help = "Maximum memory (MB) for the blocks of rows processed at once (default: 1024).")
+    argparser.add_argument("--format", default = "HFA", help = "GDAL format of the output, COG for tiled Cloud-Optimized GeoTIFF with overviews (default: HFA).")
+    argparser.add_argument("--createopt", action = "append", default = None, help = "GDAL creation option of the output, may be repeated (default: COMPRESSED=YES for HFA; COMPRESS=DEFLATE, PREDICTOR=YES, NUM_THREADS=ALL_CPUS, OVERVIEWS=AUTO, BIGTIFF=IF_SAFER for COG).")
+    argparser.add_argument("--type", choices = ("Float32", "UInt16", "Int16"), default = "Float32", help = "Data type of the output, UInt16 and Int16 store the reflectance as scaled integers (value * quantification - boaoffset, with the scale and offset set in the metadata) in formats keeping the scale and offset (default: Float32).")
+    argparser.add_argument("--quantification", type = float, default = 10000, help = "Quantification value of the scaled integer output (default: 10000, as BOA_QUANTIFICATION_VALUE of L2A).")
+    argparser.add_argument("--boaoffset", type = float, default = -1000, help = "Offset of the scaled integer output in integer units (default: -1000, as BOA_ADD_OFFSET of L2A since processing baseline 04.00, keeping reflectance down to -0.1 in UInt16).")
+    args = argparser.parse_args()
+    if args.createopt is None:
+        if args.format == "HFA":
+            args.createopt = ["COMPRESSED=YES"]
+        elif args.format == "COG":
+            args.createopt = ["COMPRESS=DEFLATE", "PREDICTOR=YES", "NUM_THREADS=ALL_CPUS", "OVERVIEWS=AUTO", "BIGTIFF=IF_SAFER"]
+        else:
+            args.createopt = []
+    if args.type != "Float32" and args.format == "HFA":
+        argparser.error("scaled integer output needs a format keeping the scale and offset (e.g. GTiff or COG)")
+    if args.quantification <= 0:
+        argparser.error("quantification must be positive")
+    if args.circlesize < 3 or args.circlesize % 2 == 0:
+        argparser.error("circlesize must be an odd number >= 3")
+    if args.sample is not None and args.sample <= args.pixels:
+        argparser.error("sample must be greater than pixels")
+    gdal.UseExceptions()
+
+    inpfiles = SceneFiles(args.input, INPUTSX)
+    reffiles = SceneFiles(args.reference, INPUTSX)
+    output = args.output or args.input[:-len(INPUTSX)] + ("_20m_corr.tif" if args.format in ("COG", "GTiff") else "_20m_corr.img")
+    datasets = {'bands': OpenRaster(inpfiles['bands']), 'scl': OpenRaster(inpfiles['scl']), 'ndmi': OpenRaster(inpfiles['ndmi']), 'cloud': OpenRaster(inpfiles['cloud']),
+                'refbands': OpenRaster(reffiles['bands']), 'refscl': OpenRaster(reffiles['scl']), 'refndmi': OpenRaster(reffiles['ndmi'])}
+    if args.refcloud:
+        datasets['refcloud'] = OpenRaster(args.refcloud)
+    CheckGrid(datasets)
+    if datasets['bands'].RasterCount != datasets['refbands'].RasterCount:
+        sys.exit("ERROR: Number of input (" + str(datasets['bands'].RasterCount) + ") and reference (" + str(datasets['refbands'].RasterCount) + ") bands differ.")
+    names = [os.path.basename(args.input) + "." + str(k + 1) for k in range(datasets['bands'].RasterCount)]
+
+    geotransform = datasets['bands'].GetGeoTransform()
+    ewres = abs(geotransform[1])
+    nsres = abs(geotransform[5])
+    rows = datasets['bands'].RasterYSize
+    cols = datasets['bands'].RasterXSize
+    grid_shape = gridcorrel.GridShape(rows, cols, nsres, ewres, args.gridsize)
+    print("Grid size: " + str(grid_shape[0]) + " rows, " + str(grid_shape[1]) + " cols.")
+
+    moments, avalues, bvalues, extents = TileStatistics(datasets, grid_shape, args, nsres, ewres)
+    coefgrids = CoefGrids(moments, avalues, bvalues, grid_shape, args, names)
+    hullspans = gridcorrel.HullSpans(extents[0], extents[1], cols)
+    WriteOutput(datasets, output, grid_shape, coefgrids, hullspans, args)
+    print("Output file " + output + " created.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -24,11 +24,15 @@ REFNDMI="s2_20220719_20m_ndmi"
 # The GRASS command
 GRASSCMD=/usr/bin/grass
 #GRASSCMD=grass78
-#Directory with python scripts i.grid.correl.atcor.py and r.buff.cloudmask.py
+#Directory with python scripts i.grid.correl.atcor.py, i.atcor.mask.py, i.atcor.refindex.py and module gridcorrel.py
 SCRIPTDIR="/home/tom/Dropbox/grass-moje/grass-run"
 #i.grid.correl.atcor.py parameters (multiple space separated parameters and/or flags except input/output; leave empty for default values, use the commented example below as a guide for modifications)
 #ATCOR_PARMS=""
 ATCOR_PARMS="gridsize=4000 minr=0.88 pixels=300 regression=orthogonal"
+#Directory of the reference index (memory-mappable smoothed reference NDMI made by i.atcor.refindex.py once per reference, then shared by all the scenes; leave empty to always smooth the reference NDMI)
+REFINDEX="${THELOC}/PERMANENT/atcor_refindex"
+#Number of concurrent i.grid.correl.atcor.py jobs the bands are split into (1 = all bands in one run)
+JOBS=1
 ##NDMI difference mask parameters
 # max NDMI difference to pass the mask (to filter out change in vegetation cover and moisture content)
 MAXNDMIDIFF="0.1"
@@ -43,6 +47,12 @@ SCLSX="_SCL_20m.vrt"
 # Output file suffix. It must be different, than above suffixes. 
 # corr4or - 20220719 reference, orthogonal regression, results straight in reflectance as the reference.
 OUTPUTSX="_20m_corr4or.img"
+# Output file format: HFA - Float32 .img exported from the group of the corrected bands at the end, COG - tiled Cloud-Optimized GeoTIFF with overviews (use OUTPUTSX ending with .tif), every band exported as soon as its i.grid.correl.atcor.py job finishes, compressed by all the CPU cores in the end
+OUTFORMAT="HFA"
+# Data type of the COG output: Float32, or UInt16/Int16 for the reflectance stored as scaled integers the same way as in the L2A products (value = reflectance * OUTQUANTIFICATION - OUTBOAOFFSET, scale and offset set in the metadata as L2A_vrt-img does; -1000 keeps reflectance down to -0.1 in UInt16)
+OUTTYPE="Float32"
+OUTQUANTIFICATION=10000
+OUTBOAOFFSET=-1000
 #############################################################################
 
 
@@ -69,7 +79,9 @@ then
     cat <<!
  
 Usage:  
-     $SCRIPT_NAME [-a "<atcor parameters>"] <Input_reflective_bands_file.img>
+     $SCRIPT_NAME [-a "<atcor parameters>"] [-j N] [-y] [-r] [--resume] [--skip-ref-check] <Input_reflective_bands_file.img>
+To check the reference maps and scripts only:
+     $SCRIPT_NAME --check-only
 To get help:
      $SCRIPT_NAME -h
 To get version info:  
@@ -97,6 +109,40 @@ PARAMETERS
 		Must be passed as single string enclosed in double quotes. For 
 		help run 'i.grid.correl.atcor.py --help' within a GRASS GIS 
 		session.
+
+-j N
+--jobs N
+		(optional) Split the bands into N groups processed by 
+		concurrent i.grid.correl.atcor.py runs in the same temporary 
+		mapset (currently: $JOBS). Each run has its own log file.
+
+-y
+--yes
+		(optional) Do not ask or wait for anything (existing output 
+		file is overwritten), for unattended runs.
+
+-r
+--report
+		(optional) Write JSON run report of every i.grid.correl.atcor.py
+		job (stage and tile times, GRASS commands launched, peak memory)
+		next to the output file, named <output file>_job<N>.json.
+
+--resume
+		(optional) Use the mapset named after the input file 
+		(tmp_<input name>) instead of a new one, and resume the run 
+		interrupted in it: the maps already imported (if their source 
+		files did not change since) and the masks made from them are 
+		reused, i.grid.correl.atcor.py is run with the -r flag to reuse 
+		the tiles and bands it finished. Fails if the mapset is locked 
+		by a GRASS session still running.
+
+--skip-ref-check
+		(optional) Do not check the reference maps in PERMANENT (when
+		checked already, e.g. by L2A_batch_atcor.py).
+
+--check-only
+		Only check the reference maps in PERMANENT and the scripts, 
+		then exit (exit status 0 if all is OK).
 !
     exit
 fi
@@ -104,6 +150,11 @@ fi
 ## Functions
 #function name () { list; } [redirection]
 
+# Stamp of the map imported from the source file (map name, file modification time and size), the maps of the interrupted run are reused with --resume only if their stamp in $STAMPFILE is the same
+MapStamp () { echo "$1 $(stat -c '%Y %s' "$2")"; }
+StampMatches () { [ -n "$RESUME" ] && grep -qxF "$1" "$STAMPFILE" 2>/dev/null; }
+RecordStamp () { sed -i "/^${1%% *} /d" "$STAMPFILE" 2>/dev/null; echo "$1" >> "$STAMPFILE"; }
+
 
 ## Main program
 
@@ -115,6 +166,32 @@ while [[ "$#" -gt 0 ]]; do case $1 in
 		shift
 		;;
 
+  -j|--jobs) 
+		JOBS="$2"
+		[[ "$JOBS" =~ ^[1-9][0-9]*$ ]] || { echo "ERROR: Number of jobs must be a positive integer, got '$2'."; exit 1; }
+		shift
+		;;
+
+  -y|--yes) 
+		NOPROMPT="yes"
+		;;
+
+  -r|--report) 
+		REPORTS="yes"
+		;;
+
+  --resume) 
+		RESUME="yes"
+		;;
+
+  --skip-ref-check) 
+		SKIPREFCHECK="yes"
+		;;
+
+  --check-only) 
+		CHECKONLY="yes"
+		;;
+
   *)	
   		if [ -e "$1" ]
   		then
@@ -131,6 +208,9 @@ done
 
 ### CHECKS ##############################
 
+if [ -z "$CHECKONLY" ]
+then
+[ -n "$INPATHFILE" ] || { echo "ERROR: No input reflective bands file supplied. Please run $0 --help."; exit 1; }
 # get separate dirname and filename
 INDNAME="$(dirname $INPATHFILE)"
 INFNAME="${INPATHFILE#"${INDNAME}/"}"
@@ -142,9 +222,14 @@ L2ABASE="${INFNAME%"$INPUTSX"}"
 echo "Checking output file..."
 echo "Output directory: $INDNAME"
 echo "Output file: ${L2ABASE}${OUTPUTSX}"
-if [ -e ${INDNAME}${L2ABASE}${OUTPUTSX} ]
+if [ -e ${INDNAME}/${L2ABASE}${OUTPUTSX} ]
 then
-  read -t 20 -p "WARNING: Output file already exists and will be OWERWRITTEN. Press N to exit, Y or anything else to continue and overwrite the file in the end." 
+  if [ -n "$NOPROMPT" ]
+  then
+    echo "WARNING: Output file already exists and will be OWERWRITTEN."
+  else
+    read -t 20 -p "WARNING: Output file already exists and will be OWERWRITTEN. Press N to exit, Y or anything else to continue and overwrite the file in the end." 
+  fi
   case $REPLY in
 	  [yY]*)
 	    echo "Going ahead."
@@ -160,24 +245,23 @@ else
   echo "OK"
 fi
 echo
+fi
 
-# Check presence of reference maps in PERMANENT mapset
+# Check presence of reference maps in PERMANENT mapset (all of them from single g.list run)
+if [ -z "$SKIPREFCHECK" ]
+then
 echo "Checking presence of reference maps in PERMANENT mapset..."
 echo "Location: ${THELOC}"
-for band in 1 2 3 4 5 6 7 8 9 ; do
-  $GRASSCMD ${THELOC}/PERMANENT --exec g.findfile element=cell file="${REFBASE}.$band" > /dev/null 2>&1 || { echo "ERROR: map ${REFBASE}.$band not found in PERMANENT mapset. Please check REFERENCE MAPS in USER SETTINGS and in your PERMANENT."; exit 1; }
-  echo "${REFBASE}.$band OK"
-done
-echo
-
-# Check presence of reference auxiliary maps in PERMANENT mapset
-echo "Checking presence of reference maps in PERMANENT mapset..."
-for map in $REFCLOUDMASK $REFSCL $REFNDMI; do
-  $GRASSCMD ${THELOC}/PERMANENT --exec g.findfile element=cell file="$map" > /dev/null 2>&1 || { echo "ERROR: map $map not found in PERMANENT mapset. Please check REFERENCE MAPS in USER SETTINGS and in your PERMANENT."; exit 1; }
+REFLIST=$($GRASSCMD ${THELOC}/PERMANENT --exec g.list type=raster mapset=PERMANENT 2> /dev/null)
+for map in ${REFBASE}.1 ${REFBASE}.2 ${REFBASE}.3 ${REFBASE}.4 ${REFBASE}.5 ${REFBASE}.6 ${REFBASE}.7 ${REFBASE}.8 ${REFBASE}.9 $REFCLOUDMASK $REFSCL $REFNDMI; do
+  echo "$REFLIST" | grep -qx "$map" || { echo "ERROR: map $map not found in PERMANENT mapset. Please check REFERENCE MAPS in USER SETTINGS and in your PERMANENT."; exit 1; }
   echo "$map OK"
 done
 echo
+fi
 
+if [ -z "$CHECKONLY" ]
+then
 # Check presence of all input files
 echo "Checking presence of all input files in ${INDNAME}..."
 for suffix in $INPUTSX $CLOUDSX $WATERSX $NDMISX $SCLSX; do
@@ -189,14 +273,34 @@ for suffix in $INPUTSX $CLOUDSX $WATERSX $NDMISX $SCLSX; do
   echo "${L2ABASE}${suffix} OK" 
 done
 echo
+fi
 
 # Check presence of scripts
 echo "Checking presence of scripts in ${SCRIPTDIR}..."
 [ -e "${SCRIPTDIR}/i.grid.correl.atcor.py" ] || { echo "ERROR: script i.grid.correl.atcor.py not found. Please check SCRIPTDIR path in USER SETTINGS and content of the directory specified."; exit 1; }
 echo i.grid.correl.atcor.py OK
-[ -e "${SCRIPTDIR}/r.buff.cloudmask.py" ] || { echo "ERROR: script r.buff.cloudmask.py not found. Please check SCRIPTDIR path in USER SETTINGS and content of the directory specified."; exit 1; }
-echo r.buff.cloudmask.py OK
+[ -e "${SCRIPTDIR}/i.atcor.mask.py" ] || { echo "ERROR: script i.atcor.mask.py not found. Please check SCRIPTDIR path in USER SETTINGS and content of the directory specified."; exit 1; }
+echo i.atcor.mask.py OK
+case "$OUTFORMAT/$OUTTYPE" in
+  HFA/Float32|COG/Float32|COG/UInt16|COG/Int16) ;;
+  *) echo "ERROR: Unsupported output format/type $OUTFORMAT/$OUTTYPE. Please check OUTFORMAT and OUTTYPE in USER SETTINGS (the scaled integer types need the COG format)."; exit 1 ;;
+esac
+if [ "$OUTFORMAT" = "COG" ]
+then
+  command -v gdal_translate >/dev/null 2>&1 && command -v gdalbuildvrt >/dev/null 2>&1 || { echo "ERROR: gdal_translate and gdalbuildvrt are needed for the COG output. Please install gdal tools (gdal-bin package or similar)."; exit 1; }
+  gdal_translate --formats | grep -q "^ *COG" || { echo "ERROR: GDAL without the COG driver (GDAL 3.1 or newer needed). Please set OUTFORMAT=HFA in USER SETTINGS or update GDAL."; exit 1; }
+  case "$OUTPUTSX" in
+    *.tif) ;;
+    *) echo "ERROR: The COG output needs OUTPUTSX ending with .tif, got '$OUTPUTSX'. Please check OUTPUTSX in USER SETTINGS."; exit 1 ;;
+  esac
+  echo COG output OK
+fi
+[ -e "${SCRIPTDIR}/i.atcor.refindex.py" ] || { echo "ERROR: script i.atcor.refindex.py not found. Please check SCRIPTDIR path in USER SETTINGS and content of the directory specified."; exit 1; }
+echo i.atcor.refindex.py OK
+[ -e "${SCRIPTDIR}/gridcorrel.py" ] || { echo "ERROR: module gridcorrel.py not found. Please check SCRIPTDIR path in USER SETTINGS and content of the directory specified."; exit 1; }
+echo gridcorrel.py OK
 echo
+[ -z "$CHECKONLY" ] || { echo "All checks OK."; exit 0; }
 #########################################
 
 
@@ -204,66 +308,195 @@ echo
 ### PREPARE GRASS MAPSET ################
 #create mapset
 MAPSETNAME="tmp$$"
-echo "Creating mapset $MAPSETNAME in location $THELOC"
-$GRASSCMD -c -e ${THELOC}/${MAPSETNAME}
+# with --resume the mapset is named after the input, so the rerun finds the one of the interrupted run
+[ -z "$RESUME" ] || MAPSETNAME="tmp_$(echo -n "$L2ABASE" | tr -c 'A-Za-z0-9_' '_')"
+if [ -n "$RESUME" ] && [ -d "${THELOC}/${MAPSETNAME}" ]
+then
+  echo "Resuming in mapset $MAPSETNAME in location $THELOC"
+  # the lock of the interrupted session is removed, unless its process still runs (e.g. another run on the same input)
+  LOCKPID=$(cat "${THELOC}/${MAPSETNAME}/.gislock" 2>/dev/null)
+  if [ -n "$LOCKPID" ] && kill -0 "$LOCKPID" 2>/dev/null
+  then
+    echo "ERROR: Mapset $MAPSETNAME is in use by a running GRASS session (PID $LOCKPID). Wait for it to finish or stop it first."
+    exit 1
+  fi
+  rm -f "${THELOC}/${MAPSETNAME}/.gislock"
+else
+  echo "Creating mapset $MAPSETNAME in location $THELOC"
+  $GRASSCMD -c -e ${THELOC}/${MAPSETNAME}
+fi
 
 #link/import files 
 # New 2021-02: Do not use original ${L2ABASE} within the GRASS mapset, because it can contain unsupported characters. Use "input" and "output" instead. Means to do the replace down to the ## CREATE & EXPORT OUTPUT ## part (inclusive).  
 # Also stripping the trailing filetype suffix from the ${suffix}, like this: _cloud_mask_20m.img --> _cloud_mask_20m (i.e. with ${suffix%.*}).
 # Also reverted back to full import (r.in.gdal) instead of linking (r.external), since there were problems with ndmi file with nodata values defined as very high number. The parameters of both commands are identical. ###DEVIDEA: This makes it extremely easy to make the link/import method user-selectable.
 echo "Importing maps to mapset $MAPSETNAME"
+STAMPFILE="${THELOC}/${MAPSETNAME}/atcor_stamps"
+REIMPORTED=""
 for suffix in $INPUTSX $CLOUDSX $WATERSX $NDMISX $SCLSX; do
-  $GRASSCMD ${THELOC}/${MAPSETNAME} --exec r.in.gdal -oe input="${INDNAME}/${L2ABASE}${suffix}" output="input${suffix%.*}" > /dev/null 2>&1 || { echo "ERROR: map ${L2ABASE}$suffix import failed."; exit 1; }
+  STAMP="$(MapStamp "input${suffix%.*}" "${INDNAME}/${L2ABASE}${suffix}")"
+  # with --resume the map imported by the interrupted run is reused if its source file did not change since
+  StampMatches "$STAMP" && [ -n "$($GRASSCMD ${THELOC}/${MAPSETNAME} --exec g.list type=raster pattern="input${suffix%.*}" mapset=. 2>/dev/null)" ] && continue
+  $GRASSCMD ${THELOC}/${MAPSETNAME} --exec r.in.gdal -oe --overwrite input="${INDNAME}/${L2ABASE}${suffix}" output="input${suffix%.*}" > /dev/null 2>&1 || { echo "ERROR: map ${L2ABASE}$suffix import failed."; exit 1; }
+  RecordStamp "$STAMP"
+  REIMPORTED="yes"
 done
 echo
 
 #set region and null mask based on imported SCL file
 echo "Setting region"
 $GRASSCMD ${THELOC}/$MAPSETNAME --exec g.region raster="input${SCLSX%.*}" > /dev/null 2>&1 || { echo "ERROR: Setting region failed."; exit 1; }
+MASKFOUND="$($GRASSCMD ${THELOC}/${MAPSETNAME} --exec g.list type=raster pattern=MASK mapset=. 2>/dev/null)"
+if [ -n "$RESUME" ] && [ -n "$MASKFOUND" ] && [ -z "$REIMPORTED" ]
+then
+  # set by the interrupted run after the reference index update from the same imports; kept, the journal of i.grid.correl.atcor.py is bound to it
+  echo "Reusing the no-data areas MASK"
+else
+# the MASK of the stale imports removed, the index has to be updated without it
+[ -z "$MASKFOUND" ] || $GRASSCMD ${THELOC}/$MAPSETNAME --exec r.mask -r > /dev/null 2>&1
+if [ -n "$REFINDEX" ]
+then
+  # before the MASK is set, the index holds all the reference pixels; the map already indexed is skipped
+  echo "Updating reference index in $REFINDEX"
+  $GRASSCMD ${THELOC}/$MAPSETNAME --exec python ${SCRIPTDIR}/i.atcor.refindex.py refndmi="$REFNDMI" output="$REFINDEX" > /dev/null 2>&1 || echo "WARNING: Updating reference index failed, the reference NDMI will be smoothed in every run." #Missing index is non-fatal, the NDMI not indexed is smoothed as usual.
+fi
 echo "Masking no-data areas"
 $GRASSCMD ${THELOC}/$MAPSETNAME --exec r.mask -i raster="input${SCLSX%.*}" maskcats=0  > /dev/null 2>&1 2>&1 || echo "WARNING: Creating MASK for bands no-data areas failed." #Missing mask is non-fatal. It only prolongs the atcor processing for Sentinel-2 granules containing substantial nodata areas and makes these areas zero-value.
+fi
 #########################################
 
 
 
 ### CREATE CHANGE AND FEATURE MASKS #####
-echo "Creating SCL difference mask"
-$GRASSCMD ${THELOC}/$MAPSETNAME --exec r.mapcalc expression="scldiffmask = $REFSCL == input${SCLSX%.*}" > /dev/null 2>&1 || { echo "ERROR: Creating SCL difference mask failed."; exit 1; }
-echo "Creating NDMI difference mask"
-# NEW 2020-02: Using smoothing of both ndmi rasters first to mitigate image noise influence and to get true PIFs as features (areas) as opposed to scattered pixels.
-$GRASSCMD ${THELOC}/$MAPSETNAME --exec r.neighbors input="input${NDMISX%.*}" output=ndmi_in_smooth method=average size=3
-$GRASSCMD ${THELOC}/$MAPSETNAME --exec r.neighbors input="$REFNDMI" output=ndmi_ref_smooth method=average size=3
-# NEW 2020-02: Limit the mask to areas with low moisture content (NDMI<0.15) 
-$GRASSCMD ${THELOC}/$MAPSETNAME --exec r.mapcalc expression="ndmidiffmask = ( (ndmi_in_smooth - ndmi_ref_smooth) > -$MAXNDMIDIFF && (ndmi_in_smooth - ndmi_ref_smooth) < $MAXNDMIDIFF && (input${NDMISX%.*} < $MAXNDMI) && ($REFNDMI < $MAXNDMI) )" > /dev/null 2>&1 || { echo "ERROR: Creating NDMI difference mask failed."; exit 1; }
-echo "Buffering and cleaning cloud mask"
-$GRASSCMD ${THELOC}/$MAPSETNAME --exec python ${SCRIPTDIR}/r.buff.cloudmask.py input="input${CLOUDSX%.*}" buffsize=300 output="input${CLOUDSX%.*}_buff300" > /dev/null 2>&1 || { echo "ERROR: Buffering and cleaning cloud mask failed."; exit 1; }
+# All the rules in single pass: SCL difference, NDMI difference of the smoothed (3x3) NDMI rasters, low moisture content (NDMI < $MAXNDMI), input cloud mask and its cleaned and buffered (300 m) version, reference cloud mask. The result is bit-packed mask, pseudo-invariant pixels have all the bits set.
+# the pimask of the interrupted run is reused only if made from the same imports, reference maps and parameters
+STAMP="pimask $REFSCL $REFNDMI $REFCLOUDMASK $MAXNDMIDIFF $MAXNDMI"
+if [ -z "$REIMPORTED" ] && StampMatches "$STAMP" && [ -n "$($GRASSCMD ${THELOC}/${MAPSETNAME} --exec g.list type=raster pattern=pimask mapset=. 2>/dev/null)" ]
+then
+  echo "Reusing pseudo-invariant pixels mask"
+else
+echo "Creating pseudo-invariant pixels mask"
+$GRASSCMD ${THELOC}/$MAPSETNAME --exec python ${SCRIPTDIR}/i.atcor.mask.py --overwrite scl="input${SCLSX%.*}" refscl="$REFSCL" ndmi="input${NDMISX%.*}" refndmi="$REFNDMI" cloud="input${CLOUDSX%.*}" ${REFCLOUDMASK:+refcloud=$REFCLOUDMASK} maxndmidiff=$MAXNDMIDIFF maxndmi=$MAXNDMI buffsize=300 ${REFINDEX:+refindex=$REFINDEX} output=pimask > /dev/null 2>&1 || { echo "ERROR: Creating pseudo-invariant pixels mask failed."; exit 1; }
+RecordStamp "$STAMP"
+fi
 #########################################
 
 
 
 ### CREATE & EXPORT OUTPUT ##############
-read -p "Starting the i.grid.correl.atcor.py for all bands (press Ctrl-C to abort now)" -t 5
+[ -n "$NOPROMPT" ] || read -p "Starting the i.grid.correl.atcor.py for all bands (press Ctrl-C to abort now)" -t 5
 echo
-#run i.grid.correl.atcor.py
-time for i in 1 2 3 4 5 6 7 8 9
+#run i.grid.correl.atcor.py (the bands split into $JOBS concurrent runs, the bands of one run sharing the mask, grid and tiles)
+OUTPUTS=""
+JOBSCRIPT="tmpjobs_$$.sh"
+# the status of the tee pipe is that of the job, the failure of any job is the exit status of the job script
+echo "set -o pipefail" > $JOBSCRIPT
+echo "FAILED=0" >> $JOBSCRIPT
+for j in $(seq 1 $JOBS)
+do
+  INPUTS=""
+  REFERENCES=""
+  JOBOUTPUTS=""
+  # band i goes to the job (i-1)%JOBS+1
+  for i in 1 2 3 4 5 6 7 8 9
+  do 
+    [ $(( (i - 1) % JOBS + 1 )) -eq $j ] || continue
+    INPUTS="${INPUTS:+${INPUTS},}input${INPUTSX%.*}.$i"
+    REFERENCES="${REFERENCES:+${REFERENCES},}${REFBASE}.$i"
+    JOBOUTPUTS="${JOBOUTPUTS:+${JOBOUTPUTS},}input${OUTPUTSX%.*}.$i"
+  done
+  [ -n "$INPUTS" ] || continue
+  ATCORCMD="python ${SCRIPTDIR}/i.grid.correl.atcor.py --overwrite -k $ATCOR_PARMS input=$INPUTS reference=$REFERENCES output=$JOBOUTPUTS pimask=pimask"
+  # the report path made absolute, next to the output file
+  [ -z "$RESUME" ] || ATCORCMD="$ATCORCMD -r"
+  [ -z "$REPORTS" ] || ATCORCMD="$ATCORCMD report=$(cd "$INDNAME" && pwd)/${L2ABASE}${OUTPUTSX}_job$j.json"
+  if [ "$OUTFORMAT" = "COG" ]; then
+    # the bands of the job exported to the temporary tiled GeoTIFFs next to the output right after the job (the scaled integers encoded by r.mapcalc first), renamed to .tif only when the export succeeded
+    BANDDIR="$(cd "$INDNAME" && pwd)"
+    for i in 1 2 3 4 5 6 7 8 9
+    do
+      [ $(( (i - 1) % JOBS + 1 )) -eq $j ] || continue
+      case $OUTTYPE in
+        UInt16) ENCODE="tmpenc_$$_$i = round(max(1, min(65535, \"input${OUTPUTSX%.*}.$i\" * $OUTQUANTIFICATION - ($OUTBOAOFFSET))))"; EXPORTMAP="tmpenc_$$_$i"; EXPORTNULL=0 ;;
+        Int16) ENCODE="tmpenc_$$_$i = round(max(-32767, min(32767, \"input${OUTPUTSX%.*}.$i\" * $OUTQUANTIFICATION - ($OUTBOAOFFSET))))"; EXPORTMAP="tmpenc_$$_$i"; EXPORTNULL=-32768 ;;
+        *) ENCODE=""; EXPORTMAP="input${OUTPUTSX%.*}.$i"; EXPORTNULL="" ;;
+      esac
+      [ -z "$ENCODE" ] || ATCORCMD="$ATCORCMD && r.mapcalc --overwrite --quiet expression='$ENCODE'"
+      ATCORCMD="$ATCORCMD && r.out.gdal -c -f --overwrite --quiet input=$EXPORTMAP output=$BANDDIR/tmpband_$$_$i.part format=GTiff type=$OUTTYPE ${EXPORTNULL:+nodata=$EXPORTNULL} createopt=TILED=YES,BIGTIFF=IF_SAFER && mv $BANDDIR/tmpband_$$_$i.part $BANDDIR/tmpband_$$_$i.tif"
+      # the encoded map only needed for the export
+      [ -z "$ENCODE" ] || ATCORCMD="$ATCORCMD && g.remove -f --quiet type=raster name=$EXPORTMAP"
+    done
+  fi
+  if [ $JOBS -gt 1 ]; then
+    # concurrent jobs run in background, each writing to its own log
+    echo "{ $ATCORCMD; } > tmplog_$$_$j 2>&1 &" >> $JOBSCRIPT
+    echo "PIDS=\"\$PIDS \$!\"" >> $JOBSCRIPT
+  else
+    echo "{ $ATCORCMD; } 2>&1 | tee tmplog_$$_$j || FAILED=1" >> $JOBSCRIPT
+  fi
+done
+echo "for PID in \$PIDS; do wait \$PID || FAILED=1; done" >> $JOBSCRIPT
+echo "exit \$FAILED" >> $JOBSCRIPT
+# the output bands in the band order (for the group)
+for i in 1 2 3 4 5 6 7 8 9
 do 
-    LOG=${L2ABASE}${OUTPUTSX}.${i}_$(date +%s).log
-    if [ -z "$REFCLOUDMASK" ]; then 
-      $GRASSCMD ${THELOC}/$MAPSETNAME --exec python ${SCRIPTDIR}/i.grid.correl.atcor.py --overwrite -k $ATCOR_PARMS input=input${INPUTSX%.*}.$i reference=${REFBASE}.$i output=input${OUTPUTSX%.*}.$i masks=input${CLOUDSX%.*},input${CLOUDSX%.*}_buff300,ndmidiffmask,scldiffmask 2>&1 | tee tmplog_$$ || exit 1
-    else
-      $GRASSCMD ${THELOC}/$MAPSETNAME --exec python ${SCRIPTDIR}/i.grid.correl.atcor.py --overwrite -k $ATCOR_PARMS input=input${INPUTSX%.*}.$i reference=${REFBASE}.$i output=input${OUTPUTSX%.*}.$i masks=${REFCLOUDMASK},input${CLOUDSX%.*},input${CLOUDSX%.*}_buff300,ndmidiffmask,scldiffmask 2>&1 | tee tmplog_$$ || exit 1
-    fi
-    #Tidy up the log
-    #The sed filter removes terminal codes for progress percents, grep empty lines with spaces
-    cat tmplog_$$ | sed 's/\x1B\[[0-9;]\+[A-Za-z]//g' | grep "\S" > $LOG
-    rm tmplog_$$
-done 
+  OUTPUTS="${OUTPUTS:+${OUTPUTS},}input${OUTPUTSX%.*}.$i"
+done
+# all the jobs run within one GRASS session (the mapset can not be opened by more sessions at once)
+JOBSFAILED=""
+time $GRASSCMD ${THELOC}/$MAPSETNAME --exec bash $JOBSCRIPT || JOBSFAILED="yes"
+rm $JOBSCRIPT
+#Tidy up the logs (one per job)
+#The sed filter removes terminal codes for progress percents, grep empty lines with spaces
+for j in $(seq 1 $JOBS)
+do
+  [ -e tmplog_$$_$j ] || continue
+  if [ $JOBS -gt 1 ]; then
+    LOG=${L2ABASE}${OUTPUTSX}_$(date +%s)_job$j.log
+  else
+    LOG=${L2ABASE}${OUTPUTSX}_$(date +%s).log
+  fi
+  cat tmplog_$$_$j | sed 's/\x1B\[[0-9;]\+[A-Za-z]//g' | grep "\S" > $LOG
+  rm tmplog_$$_$j
+  echo "Log of job $j: $LOG"
+done
+# the encoded maps left by the failed exports removed
+if [ "$OUTFORMAT" = "COG" -a "$OUTTYPE" != "Float32" ]
+then
+  $GRASSCMD ${THELOC}/$MAPSETNAME --exec g.remove -f type=raster pattern="tmpenc_$$_*" > /dev/null 2>&1
+fi
+# the maps of the failed jobs (or the stale ones of the resumed run) are not exported
+[ -z "$JOBSFAILED" ] || { echo "ERROR: i.grid.correl.atcor.py failed, check the logs of the jobs. No output file created."; exit 1; }
 
+if [ "$OUTFORMAT" = "COG" ]
+then
+  # the bands exported by the jobs stacked and copied into the COG, the tiles compressed and overviews built by all the CPU cores
+  BANDFILES=""
+  for i in 1 2 3 4 5 6 7 8 9
+  do
+    [ -e ${INDNAME}/tmpband_$$_$i.tif ] || { echo "ERROR: Export of the corrected band $i failed, check the log of its job."; rm -f ${INDNAME}/tmpband_$$_*; exit 1; }
+    BANDFILES="$BANDFILES ${INDNAME}/tmpband_$$_$i.tif"
+  done
+  SCALEOPTS=""
+  if [ "$OUTTYPE" != "Float32" ]
+  then
+    # the same scale and offset as L2A_vrt-img sets (awk prints the leading zero, unlike bc)
+    SCALEOPTS="-a_scale $(awk "BEGIN { print 1 / $OUTQUANTIFICATION }") -a_offset $(awk "BEGIN { print $OUTBOAOFFSET / $OUTQUANTIFICATION }")"
+  fi
+  echo "Creating Cloud-Optimized GeoTIFF ${L2ABASE}${OUTPUTSX}"
+  COGFAILED=""
+  gdalbuildvrt -q -separate ${INDNAME}/tmpbands_$$.vrt $BANDFILES && \
+  gdal_translate -q -of COG $SCALEOPTS -co COMPRESS=DEFLATE -co PREDICTOR=YES -co NUM_THREADS=ALL_CPUS -co OVERVIEWS=AUTO -co BIGTIFF=IF_SAFER ${INDNAME}/tmpbands_$$.vrt ${INDNAME}/${L2ABASE}${OUTPUTSX} || COGFAILED="yes"
+  rm -f ${INDNAME}/tmpbands_$$.vrt $BANDFILES
+  # the output of an earlier run must not pass the final check
+  [ -z "$COGFAILED" ] || { echo "ERROR: Creating ${L2ABASE}${OUTPUTSX} failed."; rm -f ${INDNAME}/${L2ABASE}${OUTPUTSX}; exit 1; }
+else
 # create group of images, export
 #group
-$GRASSCMD ${THELOC}/$MAPSETNAME --exec i.group group=input${OUTPUTSX%.*} input=input${OUTPUTSX%.*}.1,input${OUTPUTSX%.*}.2,input${OUTPUTSX%.*}.3,input${OUTPUTSX%.*}.4,input${OUTPUTSX%.*}.5,input${OUTPUTSX%.*}.6,input${OUTPUTSX%.*}.7,input${OUTPUTSX%.*}.8,input${OUTPUTSX%.*}.9 > /dev/null 2>&1 || { echo "ERROR: Creating image group input${OUTPUTSX%.*} failed."; exit 1; }
+$GRASSCMD ${THELOC}/$MAPSETNAME --exec i.group group=input${OUTPUTSX%.*} input=$OUTPUTS > /dev/null 2>&1 || { echo "ERROR: Creating image group input${OUTPUTSX%.*} failed."; exit 1; }
 #export
 $GRASSCMD ${THELOC}/$MAPSETNAME --exec r.out.gdal -f --overwrite input=input${OUTPUTSX%.*} output=${INDNAME}/${L2ABASE}${OUTPUTSX} format=HFA type=Float32 createopt=COMPRESSED=YES
+fi
 #########################################
 
 
@@ -280,6 +513,7 @@ then
     echo "Output file ${INDNAME}/${L2ABASE}${OUTPUTSX} created."
 else
     echo "Something went wrog. Check the messages above and the logs."
+    exit 1
 fi
 echo "All done."
 #########################################
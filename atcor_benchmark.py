@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+#
+##############################################################################
+#
+# MODULE:       atcor_benchmark.py
+#
+# AUTHOR(S):    Tomas Brunclik, brunclik(at)atlas.cz
+#
+# PURPOSE:      Benchmark of the grid correlation normalization on synthetic
+#               scenes, to check the speed changes against the accuracy.
+#               The input/reference band pairs are generated at the 60, 20
+#               and 10 m resolutions (land cover patches, spatially varying
+#               known gain b and offset a of 'reference = a + b * input',
+#               clouds with undetected rims and speckles in the cloud mask,
+#               no-data corner of the input granule and a no-data patch of
+#               the reference), then the cloud mask buffering and the
+#               regression are run for every resolution, grid size and
+#               regression method by one of the backends:
+#               fake   - the scripts r.buff.cloudmask.py (or i.atcor.mask.py
+#                        with the pimask option) and i.grid.correl.atcor.py
+#                        run without GRASS against fakegrass.py, the numpy
+#                        stand-in of grass.script, grass.script.array and
+#                        pygrass RasterRow (engine=array and
+#                        interpolator=grid only), every case in a separate
+#                        process, the GRASS commands the scripts would
+#                        launch counted by fakegrass.py,
+#               grass  - the scenes are written into the current GRASS
+#                        mapset and the same scripts are run
+#                        (inside GRASS session only, the times, commands
+#                        count and peak memory are taken from the report of
+#                        i.grid.correl.atcor.py, see its report parameter).
+#               Reported are the wall time (and the times of the stages),
+#               number of GRASS commands launched, peak memory and the
+#               errors of the recovered a, b (the fitted tile grid
+#               interpolated to the pixels) and of the corrected
+#               reflectance, against the known coefficients.
+#
+# DATE:         2023
+#
+##############################################################################
+
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import os
+import argparse
+import json
+import multiprocessing
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+import gridcorrel
+
+# Names of the arrays of the synthetic scene files (see MakeScene)
+SCENE_ARRAYS = ('x', 'y', 'a', 'b', 'cloud', 'truecloud')
+
+def PeakMemory():
+    """Returns the peak resident memory (MB) of the process, None where not
+    available (the resource module is Unix only)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kB, except of OS X (bytes)
+    unit = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+
+def Patches(rng, rows, cols, size):
+    """Returns 2D array of smooth random field (zero mean, unit std) with
+    patches of about size pixels."""
+    size = max(int(size) // 2 * 2 + 1, 3)
+    field = gridcorrel.BoxMean(rng.rand(rows, cols), size)
+    return (field - field.mean()) / field.std()
+
+def MakeScene(filename, extent, res, nbands, clouds, seed):
+    """Generates the synthetic scene of extent x extent map units at the res
+    resolution and saves it into the .npz file filename. The arrays are
+    the input bands x and reference bands y (nbands, rows, cols, NaN for
+    no-data), the true a, b of 'y = a + b * x' (the same shape), the
+    detected cloud mask (0 - cloud, 1 - clear, as used by
+    r.buff.cloudmask.py) and the true clouds (boolean, with the rims the
+    cloud mask misses). The same seed gives the same scene at every
+    resolution (up to the pixel size)."""
+    rows = cols = int(round(extent / res))
+    rng = np.random.RandomState(seed)
+    # land cover: classes of patches of about 1 km with reflectances of every band, texture of about 200 m
+    classes = np.digitize(Patches(rng, rows, cols, 1000 / res), [-1.0, -0.4, 0.0, 0.4, 1.0])
+    classrefl = rng.uniform(0.02, 0.4, (nbands, 6))
+    texture = Patches(rng, rows, cols, 200 / res)
+    # coordinates of the pixel centers (0-1) for the smooth a, b trends
+    u = ((np.arange(cols) + 0.5) / cols)[np.newaxis, :]
+    v = ((np.arange(rows) + 0.5) / rows)[:, np.newaxis]
+    x = np.empty((nbands, rows, cols), dtype = np.float32)
+    y = np.empty((nbands, rows, cols), dtype = np.float32)
+    a = np.empty((nbands, rows, cols), dtype = np.float32)
+    b = np.empty((nbands, rows, cols), dtype = np.float32)
+    for k in range(nbands):
+        phase = rng.uniform(0, 2 * np.pi, 3)
+        x[k] = classrefl[k][classes] * (1 + 0.1 * texture) + rng.normal(0, 0.002, (rows, cols))
+        b[k] = 1 + 0.15 * np.sin(2 * np.pi * 0.7 * u + phase[0]) * np.cos(2 * np.pi * 0.5 * v + phase[1])
+        a[k] = 0.02 * np.sin(2 * np.pi * 0.6 * (u + v) + phase[2]) + 0.01 * (v - 0.5)
+        y[k] = a[k] + b[k] * x[k] + rng.normal(0, 0.003, (rows, cols))
+    # clouds: discs of 300 - 1500 m radius covering about the clouds fraction, the outer 15 % of the radius missed by the cloud mask
+    truecloud = np.zeros((rows, cols), dtype = bool)
+    cloud = np.ones((rows, cols), dtype = np.float32)
+    covered = 0.0
+    while covered < clouds * extent * extent:
+        radius = rng.uniform(300, 1500)
+        cx, cy = rng.uniform(0, extent, 2)
+        dist = np.hypot((u * extent - cx), (v * extent - cy))
+        truecloud |= dist <= radius
+        cloud[dist <= 0.85 * radius] = 0
+        covered += np.pi * radius * radius
+    # few pixel false clouds of the cloud mask (removed by the mode filter)
+    cloud[rng.rand(rows, cols) < 0.001] = 0
+    for k in range(nbands):
+        x[k][truecloud] = rng.uniform(0.4, 0.8, truecloud.sum())
+    # no-data corner of the input granule and no-data patch of the reference
+    x[:, (u + v) < 0.25] = np.nan
+    y[:, (np.abs(u - 0.7) < 0.05) & (np.abs(v - 0.3) < 0.05)] = np.nan
+    with open(filename, "wb") as f:
+        np.savez(f, x = x, y = y, a = a, b = b, cloud = cloud, truecloud = truecloud)
+
+def LoadScene(filename):
+    """Returns dict of the arrays of the scene saved by MakeScene."""
+    with np.load(filename) as data:
+        return dict([(name, data[name]) for name in SCENE_ARRAYS])
+
+def RecoveryErrors(scene, coefs, interpolation):
+    """Returns dict of the accepted tiles count and of the RMS errors of the
+    recovered a, b and of the corrected reflectance b * x + a against the
+    true ones (noise free), over the valid cloud-free pixels, per band.
+    coefs is the (bands, 2, grid rows, grid cols) array of the a, b of the
+    accepted tiles (NaN elsewhere), interpolated to the pixels by the grid
+    interpolator (gap filled, see i.grid.correl.atcor.py CoefGrid)."""
+    nbands, rows, cols = scene['x'].shape
+    rowweights = gridcorrel.AxisWeights(rows, coefs.shape[2], interpolation)
+    colweights = gridcorrel.AxisWeights(cols, coefs.shape[3], interpolation)
+    errors = {'tiles': [], 'a_rmse': [], 'b_rmse': [], 'refl_rmse': []}
+    for k in range(nbands):
+        accepted = ~np.isnan(coefs[k][1])
+        errors['tiles'].append(int(accepted.sum()))
+        if not accepted.any():
+            for name in ('a_rmse', 'b_rmse', 'refl_rmse'):
+                errors[name].append(None)
+            continue
+        ka, kb = gridcorrel.InterpolateGrid(gridcorrel.FillGaps(coefs[k]), rowweights, colweights)
+        x = scene['x'][k].astype(np.float64)
+        evaluated = ~np.isnan(x) & ~np.isnan(scene['y'][k]) & ~scene['truecloud']
+        a = scene['a'][k][evaluated]
+        b = scene['b'][k][evaluated]
+        x = x[evaluated]
+        errors['a_rmse'].append(float(np.sqrt(np.mean((ka[evaluated] - a)**2))))
+        errors['b_rmse'].append(float(np.sqrt(np.mean((kb[evaluated] - b)**2))))
+        errors['refl_rmse'].append(float(np.sqrt(np.mean((kb[evaluated] * x + ka[evaluated] - (a + b * x))**2))))
+    return errors
+
+def FakeCase(case):
+    """Runs the case (dict) by the fake backend: the scene is written into the
+    maps of fakegrass.py (numpy stand-in of grass.script, grass.script.array
+    and pygrass RasterRow) and the main() of the same scripts as by the
+    grass backend (see ScriptRuns) is run on them in this process, so the
+    code paths of the scripts are measured without GRASS (engine=array and
+    interpolator=grid only, the GRASS commands the scripts would launch are
+    counted by fakegrass.py). Run in a worker process, so the stand-in
+    modules and the peak memory are of the case only (the scene included).
+    Returns dict of the results, None if a script failed."""
+    import fakegrass
+    scriptdir = os.path.dirname(os.path.abspath(__file__))
+    directory = tempfile.mkdtemp(prefix = "fakegrass_", dir = case['workdir'])
+    try:
+        fakegrass.Install(directory)
+        scene = LoadScene(case['scene'])
+        maps = WriteGrassScene(scene, "bench_scene", case['extent'], case['resolution'], case['pimask'])
+        # the commands of the scripts only
+        fakegrass.COMMANDS.clear()
+        model = os.path.join(directory, "bench.npz")
+        maskstage, maskscript, maskoptions, atcoroptions = ScriptRuns(case, maps, "bench")
+        atcoroptions['savemodel'] = model
+        started = time.time()
+        try:
+            fakegrass.LoadScript(os.path.join(scriptdir, maskscript), maskoptions).main()
+            maskseconds = time.time() - started
+            atcor = fakegrass.LoadScript(os.path.join(scriptdir, "i.grid.correl.atcor.py"), atcoroptions)
+            atcor.main()
+        except fakegrass.ScriptError as e:
+            print("ERROR: " + str(e), file = sys.stderr)
+            return None
+        seconds = time.time() - started
+        result = {'seconds': seconds, 'stages': [{'stage': maskstage, 'seconds': maskseconds}] + atcor.REPORT['stages'],
+                  'commands': sum(fakegrass.COMMANDS.values()), 'peak_memory_mb': PeakMemory()}
+        result.update(RecoveryErrors(scene, gridcorrel.LoadModel(model)['coefs'], case['interpolation']))
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+def RunInWorker(function, *args):
+    """Returns function(*args) run in a new worker process."""
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(function, args)
+    finally:
+        pool.close()
+        pool.join()
+
+def MaskLayers(scene):
+    """Returns dict of the synthetic input layers of i.atcor.mask.py for the
+    scene (the pimask option): the scene classifications scl and refscl
+    (4 and 5 split by the median of the first band, 9 for the clouds of the
+    cloud mask in scl) and the moisture indices ndmi and refndmi of the
+    last and first band of the input and reference (NaN for no-data)."""
+    layers = {}
+    for prefix, bands in (("", scene['x']), ("ref", scene['y'])):
+        first = bands[0].astype(np.float64)
+        last = bands[-1].astype(np.float64)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            layers[prefix + "scl"] = np.where(np.isnan(first), np.nan, np.where(first > np.nanmedian(first), 5, 4))
+            layers[prefix + "ndmi"] = (last - first) / (last + first)
+    layers['scl'][scene['cloud'] == 0] = 9
+    return layers
+
+def WriteGrassScene(scene, prefix, extent, res, masklayers = False):
+    """Writes the arrays of the scene into rasters of the current mapset
+    (<prefix>_x<band>, <prefix>_y<band>, <prefix>_cloud and with masklayers
+    the layers of MaskLayers as <prefix>_<layer>) in the region of the
+    scene. Returns dict of the map names: lists inputs and references, the
+    cloud mask cloud and the mask layers."""
+    import grass.script as grass
+    import grass.script.array as garray
+    grass.run_command("g.region", n = extent, s = 0, e = extent, w = 0, res = res, quiet = True)
+    maps = {'inputs': [], 'references': []}
+    for k in range(scene['x'].shape[0]):
+        for names, name, values in ((maps['inputs'], "x", scene['x'][k]), (maps['references'], "y", scene['y'][k])):
+            names.append(prefix + "_" + name + str(k + 1))
+            raster = garray.array()
+            raster[...] = np.where(np.isnan(values), -9999, values)
+            raster.write(mapname = names[-1], null = -9999, overwrite = True)
+    raster = garray.array()
+    raster[...] = scene['cloud']
+    raster.write(mapname = prefix + "_cloud", overwrite = True)
+    maps['cloud'] = prefix + "_cloud"
+    if masklayers:
+        for name, values in MaskLayers(scene).items():
+            maps[name] = prefix + "_" + name
+            raster = garray.array()
+            raster[...] = np.where(np.isnan(values), -9999, values)
+            raster.write(mapname = maps[name], null = -9999, overwrite = True)
+    return maps
+
+def ScriptRuns(case, maps, name):
+    """Returns the stage name, the script and its options (dict) of the mask
+    of the case on the maps of the scene (see WriteGrassScene): the cloud
+    mask buffering by r.buff.cloudmask.py, or with the pimask option the
+    pseudo-invariant pixels mask by i.atcor.mask.py as L2A_grass_atcor.sh
+    builds it, and the options of i.grid.correl.atcor.py. The maps created
+    are prefixed by name."""
+    if case['pimask']:
+        maskstage = "pimask"
+        maskscript = "i.atcor.mask.py"
+        maskoptions = {'scl': maps['scl'], 'refscl': maps['refscl'], 'ndmi': maps['ndmi'], 'refndmi': maps['refndmi'], 'cloud': maps['cloud'],
+                       'output': name + "_pimask", 'buffsize': str(int(case['buffsize'])), 'circlesize': str(case['circlesize'])}
+        atcoroptions = {'pimask': name + "_pimask"}
+    else:
+        maskstage = "cloudmask"
+        maskscript = "r.buff.cloudmask.py"
+        maskoptions = {'input': maps['cloud'], 'clmask': name + "_clean", 'output': name + "_buff", 'buffsize': str(int(case['buffsize'])),
+                       'circlesize': str(case['circlesize']), 'engine': case['cloudengine']}
+        atcoroptions = {'masks': name + "_buff"}
+    atcoroptions.update({'input': ",".join(maps['inputs']), 'reference': ",".join(maps['references']),
+                         'output': ",".join([name + "_out" + str(k + 1) for k in range(len(maps['inputs']))]),
+                         'gridsize': str(case['gridsize']), 'pixels': str(case['pixels']), 'minr': str(case['minr']), 'regression': case['method'],
+                         'engine': case['engine'], 'interpolator': case['interpolator'], 'interpolation': case['interpolation']})
+    if case['sample']:
+        atcoroptions.update({'sample': str(case['sample']), 'seed': str(case['seed'])})
+    return maskstage, maskscript, maskoptions, atcoroptions
+
+def GrassCase(case, maps, workdir):
+    """Runs the case (dict) by the grass backend: the scripts of ScriptRuns
+    (i.grid.correl.atcor.py with report and savemodel) on the maps of the
+    scene. Returns dict of the results, None if a script failed."""
+    import grass.script as grass
+    scriptdir = os.path.dirname(os.path.abspath(__file__))
+    name = "bench_" + str(os.getpid())
+    report = os.path.join(workdir, name + ".json")
+    model = os.path.join(workdir, name + ".npz")
+    maskstage, maskscript, maskoptions, atcoroptions = ScriptRuns(case, maps, name)
+    atcoroptions.update({'report': report, 'savemodel': model})
+    started = time.time()
+    if subprocess.call([sys.executable, os.path.join(scriptdir, maskscript)] + [key + "=" + value for key, value in sorted(maskoptions.items())] + ["--overwrite", "--quiet"]) != 0:
+        return None
+    maskseconds = time.time() - started
+    code = subprocess.call([sys.executable, os.path.join(scriptdir, "i.grid.correl.atcor.py")] + [key + "=" + value for key, value in sorted(atcoroptions.items())] + ["--overwrite", "--quiet"])
+    seconds = time.time() - started
+    grass.run_command("g.remove", flags = 'f', type = "raster", pattern = name + "_*", quiet = True)
+    if code != 0:
+        return None
+    with open(report) as f:
+        runreport = json.load(f)
+    peak = runreport['peak_memory_mb']
+    result = {'seconds': seconds, 'stages': [{'stage': maskstage, 'seconds': maskseconds}] + runreport['stages'],
+              'commands': runreport['commands_total'], 'peak_memory_mb': max([m for m in (peak['script'], peak['children']) if m is not None] or [None])}
+    result.update(RecoveryErrors(LoadScene(case['scene']), gridcorrel.LoadModel(model)['coefs'], case['interpolation']))
+    return result
+
+def Mean(values):
+    """Mean of the values not None, None if there is none."""
+    values = [v for v in values if v is not None]
+    return sum(values) / len(values) if values else None
+
+def main():
+    argparser = argparse.ArgumentParser(description = "Benchmark of the cloud mask buffering and grid correlation regression on synthetic scenes with known gain and offset.")
+    argparser.add_argument("--backend", choices = ("fake", "grass"), default = "fake", help = "fake - the scripts run without GRASS against fakegrass.py (engine=array, interpolator=grid), grass - the scripts run in the current GRASS mapset (default: fake).")
+    argparser.add_argument("--resolutions", default = "60,20,10", help = "Resolutions (m) of the scenes (default: 60,20,10).")
+    argparser.add_argument("--extent", type = float, default = 24000, help = "Size of the square scenes in m (default: 24000; 109800 for the full Sentinel-2 granule).")
+    argparser.add_argument("--bands", type = int, default = 3, help = "Number of bands (default: 3).")
+    argparser.add_argument("--methods", default = "theil_sen,orthogonal,least_sq,huber,tukey", help = "Regression methods (default: theil_sen,orthogonal,least_sq,huber,tukey).")
+    argparser.add_argument("--gridsizes", default = "3000,6000", help = "Grid tile sizes in m (default: 3000,6000).")
+    argparser.add_argument("--clouds", type = float, default = 0.1, help = "Fraction of the scene covered by clouds (default: 0.1).")
+    argparser.add_argument("--seed", type = int, default = 0, help = "Seed of the random scenes (default: 0).")
+    argparser.add_argument("--pixels", type = int, default = 300, help = "Minimal number of valid pixels in tile (default: 300).")
+    argparser.add_argument("--minr", type = float, default = 0.9, help = "Minimal correlation coefficient R to accept (default: 0.9).")
+    argparser.add_argument("--buffsize", type = float, default = 300, help = "Cloud buffer size in meters (default: 300).")
+    argparser.add_argument("--circlesize", type = int, default = 9, help = "Size of circular area to filter out few pixel-sized clouds (default: 9).")
+    argparser.add_argument("--sample", type = int, default = None, help = "Maximum number of valid pixels per tile to fit (stratified sample, see the sample parameter of i.grid.correl.atcor.py).")
+    argparser.add_argument("--pimask", action = "store_true", help = "Mask the pixels by the pseudo-invariant pixels mask of i.atcor.mask.py (from synthetic scene classifications and NDMI) instead of the cloud mask buffered by r.buff.cloudmask.py, as L2A_grass_atcor.sh does.")
+    argparser.add_argument("--interpolation", choices = ("bilinear", "bicubic"), default = "bicubic", help = "Interpolation of the regression parameters (default: bicubic).")
+    argparser.add_argument("--engine", choices = ("tiles", "array"), help = "engine of i.grid.correl.atcor.py (default: tiles for the grass backend, the fake backend runs array only).")
+    argparser.add_argument("--interpolator", choices = ("bspline", "grid"), default = "grid", help = "interpolator of i.grid.correl.atcor.py (default: grid, the fake backend runs grid only). The errors are computed from the saved model by the grid interpolator anyway.")
+    argparser.add_argument("--cloudengine", choices = ("modules", "array"), help = "engine of r.buff.cloudmask.py (default: modules for the grass backend, the fake backend runs array only).")
+    argparser.add_argument("--workdir", help = "Directory for the scene files (default: temporary directory removed in the end).")
+    argparser.add_argument("-o", "--output", help = "JSON file to write the results to.")
+    args = argparser.parse_args()
+    if args.backend == "grass" and "GISBASE" not in os.environ:
+        print("ERROR: The grass backend has to be run in GRASS GIS session.")
+        return 1
+    if args.backend == "fake":
+        # the tiles engine, v.surf.bspline and r.neighbors/r.buffer need GRASS
+        if args.engine == "tiles" or args.interpolator == "bspline" or args.cloudengine == "modules":
+            print("ERROR: The fake backend runs engine=array, interpolator=grid and cloudengine=array only.")
+            return 1
+        args.engine = args.cloudengine = "array"
+    else:
+        args.engine = args.engine or "tiles"
+        args.cloudengine = args.cloudengine or "modules"
+    workdir = args.workdir or tempfile.mkdtemp(prefix = "atcor_benchmark_")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    if args.backend == "grass":
+        import grass.script as grass
+        grass.use_temp_region()
+    results = []
+    print("%4s %8s %-10s %9s %8s %8s %6s %9s %9s %9s" % ("res", "gridsize", "method", "seconds", "commands", "peak MB", "tiles", "a rmse", "b rmse", "refl rmse"))
+    try:
+        for res in [float(r) for r in args.resolutions.split(',')]:
+            scene = os.path.join(workdir, "scene_%d_%d_%d_%g_%g.npz" % (args.seed, args.extent, args.bands, args.clouds, res))
+            if not os.path.isfile(scene):
+                RunInWorker(MakeScene, scene, args.extent, res, args.bands, args.clouds, args.seed)
+            if args.backend == "grass":
+                maps = WriteGrassScene(LoadScene(scene), "bench_scene", args.extent, res, args.pimask)
+            for gridsize in [int(g) for g in args.gridsizes.split(',')]:
+                for method in args.methods.split(','):
+                    case = {'scene': scene, 'resolution': res, 'gridsize': gridsize, 'method': method, 'pixels': args.pixels, 'minr': args.minr,
+                            'sample': args.sample, 'seed': args.seed, 'buffsize': args.buffsize, 'circlesize': args.circlesize, 'interpolation': args.interpolation,
+                            'engine': args.engine, 'interpolator': args.interpolator, 'cloudengine': args.cloudengine, 'pimask': args.pimask,
+                            'extent': args.extent, 'workdir': workdir}
+                    if args.backend == "grass":
+                        result = GrassCase(case, maps, workdir)
+                    else:
+                        result = RunInWorker(FakeCase, case)
+                    if result is None:
+                        print("%4g %8g %-10s FAILED" % (res, gridsize, method))
+                        results.append(dict(case, status = "failed"))
+                        continue
+                    case.update(result)
+                    case['status'] = "ok"
+                    results.append(case)
+                    errors = [Mean(case[name]) for name in ('a_rmse', 'b_rmse', 'refl_rmse')]
+                    print("%4g %8g %-10s %9.2f %8s %8s %6d %9s %9s %9s" % ((res, gridsize, method, case['seconds'], "-" if case['commands'] is None else str(case['commands']),
+                          "-" if case['peak_memory_mb'] is None else "%.0f" % case['peak_memory_mb'], sum(case['tiles']))
+                          + tuple(["-" if e is None else "%.5f" % e for e in errors])))
+                    sys.stdout.flush()
+        # the times of the methods fitting the pixels, not the sums
+        methods = args.methods.split(',')
+        if "theil_sen" in methods:
+            print("Note: theil_sen fits the pixels of every accepted tile (the pixels and slopes of the tile sorted, O(n log n) per tile and band), least_sq and orthogonal the six sums of the tile only, so theil_sen takes many times longer, the more the finer the resolution.")
+        robust = [method for method in methods if method in gridcorrel.ROBUST_METHODS]
+        if robust:
+            print("Note: " + ", ".join(robust) + ": the weighted sums of all the pixels recomputed in every iteration (up to 10), so several times longer than least_sq and orthogonal.")
+    finally:
+        if args.backend == "grass":
+            grass.run_command("g.remove", flags = 'f', type = "raster", pattern = "bench_scene_*", quiet = True)
+        if not args.workdir:
+            shutil.rmtree(workdir)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'backend': args.backend, 'extent': args.extent, 'bands': args.bands, 'seed': args.seed, 'clouds': args.clouds, 'cases': results}, f, indent = 1, sort_keys = True)
+        print("Results written to " + args.output)
+    return 0 if all(case['status'] == "ok" for case in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
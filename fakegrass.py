@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+################################################################################
+"""
+MODULE:       fakegrass.py
+
+AUTHOR(S):    Tomas Brunclik, brunclik(at)atlas.cz
+
+PURPOSE:      Numpy-backed stand-in of the parts of grass.script,
+              grass.script.array and grass.pygrass.raster used by the array
+              code paths of the scripts (r.buff.cloudmask.py engine=array,
+              i.atcor.mask.py and i.grid.correl.atcor.py engine=array
+              interpolator=grid), so their main() can be run without GRASS
+              by atcor_benchmark.py and the tests. The raster
+              maps are held in memory as float64 arrays (NaN for null) of the
+              current region, the grid vectors made by v.mkgrid as the grid
+              shape and the attribute table as dict. The GRASS commands are
+              counted per module in COMMANDS, the commands other than those
+              the array code paths run are refused (ScriptError).
+              Install() puts the stand-in modules into sys.modules,
+              LoadScript() loads a script as module (its main() is not run).
+"""
+################################################################################
+
+# __future__ makes python3 syntax work in python2 (version 2.7+)
+from __future__ import division
+from __future__ import print_function
+
+import fnmatch
+import os
+import re
+import string
+import sys
+import tempfile
+import types
+
+import numpy as np
+
+
+# Null value of the CELL rows read by pygrass
+CELL_NULL = -2147483648
+
+# Raster maps {name: (values, mtype, region)}, vector grids {name: {'grid': (rows, cols), 'table': {cat: {column: value}}}}
+MAPS = {}
+VECTORS = {}
+
+# Current region (see SetRegion) and the GRASS commands run per module
+REGION = {}
+COMMANDS = {}
+
+# Directory of the files standing for the raster maps (their modification time is the stamp of the map)
+STATE = {'directory': None}
+
+# numpy types of the map types
+MTYPES = {'CELL': np.int32, 'FCELL': np.float32, 'DCELL': np.float64}
+
+
+class ScriptError(Exception):
+    """Error raised by fatal() (as by grass.script with raise_on_error)."""
+    pass
+
+
+def Count(prog):
+    COMMANDS[prog] = COMMANDS.get(prog, 0) + 1
+
+
+def SetRegion(n, s, e, w, res):
+    """Sets the current region (the rows and cols rounded as by g.region)."""
+    REGION.clear()
+    REGION.update({'n': float(n), 's': float(s), 'e': float(e), 'w': float(w)})
+    REGION['rows'] = int(round((REGION['n'] - REGION['s']) / float(res)))
+    REGION['cols'] = int(round((REGION['e'] - REGION['w']) / float(res)))
+    REGION['nsres'] = (REGION['n'] - REGION['s']) / REGION['rows']
+    REGION['ewres'] = (REGION['e'] - REGION['w']) / REGION['cols']
+
+
+def StoreMap(name, values, mtype):
+    """Stores the map values (2D array of the region, NaN for null) and
+    touches the file standing for the map."""
+    values = np.array(values, dtype=np.float64)
+    if values.shape != (REGION['rows'], REGION['cols']):
+        raise ScriptError("Map <" + name + "> does not match the region.")
+    if mtype == 'CELL':
+        values = np.where(np.isnan(values), np.nan, np.trunc(values))
+    MAPS[name] = (values, mtype, dict(REGION))
+    with open(MapFile(name), "w"):
+        pass
+
+
+def MapValues(name):
+    """Returns the values and mtype of the map, which has to be stored in the
+    current region (the maps are not resampled)."""
+    name = name.split('@')[0]
+    if name not in MAPS:
+        raise ScriptError("Raster map <" + name + "> not found.")
+    values, mtype, mapregion = MAPS[name]
+    if mapregion != REGION:
+        raise ScriptError("Raster map <" + name + "> is not in the current region, fakegrass does not resample.")
+    return values, mtype
+
+
+def MapFile(name):
+    return os.path.join(STATE['directory'], name)
+
+
+def RemoveMap(name):
+    if name in MAPS:
+        del MAPS[name]
+        os.remove(MapFile(name))
+
+
+################################################################################
+# grass.script
+
+def region(**kwargs):
+    return dict(REGION)
+
+
+def gisenv():
+    return {'GISDBASE': STATE['directory'], 'LOCATION_NAME': "fake", 'MAPSET': "fake"}
+
+
+def message(msg, flag=None):
+    pass
+
+
+def verbose(msg):
+    pass
+
+
+def debug(msg, debug=1):
+    pass
+
+
+def percent(i, n, s):
+    pass
+
+
+def warning(msg):
+    print("WARNING: " + msg, file=sys.stderr)
+
+
+def fatal(msg):
+    raise ScriptError(msg)
+
+
+def append_node_pid(name):
+    return name + "_" + str(os.getpid())
+
+
+def use_temp_region():
+    STATE['saved_region'] = dict(REGION)
+
+
+def del_temp_region():
+    if STATE.get('saved_region'):
+        REGION.clear()
+        REGION.update(STATE.pop('saved_region'))
+
+
+def find_file(name, element="cell", mapset=None):
+    name = name.split('@')[0]
+    if element == "cell" and name in MAPS:
+        return {'name': name, 'mapset': "fake", 'fullname': name + "@fake", 'file': MapFile(name)}
+    return {'name': "", 'mapset': "", 'fullname': "", 'file': ""}
+
+
+def run_command(prog, **kwargs):
+    Count(prog)
+    if prog == "g.region" and 'raster' in kwargs:
+        REGION.clear()
+        REGION.update(MAPS[kwargs['raster'].split('@')[0]][2])
+    elif prog == "g.region":
+        SetRegion(kwargs.get('n', REGION.get('n')), kwargs.get('s', REGION.get('s')), kwargs.get('e', REGION.get('e')),
+                  kwargs.get('w', REGION.get('w')), kwargs['res'])
+    elif prog == "v.mkgrid":
+        grid_rows, grid_cols = [int(v) for v in kwargs['grid']]
+        VECTORS[kwargs['map']] = {'grid': (grid_rows, grid_cols), 'table': dict([(cat, {}) for cat in range(1, grid_rows * grid_cols + 1)])}
+    elif prog in ("g.gisenv", "v.db.addcolumn"):
+        # the printed mapset path and the columns of the table (created by the updates)
+        pass
+    elif prog == "g.remove":
+        names = kwargs.get('name', "").split(',') if kwargs.get('name') else []
+        for name in list(MAPS) + list(VECTORS):
+            if name in names or (kwargs.get('pattern') and fnmatch.fnmatch(name, kwargs['pattern'])):
+                RemoveMap(name)
+                VECTORS.pop(name, None)
+    else:
+        raise ScriptError(prog + " is not supported by fakegrass.")
+    return 0
+
+
+def read_command(prog, **kwargs):
+    Count(prog)
+    if prog == "v.out.ascii" and kwargs.get('type') == "centroid":
+        # centroids of the tiles, categories row by row from the top left tile
+        grid_rows, grid_cols = VECTORS[kwargs['input']]['grid']
+        height = (REGION['n'] - REGION['s']) / grid_rows
+        width = (REGION['e'] - REGION['w']) / grid_cols
+        sep = kwargs.get('separator', "|")
+        lines = []
+        for tile in range(grid_rows * grid_cols):
+            x = REGION['w'] + (tile % grid_cols + 0.5) * width
+            y = REGION['n'] - (tile // grid_cols + 0.5) * height
+            lines.append(repr(x) + sep + repr(y) + sep + str(tile + 1))
+        return "\n".join(lines) + "\n"
+    raise ScriptError(prog + " is not supported by fakegrass.")
+
+
+def write_command(prog, stdin=None, **kwargs):
+    Count(prog)
+    if prog != "db.execute":
+        raise ScriptError(prog + " is not supported by fakegrass.")
+    # the UPDATE statements of WriteTileValues only
+    for statement in stdin.split(";"):
+        if not statement.strip():
+            continue
+        match = re.match(r"\s*UPDATE\s+(\S+)\s+SET\s+(.*)\s+WHERE\s+cat=(\d+)\s*$", statement, re.S)
+        if not match:
+            raise ScriptError("SQL not supported by fakegrass: " + statement)
+        table = VECTORS[match.group(1)]['table'][int(match.group(3))]
+        for assignment in re.findall(r"(\w+)=('(?:[^']|'')*'|[^,]+)", match.group(2)):
+            column, value = assignment
+            value = value.strip()
+            table[column] = None if value == "NULL" else value.strip("'").replace("''", "'")
+    return 0
+
+
+def vector_db_select(map, columns=None, **kwargs):
+    Count("v.db.select")
+    columns = columns.split(',')
+    table = VECTORS[map.split('@')[0]]['table']
+    return {'columns': columns,
+            'values': dict([(cat, ["" if table[cat].get(c) is None else str(table[cat][c]) for c in columns]) for cat in table])}
+
+
+def mapcalc(exp, **kwargs):
+    """r.mapcalc of the expressions 'name = expression' of map names, numbers,
+    isnull(), ! && || == != < > <= >= + - * / and parentheses, with the null
+    propagation of r.mapcalc (&& and || are null if any argument is null).
+    The ${name} templates are replaced by the keyword arguments."""
+    Count("r.mapcalc")
+    exp = string.Template(exp).safe_substitute(kwargs)
+    name, expression = exp.split("=", 1)
+    values = MapcalcParser(expression).Parse()
+    StoreMap(name.strip(), np.broadcast_to(values, (REGION['rows'], REGION['cols'])),
+             'CELL' if re.search(r"&&|\|\||==|!=|<|>|isnull", expression) else 'DCELL')
+
+
+class MapcalcParser(object):
+    """Recursive descent parser evaluating the r.mapcalc expression on the
+    maps (float64 arrays, NaN for null)."""
+
+    TOKENS = re.compile(r"\s*(&&|\|\||==|!=|<=|>=|[<>!()+\-*/]|[0-9.]+(?:[eE][-+]?[0-9]+)?|[A-Za-z_][\w.@]*)")
+
+    def __init__(self, expression):
+        self.tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = self.TOKENS.match(expression, position)
+            if not match:
+                raise ScriptError("r.mapcalc expression not supported by fakegrass: " + expression)
+            self.tokens.append(match.group(1))
+            position = match.end()
+        self.position = 0
+
+    def Peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def Take(self, expected=None):
+        token = self.Peek()
+        if expected is not None and token != expected:
+            raise ScriptError("r.mapcalc: expected " + expected + ", got " + str(token))
+        self.position += 1
+        return token
+
+    def Parse(self):
+        values = self.Or()
+        if self.Peek() is not None:
+            raise ScriptError("r.mapcalc: unexpected " + self.Peek())
+        return values
+
+    @staticmethod
+    def Logical(a, b, result):
+        return np.where(np.isnan(a) | np.isnan(b), np.nan, result.astype(np.float64))
+
+    def Or(self):
+        values = self.And()
+        while self.Peek() == "||":
+            self.Take()
+            other = self.And()
+            values = self.Logical(values, other, (values != 0) | (other != 0))
+        return values
+
+    def And(self):
+        values = self.Comparison()
+        while self.Peek() == "&&":
+            self.Take()
+            other = self.Comparison()
+            values = self.Logical(values, other, (values != 0) & (other != 0))
+        return values
+
+    def Comparison(self):
+        values = self.Sum()
+        operators = {'==': np.equal, '!=': np.not_equal, '<': np.less, '>': np.greater, '<=': np.less_equal, '>=': np.greater_equal}
+        while self.Peek() in operators:
+            operator = operators[self.Take()]
+            other = self.Sum()
+            with np.errstate(invalid='ignore'):
+                values = self.Logical(values, other, operator(values, other))
+        return values
+
+    def Sum(self):
+        values = self.Product()
+        while self.Peek() in ("+", "-"):
+            values = values + self.Product() if self.Take() == "+" else values - self.Product()
+        return values
+
+    def Product(self):
+        values = self.Unary()
+        while self.Peek() in ("*", "/"):
+            if self.Take() == "*":
+                values = values * self.Unary()
+            else:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    values = values / self.Unary()
+        return values
+
+    def Unary(self):
+        if self.Peek() == "!":
+            self.Take()
+            values = self.Unary()
+            return np.where(np.isnan(values), np.nan, (values == 0).astype(np.float64))
+        if self.Peek() == "-":
+            self.Take()
+            return -self.Unary()
+        return self.Primary()
+
+    def Primary(self):
+        token = self.Take()
+        if token == "(":
+            values = self.Or()
+            self.Take(")")
+            return values
+        if token == "isnull":
+            self.Take("(")
+            values = self.Or()
+            self.Take(")")
+            return np.isnan(values).astype(np.float64)
+        if token is not None and re.match(r"[0-9.]", token):
+            return np.float64(token)
+        if token is not None and token.split('@')[0] in MAPS:
+            return MapValues(token)[0]
+        raise ScriptError("r.mapcalc: raster map <" + str(token) + "> not found")
+
+
+################################################################################
+# grass.script.array
+
+class array(np.ndarray):
+    """garray.array: 2D float64 array of the current region, read from the
+    map mapname (nulls as NaN) if given."""
+
+    def __new__(cls, mapname=None, null=None, dtype=np.float64):
+        values = np.ndarray.__new__(cls, (REGION['rows'], REGION['cols']), dtype=dtype)
+        if mapname:
+            Count("r.out.bin")
+            values[...] = MapValues(mapname)[0]
+        else:
+            values[...] = 0
+        return values
+
+    def write(self, mapname, title=None, null=None, overwrite=None, quiet=None):
+        Count("r.in.bin")
+        values = np.array(self, dtype=np.float64)
+        if null is not None:
+            values[values == null] = np.nan
+        StoreMap(mapname, values, 'CELL' if np.issubdtype(self.dtype, np.integer) else 'FCELL' if self.dtype == np.float32 else 'DCELL')
+        return 0
+
+
+################################################################################
+# grass.pygrass.raster
+
+def Buffer(shape, mtype='FCELL'):
+    """pygrass Buffer: the row array of the map type."""
+    return np.zeros(shape, dtype=MTYPES[mtype])
+
+
+class RasterRow(object):
+    """pygrass RasterRow reading the stored map by rows (CELL nulls as
+    CELL_NULL, FCELL and DCELL nulls as NaN) or writing the new one."""
+
+    def __init__(self, name):
+        self.name = name.split('@')[0]
+        self.mode = None
+        self.mtype = None
+
+    def open(self, mode='r', mtype=None, overwrite=False):
+        self.mode = mode
+        if mode == 'r':
+            self.values, self.mtype = MapValues(self.name)
+        else:
+            if self.name in MAPS and not overwrite:
+                raise ScriptError("Raster map <" + self.name + "> exists.")
+            self.mtype = mtype or 'FCELL'
+            self.rows = []
+
+    def get_row(self, row):
+        values = self.values[row]
+        if self.mtype == 'CELL':
+            return np.where(np.isnan(values), CELL_NULL, values).astype(np.int32)
+        return values.astype(MTYPES[self.mtype])
+
+    def put_row(self, row):
+        row = np.array(row, dtype=np.float64)
+        if self.mtype == 'CELL':
+            row[row == CELL_NULL] = np.nan
+        self.rows.append(row)
+
+    def close(self):
+        if self.mode == 'w':
+            StoreMap(self.name, np.array(self.rows).reshape(-1, REGION['cols']), self.mtype)
+        self.mode = None
+
+
+################################################################################
+
+def Install(directory=None):
+    """Puts the stand-in modules grass, grass.script (also as
+    grass.script.core), grass.script.array, grass.pygrass.raster and
+    grass.pygrass.raster.buffer into sys.modules, with empty maps, vectors
+    and command counts. The files standing for the maps are created in the
+    directory (temporary directory by default)."""
+    MAPS.clear()
+    VECTORS.clear()
+    COMMANDS.clear()
+    STATE['directory'] = directory or tempfile.mkdtemp(prefix="fakegrass_")
+    this = sys.modules[__name__]
+    modules = dict([(name, types.ModuleType(name)) for name in ("grass", "grass.script", "grass.script.array", "grass.pygrass",
+                                                                  "grass.pygrass.raster", "grass.pygrass.raster.buffer")])
+    for name in ("region", "gisenv", "message", "verbose", "debug", "percent", "warning", "fatal", "append_node_pid", "use_temp_region",
+                 "del_temp_region", "find_file", "run_command", "read_command", "write_command", "vector_db_select", "mapcalc", "ScriptError"):
+        setattr(modules["grass.script"], name, getattr(this, name))
+    modules["grass.script"].core = modules["grass.script"]
+    modules["grass.script"].parser = None
+    modules["grass.script.array"].array = array
+    modules["grass.pygrass.raster"].RasterRow = RasterRow
+    modules["grass.pygrass.raster.buffer"].Buffer = Buffer
+    modules["grass"].script = modules["grass.script"]
+    modules["grass"].pygrass = modules["grass.pygrass"]
+    modules["grass.script"].array = modules["grass.script.array"]
+    modules["grass.pygrass"].raster = modules["grass.pygrass.raster"]
+    modules["grass.pygrass.raster"].buffer = modules["grass.pygrass.raster.buffer"]
+    sys.modules.update(modules)
+    return STATE['directory']
+
+
+def ScriptDefaults(filename):
+    """Returns the options (dict of the #% answer: of every #% key:, empty
+    string without answer) and flags (dict of False) of the header of the
+    GRASS script, as grass.script.parser gives them with nothing set."""
+    options = {}
+    flags = {}
+    block = None
+    key = None
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line.lower().startswith("#%option") or line.lower().startswith("#%flag"):
+                block = line[2:].lower().split()[0]
+                key = None
+            elif line.lower() == "#%end":
+                block = None
+            elif block and line.startswith("#% key:"):
+                key = line.split(":", 1)[1].strip()
+                if block == "option":
+                    options[key] = ""
+                else:
+                    flags[key] = False
+            elif block == "option" and key and line.startswith("#% answer:"):
+                options[key] = line.split(":", 1)[1].strip()
+    return options, flags
+
+
+def LoadScript(filename, options=None, flags=None):
+    """Returns the script (path of the .py file, e.g. i.grid.correl.atcor.py)
+    loaded as module named after the file (dots replaced), with the options
+    and flags dicts set as by grass.script.parser: the defaults of the script
+    header (see ScriptDefaults) updated by the options and flags given.
+    Install() has to be called first, so the script imports the stand-in
+    modules."""
+    name = os.path.basename(filename)[:-3].replace(".", "_")
+    directory = os.path.dirname(os.path.abspath(filename))
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        module = imp.load_source(name, filename)
+    else:
+        spec = importlib.util.spec_from_file_location(name, filename)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    module.options, module.flags = ScriptDefaults(filename)
+    module.options.update(options or {})
+    module.flags.update(flags or {})
+    return module
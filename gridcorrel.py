@@ -0,0 +1,1011 @@
+#!/usr/bin/env python
+################################################################################
+"""
+MODULE:       gridcorrel.py
+
+AUTHOR(S):    Tomas Brunclik, brunclik(at)atlas.cz
+
+PURPOSE:      Array computations for i.grid.correl.atcor.py. The functions here
+              work on numpy arrays only and do not call any GRASS commands, so
+              the per tile statistics and regressions can be computed for all
+              the grid tiles at once instead of calling r.univar,
+              r.regression.line and r.covar for every tile.
+              It also holds the mask filters used by r.buff.cloudmask.py,
+              i.atcor.mask.py and L2A_gdal_atcor.py, the memory-mapped
+              reference index array made by i.atcor.refindex.py and the
+              reading of the rows of the maps shared by the GRASS scripts
+              (the open pygrass RasterRow is passed in, only RasterStamp
+              imports grass.script, when called).
+              The module has to be stored in the same directory as the
+              i.grid.correl.atcor.py and r.buff.cloudmask.py scripts.
+"""
+################################################################################
+
+# __future__ makes python3 syntax work in python2 (version 2.7+)
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import os
+
+import numpy as np
+
+
+# Null value of the CELL rows read by pygrass
+CELL_NULL = -2147483648
+
+# Order of the per tile moments (rows of the moments array)
+MOMENTS = ('n', 'sx', 'sy', 'sxx', 'syy', 'sxy')
+
+# Bits of the pseudo-invariant mask made by i.atcor.mask.py (set where the
+# pixel passes the rule), the pixels with all the bits set are used
+MASKBITS = (('scl', 1), ('ndmidiff', 2), ('ndmi', 4), ('cloud', 8), ('cloudbuffer', 16), ('refcloud', 32))
+MASK_ALL = 63
+
+# Format identifier stored in the correction model files (see SaveModel)
+MODEL_FORMAT = "i.grid.correl.atcor model 1"
+
+# Format identifier in the keys of the reference index arrays (see IndexKey),
+# the arrays of the older formats are never used
+INDEX_FORMAT = "refindex 3"
+
+# Robust regression methods (see RobustFit) and the tuning constants of
+# their weight functions (95 % efficiency at normally distributed residuals)
+ROBUST_METHODS = {'huber': 1.345, 'tukey': 4.685}
+
+# Scaled integer output types (see EncodeReflectance): numpy type, lowest
+# and highest valid value and the no-data value
+SCALED_TYPES = {'UInt16': (np.uint16, 1, 65535, 0), 'Int16': (np.int16, -32767, 32767, -32768)}
+
+
+def GridShape(rows, cols, nsres, ewres, size):
+    """Returns number of grid rows and cols for grid tiles of approximate size
+    in map units (the same rounding as used for v.mkgrid in MkGrid)."""
+    grid_rows = max(int(round(rows * nsres / size)), 1)
+    grid_cols = max(int(round(cols * ewres / size)), 1)
+    return grid_rows, grid_cols
+
+
+def TileIndex(rows, cols, grid_rows, grid_cols, row_start=0, row_end=None):
+    """Returns 2D array of grid tile numbers (tile_row * grid_cols + tile_col,
+    counted from the top left tile) for the region pixels in rows
+    row_start:row_end. The tile a pixel belongs to is decided by the position
+    of the pixel center, the same way as when the region is set to a tile
+    of the v.mkgrid grid."""
+    if row_end is None:
+        row_end = rows
+    # floor((i + 0.5) * grid_rows / rows) in integer arithmetic
+    tile_row = ((2 * np.arange(row_start, row_end) + 1) * grid_rows) // (2 * rows)
+    tile_col = ((2 * np.arange(cols) + 1) * grid_cols) // (2 * cols)
+    return tile_row[:, np.newaxis] * grid_cols + tile_col[np.newaxis, :]
+
+
+def TileMoments(tiles, x, y, ntiles, moments=None, weights=None):
+    """Computes sums n, Sum(x), Sum(y), Sum(x^2), Sum(y^2), Sum(x*y) of valid
+    pixels per tile in one pass. tiles, x, y are arrays of the same shape
+    containing only the valid pixels (tile numbers and values). If the
+    moments array (shape (6, ntiles)) is given, the sums are added to it,
+    which allows to accumulate the moments over several blocks of rows.
+    With the weights of the pixels given, the sums are weighted (n is the
+    sum of the weights), the regressions computed from them are the
+    weighted ones."""
+    if moments is None:
+        moments = np.zeros((len(MOMENTS), ntiles))
+    tiles = np.asarray(tiles).reshape(-1)
+    x = np.asarray(x, dtype=np.float64).reshape(-1)
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    if weights is None:
+        moments[0] += np.bincount(tiles, minlength=ntiles)
+        wx, wy = x, y
+    else:
+        weights = np.asarray(weights, dtype=np.float64).reshape(-1)
+        moments[0] += np.bincount(tiles, weights=weights, minlength=ntiles)
+        wx, wy = weights * x, weights * y
+    moments[1] += np.bincount(tiles, weights=wx, minlength=ntiles)
+    moments[2] += np.bincount(tiles, weights=wy, minlength=ntiles)
+    moments[3] += np.bincount(tiles, weights=wx * x, minlength=ntiles)
+    moments[4] += np.bincount(tiles, weights=wy * y, minlength=ntiles)
+    moments[5] += np.bincount(tiles, weights=wx * y, minlength=ntiles)
+    return moments
+
+
+def CentralMoments(moments):
+    """Returns n, mean x, mean y and the centered sums of squares and products
+    Sxx, Syy, Sxy computed from the raw moments."""
+    n, sx, sy, sxx, syy, sxy = moments
+    with np.errstate(divide='ignore', invalid='ignore'):
+        meanx = sx / n
+        meany = sy / n
+        cxx = sxx - sx * meanx
+        cyy = syy - sy * meany
+        cxy = sxy - sx * meany
+    return n, meanx, meany, cxx, cyy, cxy
+
+
+def Correlation(moments):
+    """Returns the correlation coefficient R per tile (nan if undefined)."""
+    n, meanx, meany, cxx, cyy, cxy = CentralMoments(moments)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = cxy / np.sqrt(cxx * cyy)
+    r[~np.isfinite(r)] = np.nan
+    return r
+
+
+def LeastSquares(moments):
+    """Ordinary least squares regression 'y = a + b * x' per tile from the
+    moments. Returns arrays a, b (the same as r.regression.line would give)."""
+    n, meanx, meany, cxx, cyy, cxy = CentralMoments(moments)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b = cxy / cxx
+        a = meany - b * meanx
+    return a, b
+
+
+def Orthogonal(moments):
+    """Orthogonal regression 'y = a + b * x' per tile from the moments.
+    Returns arrays a, b (the same formula as used with r.covar output)."""
+    n, meanx, meany, cxx, cyy, cxy = CentralMoments(moments)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b = (cyy - cxx + np.sqrt((cyy - cxx)**2 + 4 * cxy**2)) / (2 * cxy)
+        a = meany - b * meanx
+    return a, b
+
+
+def FitMoments(moments, method):
+    """Returns a, b of the regression computed from the moments with the
+    method least_sq or orthogonal."""
+    if method == "least_sq":
+        return LeastSquares(moments)
+    elif method == "orthogonal":
+        return Orthogonal(moments)
+    raise ValueError("Regression method " + method + " can not be computed from tile moments.")
+
+
+def AdaptiveMinr(rvalues, counts, minpixels, minr, floor, target):
+    """Returns the highest R threshold between floor and minr accepting at
+    least target tiles (tiles with more than minpixels valid pixels counts
+    and R >= threshold), so minr if it accepts target tiles already, floor
+    if even the floor accepts fewer tiles. Only the R of the tiles already
+    computed are re-thresholded, no regression is run again."""
+    candidates = np.sort(rvalues[(counts > minpixels) & (rvalues >= floor)])[::-1]
+    if target < 1 or candidates.size < target:
+        return floor
+    return max(min(minr, candidates[target - 1]), floor)
+
+
+def GroupByTile(tiles, ntiles):
+    """Returns the order in which the pixels are sorted by tile and the start
+    offsets of the tiles in it (tile i pixels are order[start[i]:start[i+1]])."""
+    tiles = np.asarray(tiles).reshape(-1)
+    order = np.argsort(tiles, kind='stable')
+    start = np.concatenate(([0], np.cumsum(np.bincount(tiles, minlength=ntiles))))
+    return order, start
+
+
+def TileMedians(tiles, values, ntiles):
+    """Returns the median of the (finite) values per tile (NaN for the tiles
+    without any value), for all the tiles at once. The values are scaled
+    into [0, 1) and added to the tile numbers, so single sort of the sums
+    orders them by tile and value (much faster than np.lexsort), the
+    medians are exact up to about 1e-12 of the values range."""
+    tiles = np.asarray(tiles).reshape(-1)
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    medians = np.full(ntiles, np.nan)
+    if values.size == 0:
+        return medians
+    low = values.min()
+    span = (values.max() - low) * (1 + 1e-9) or 1.0
+    keys = np.sort(tiles + (values - low) / span)
+    counts = np.bincount(tiles, minlength=ntiles)
+    first = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    has = counts > 0
+    middle = keys[first[has] + (counts[has] - 1) // 2] + keys[first[has] + counts[has] // 2]
+    medians[has] = (0.5 * middle - np.flatnonzero(has)) * span + low
+    return medians
+
+
+def RobustFit(tiles, x, y, ntiles, method, iterations=10, tolerance=1e-6):
+    """Robust orthogonal regression 'y = a + b * x' of all the tiles at once
+    by iteratively reweighted least squares. Starting from the orthogonal
+    regression, the orthogonal residuals of the pixels are scaled by the
+    per tile MAD (median absolute deviation) and the weighted sums of the
+    tiles are recomputed with the weights of the method: huber (weights
+    decreasing beyond the tuning constant) or tukey (biweight, zero weight
+    of the residuals beyond the constant, so the changed pixels are
+    dropped; started by three huber iterations). The scale is updated in
+    the first three iterations and kept then. Every iteration is few
+    grouped sums over the pixels (see TileMoments), the iterations stop
+    when no a, b changes more than tolerance. tiles, x, y are arrays of the
+    valid pixels as for TileMoments. Returns arrays a, b (NaN for the tiles
+    without pixels)."""
+    tiles = np.asarray(tiles).reshape(-1)
+    x = np.asarray(x, dtype=np.float64).reshape(-1)
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    a, b = Orthogonal(TileMoments(tiles, x, y, ntiles))
+    for iteration in range(iterations):
+        pa = a[tiles]
+        pb = b[tiles]
+        with np.errstate(invalid='ignore'):
+            residuals = np.abs(y - pa - pb * x) / np.sqrt(1 + pb * pb)
+        if iteration < 3:
+            # scale of the residuals (MAD of normal distribution), not zero for the exact fits
+            fitted = np.isfinite(residuals)
+            scale = 1.4826 * TileMedians(tiles[fitted], residuals[fitted], ntiles)
+            scale = np.maximum(scale, 1e-12 * (1 + np.abs(np.nan_to_num(a))))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = residuals / scale[tiles]
+        if method == "huber" or iteration < 3:
+            c = ROBUST_METHODS['huber']
+            with np.errstate(divide='ignore'):
+                weights = np.where(u <= c, 1.0, c / u)
+        elif method == "tukey":
+            c = ROBUST_METHODS['tukey']
+            weights = np.where(u < c, (1 - (u / c) ** 2) ** 2, 0.0)
+        else:
+            raise ValueError("Unknown robust regression method: " + str(method))
+        # the pixels of the tiles without fit
+        weights[~np.isfinite(u)] = 0.0
+        newa, newb = Orthogonal(TileMoments(tiles, x, y, ntiles, weights=weights))
+        with np.errstate(invalid='ignore'):
+            change = np.nanmax(np.abs(np.concatenate((newa - a, newb - b)))) if np.isfinite(newb).any() else 0.0
+        a, b = newa, newb
+        if change <= tolerance and (method == "huber" or iteration >= 3):
+            break
+    return a, b
+
+
+def StrictInversions(values, pairs=False):
+    """Counts pairs of positions i < j with values[j] < values[i] in the
+    1D array values. The pairs are counted by bottom up merging of sorted
+    blocks (searchsorted of the right block values in the left blocks for
+    all the blocks at once), so it takes O(n log^2 n) time and O(n) memory.
+    If pairs is True, also the positions i, j of all such pairs are returned
+    (the caller is responsible to keep their number reasonable)."""
+    values = np.asarray(values).reshape(-1)
+    n = values.size
+    # Dense integer ranks of the values (equal values get equal rank)
+    uniq, rank = np.unique(values, return_inverse=True)
+    rank = rank.reshape(-1).astype(np.int64)
+    m = np.int64(uniq.size + 1)
+    count = 0
+    ilist = []
+    jlist = []
+    # Positions sorted by (block, rank), blocks of size 1 to start with
+    cur = np.arange(n, dtype=np.int64)
+    size = 1
+    while size < n:
+        left = cur[(cur // size) % 2 == 0]
+        right = cur[(cur // size) % 2 == 1]
+        leftkeys = (left // (2 * size)) * m + rank[left]
+        rightpair = (right // (2 * size)) * m
+        # Left block elements of the same pair with greater rank are counted
+        first = np.searchsorted(leftkeys, rightpair + rank[right], side='right')
+        # All the left blocks before the last one are full
+        last = np.minimum((right // (2 * size) + 1) * size, left.size)
+        num = last - first
+        count += int(num.sum())
+        if pairs and num.sum() > 0:
+            ilist.append(left[np.repeat(last, num) - RangeLengths(num) - 1])
+            jlist.append(np.repeat(right, num))
+        # Merge the blocks
+        cur = cur[np.argsort((cur // (2 * size)) * m + rank[cur], kind='stable')]
+        size = size * 2
+    if pairs:
+        if ilist:
+            return count, np.concatenate(ilist), np.concatenate(jlist)
+        return count, np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return count
+
+
+def RangeLengths(num):
+    """Returns concatenated ranges 0..num[k]-1 (counted down from the end)
+    of all items of num, used to expand the searchsorted ranges."""
+    num = np.asarray(num, dtype=np.int64)
+    total = int(num.sum())
+    if total == 0:
+        return np.array([], dtype=np.int64)
+    ends = np.cumsum(num)
+    return np.arange(total, dtype=np.int64) - np.repeat(ends - num, num)
+
+
+def SlopesBelow(x, y, t, strict=False):
+    """Number of pairwise slopes (pairs with different x only) less than or
+    equal to t (strictly less than t if strict is True). x must be sorted."""
+    z = y - t * x
+    if strict:
+        # Pairs with x[i] < x[j] and z[j] < z[i], equal x pairs are ordered
+        # by z so that they are never counted
+        order = np.lexsort((z, x))
+        return StrictInversions(z[order])
+    # Number of slopes greater than t is subtracted from number of all slopes
+    order = np.lexsort((-z, x))
+    return PairsCount(x) - StrictInversions(-z[order])
+
+
+def PairsCount(x):
+    """Number of pairs with different x values."""
+    n = x.size
+    counts = np.unique(x, return_counts=True)[1].astype(np.int64)
+    return n * (n - 1) // 2 - int((counts * (counts - 1) // 2).sum())
+
+
+def SlopesBetween(x, y, tlo, thi):
+    """Returns all pairwise slopes tlo < slope < thi (pairs with different
+    x only). The pairs are those changing their order between sorting by
+    y - tlo * x and by y - thi * x."""
+    zlo = y - tlo * x
+    zhi = y - thi * x
+    order = np.lexsort((zhi, zlo))
+    count, i, j = StrictInversions(zhi[order], pairs=True)
+    i = order[i]
+    j = order[j]
+    dx = x[j] - x[i]
+    keep = dx != 0
+    slopes = (y[j][keep] - y[i][keep]) / dx[keep]
+    return slopes[(slopes > tlo) & (slopes < thi)]
+
+
+def TheilSen(x, y, seed=0, tolerance=1e-9):
+    """Theil-Sen regression 'y = a + b * x'. Returns a, b. The slope b is the
+    median of the slopes of all pairs of points with different x, the
+    intercept a = median(y) - b * median(x) (the same as 
+    scipy.stats.theilslopes gives). The median slope is found without
+    building all n^2/2 slopes: random samples of the slopes narrow the
+    interval containing the median, slopes are counted in it by counting
+    inversions (O(n log^2 n)) and when there are only few slopes left in the
+    interval (up to 8 * n), these are listed and the median taken from them.
+    If the median slope value is shared by too many pairs to be listed
+    (common with quantized data), the result is exact up to the relative
+    tolerance. Memory used is linear in n."""
+    x = np.asarray(x, dtype=np.float64).reshape(-1)
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    n = x.size
+    order = np.argsort(x, kind='stable')
+    # Centered values make the rounding errors of y - t * x smaller
+    xmedian = np.median(x)
+    ymedian = np.median(y)
+    x = x[order] - xmedian
+    y = y[order] - ymedian
+    total = PairsCount(x)
+    if total == 0:
+        return np.nan, np.nan
+    # Ranks of the two middle slopes (the same if the number of slopes is odd)
+    k1 = (total - 1) // 2
+    k2 = total // 2
+    maxlisted = max(8 * n, 10000)
+    if total <= maxlisted:
+        i, j = np.triu_indices(n, 1)
+        dx = x[j] - x[i]
+        keep = dx != 0
+        slopes = (y[j][keep] - y[i][keep]) / dx[keep]
+        b = 0.5 * (np.partition(slopes, k1)[k1] + np.partition(slopes, k2)[k2])
+        return ymedian - b * xmedian, b
+    rng = np.random.RandomState(seed)
+    # The interval (tlo, thi) contains the middle slopes, below is number of
+    # slopes <= tlo, inside number of slopes in the interval
+    tlo = -np.inf
+    thi = np.inf
+    below = 0
+    inside = total
+    while inside > maxlisted:
+        # Random slopes in the interval
+        i = rng.randint(0, n, 4 * n)
+        j = rng.randint(0, n, 4 * n)
+        dx = x[j] - x[i]
+        keep = dx != 0
+        sample = (y[j][keep] - y[i][keep]) / dx[keep]
+        sample = np.sort(sample[(sample > tlo) & (sample < thi)])
+        newlo = tlo
+        newhi = thi
+        if sample.size > 0 and sample[-1] - sample[0] <= tolerance * max(1.0, abs(sample[0])):
+            # All the sampled slopes are equal (within the tolerance), check if
+            # the middle slopes are equal to the value too
+            value = sample[sample.size // 2]
+            delta = tolerance * max(1.0, abs(value))
+            if SlopesBelow(x, y, value - delta) <= k1 and SlopesBelow(x, y, value + delta, strict=True) > k2:
+                return ymedian - value * xmedian, value
+        elif sample.size >= 30:
+            # Sample quantiles around the middle slopes with margin of 3 sigma.
+            # The bounds are moved by the tolerance away from the sampled
+            # values, as slopes equal to the bounds could be counted on the
+            # wrong side due to rounding of y - t * x.
+            margin = 3.0 / np.sqrt(sample.size)
+            qlo = (k1 - below) / inside - margin
+            qhi = (k2 - below) / inside + margin
+            if qlo > 0:
+                value = sample[int(qlo * sample.size)]
+                newlo = value - tolerance * max(1.0, abs(value))
+            if qhi < 1:
+                value = sample[min(int(qhi * sample.size), sample.size - 1)]
+                newhi = value + tolerance * max(1.0, abs(value))
+        # Keep the new bounds only if the middle slopes are still inside
+        if newlo > tlo:
+            newbelow = SlopesBelow(x, y, newlo)
+            if newbelow <= k1:
+                tlo = newlo
+                below = newbelow
+        if newhi < thi:
+            if SlopesBelow(x, y, newhi, strict=True) > k2:
+                thi = newhi
+        newinside = (SlopesBelow(x, y, thi, strict=True) if np.isfinite(thi) else total) - below
+        if newinside == inside:
+            # No progress with the sample, split the interval in half instead
+            if np.isfinite(tlo) and np.isfinite(thi):
+                if thi - tlo <= tolerance * max(1.0, abs(tlo), abs(thi)):
+                    value = 0.5 * (tlo + thi)
+                    return ymedian - value * xmedian, value
+                t = 0.5 * (tlo + thi)
+            elif sample.size > 0:
+                t = sample[sample.size // 2]
+            else:
+                continue
+            tbelow = SlopesBelow(x, y, t)
+            if tbelow <= k1:
+                tlo = t
+                below = tbelow
+            elif SlopesBelow(x, y, t, strict=True) > k2:
+                thi = t
+            else:
+                # Both middle slopes are equal to t
+                return ymedian - t * xmedian, t
+            newinside = (SlopesBelow(x, y, thi, strict=True) if np.isfinite(thi) else total) - below
+        inside = newinside
+    slopes = SlopesBetween(x, y, tlo, thi)
+    b = 0.5 * (np.partition(slopes, k1 - below)[k1 - below] + np.partition(slopes, k2 - below)[k2 - below])
+    return ymedian - b * xmedian, b
+
+
+def TileRanges(n, ngrid):
+    """Returns arrays of first and last+1 pixel of each of the ngrid tiles
+    along one axis of n pixels (pixels assigned to the tiles by position of
+    their center, as in TileIndex)."""
+    tile = ((2 * np.arange(n) + 1) * ngrid) // (2 * n)
+    first = np.searchsorted(tile, np.arange(ngrid), side='left')
+    last = np.searchsorted(tile, np.arange(ngrid), side='right')
+    return first, last
+
+
+def PixelPriorities(row_start, row_end, cols, seed):
+    """Returns 2D array of pseudo-random numbers in [0, 1) for the pixels in
+    rows row_start:row_end, computed from the position of the pixel in the
+    region and the seed only (splitmix64 hash of the pixel number), so the
+    same pixel gets the same number whatever blocks of rows are read."""
+    z = (np.arange(row_start, row_end, dtype=np.uint64)[:, np.newaxis] * np.uint64(cols)
+         + np.arange(cols, dtype=np.uint64)[np.newaxis, :])
+    z += np.uint64((seed * 0x9E3779B97F4A7C15) % 2**64)
+    z ^= z >> np.uint64(30)
+    z *= np.uint64(0xBF58476D1CE4E5B9)
+    z ^= z >> np.uint64(27)
+    z *= np.uint64(0x94D049BB133111EB)
+    z ^= z >> np.uint64(31)
+    return (z >> np.uint64(11)).astype(np.float64) / 2.0**53
+
+
+def SampleTiles(valid, rows, cols, grid_rows, grid_cols, sample, seed, row_start=0):
+    """Returns boolean array of the pixels of the valid array (2D, rows
+    row_start:row_start+valid.shape[0] of the region, whole grid tiles)
+    selected as the stratified sample of at most sample valid pixels per
+    tile. Every tile is split into about sample strata (square grid of
+    cells), the valid pixels get the seeded priorities of PixelPriorities
+    and the pixels are taken by rounds: the first pixel (lowest priority)
+    of every stratum, then the second ones, ... (lowest priority first
+    within the round), until sample pixels are taken. Only the candidate
+    pixels of priority below the threshold giving about four times the
+    sample per tile are ordered (all the pixels of the tiles where the
+    candidates would not make the sample), so the cost does not grow with
+    the resolution much. The sample is spread over the whole tile,
+    deterministic for the seed and independent of the blocks of rows."""
+    row_end = row_start + valid.shape[0]
+    tile_row = ((2 * np.arange(row_start, row_end) + 1) * grid_rows) // (2 * rows)
+    tile_col = ((2 * np.arange(cols) + 1) * grid_cols) // (2 * cols)
+    ntiles = grid_rows * grid_cols
+    tiles = tile_row[:, np.newaxis] * grid_cols + tile_col[np.newaxis, :]
+    priorities = PixelPriorities(row_start, row_end, cols, seed)
+    # candidates: the pixels of priority below the threshold of the tile
+    counts = np.bincount(tiles[valid], minlength=ntiles)
+    with np.errstate(divide='ignore'):
+        threshold = np.minimum(4.0 * sample / counts, 1.0)
+    candidates = valid & (priorities < threshold[tiles])
+    short = np.bincount(tiles[candidates], minlength=ntiles) < np.minimum(counts, sample)
+    if short.any():
+        candidates |= valid & short[tiles]
+    rowindex, colindex = np.nonzero(candidates)
+    selected = np.zeros(valid.shape, dtype=bool)
+    if rowindex.size == 0:
+        return selected
+    tiles = tiles[rowindex, colindex]
+    priorities = priorities[rowindex, colindex]
+    # strata cells of the tiles (the same number along both axes)
+    row_first, row_last = TileRanges(rows, grid_rows)
+    col_first, col_last = TileRanges(cols, grid_cols)
+    nstrata = int(np.ceil(np.sqrt(sample)))
+    rowindex = rowindex + row_start
+    tile_row = tile_row[rowindex - row_start]
+    tile_col = tile_col[colindex]
+    strata = ((tiles * nstrata + ((rowindex - row_first[tile_row]) * nstrata) // (row_last[tile_row] - row_first[tile_row])) * nstrata
+              + ((colindex - col_first[tile_col]) * nstrata) // (col_last[tile_col] - col_first[tile_col]))
+    # order of the pixels in their stratum (by priority, one sort of the stratum+priority keys)
+    order = np.argsort(strata + priorities, kind='stable')
+    first = np.concatenate(([0], np.cumsum(np.bincount(strata))[:-1]))
+    ranks = np.empty(order.size, dtype=np.int64)
+    ranks[order] = np.arange(order.size) - first[strata[order]]
+    # pixels of the tiles by rounds (rank first, then priority), the first sample pixels of every tile taken
+    order = np.argsort(tiles + (ranks + priorities) / (ranks.max() + 1.0), kind='stable')
+    first = np.concatenate(([0], np.cumsum(np.bincount(tiles))[:-1]))
+    taken = order[(np.arange(order.size) - first[tiles[order]]) < sample]
+    selected[rowindex[taken] - row_start, colindex[taken]] = True
+    return selected
+
+
+def TileRowBlocks(rows, grid_rows, maxrows):
+    """Returns list of (row_start, row_end) blocks of the region rows made of
+    whole grid tile rows (see TileRanges), so every tile lies in one block
+    only. The blocks are at most maxrows rows long, except of single tile
+    rows longer than that."""
+    first, last = TileRanges(rows, grid_rows)
+    blocks = []
+    start = 0
+    for tile_row in range(grid_rows):
+        if last[tile_row] - start > maxrows and first[tile_row] > start:
+            blocks.append((start, int(first[tile_row])))
+            start = int(first[tile_row])
+    blocks.append((start, rows))
+    return blocks
+
+
+def MemoryRows(memory, cols, arrays):
+    """Returns number of rows (at least 1) of the arrays (number of float64
+    arrays of cols columns held at once) fitting in memory (MB)."""
+    return max(int(memory * 1024 * 1024 // (cols * 8 * arrays)), 1)
+
+
+def FillGaps(values):
+    """Returns copy of the 2D (or stacked 3D, first axis being the layers)
+    array of the grid tile values with the NaN tiles filled by the mean of
+    the valid neighbouring tiles (8-neighbourhood), repeated until all the
+    tiles are filled. Raises ValueError if there is no valid tile."""
+    values = np.array(values, dtype=np.float64)
+    if np.isnan(values).all():
+        raise ValueError("No valid tile to interpolate from")
+    while np.isnan(values).any():
+        valid = ~np.isnan(values)
+        padded = np.pad(np.where(valid, values, 0.0), [(0, 0)] * (values.ndim - 2) + [(1, 1), (1, 1)], mode='constant')
+        count = np.pad(valid.astype(np.float64), [(0, 0)] * (values.ndim - 2) + [(1, 1), (1, 1)], mode='constant')
+        total = np.zeros(values.shape)
+        num = np.zeros(values.shape)
+        rows, cols = values.shape[-2:]
+        for dr in (0, 1, 2):
+            for dc in (0, 1, 2):
+                total += padded[..., dr:dr + rows, dc:dc + cols]
+                num += count[..., dr:dr + rows, dc:dc + cols]
+        fill = ~valid & (num > 0)
+        values[fill] = total[fill] / num[fill]
+    return values
+
+
+def AxisWeights(n, ngrid, method):
+    """Returns arrays of grid tile indices and weights (both of shape (n, 2)
+    for the bilinear, (n, 4) for the bicubic method) to interpolate values
+    given in the tile centers to the n pixels along one axis. The tile
+    centers are the centers of the pixel ranges of TileRanges, beyond the
+    outer tile centers the values are extended as constant. The bicubic
+    method is the cubic convolution (Catmull-Rom spline)."""
+    first, last = TileRanges(n, ngrid)
+    centers = (first + last) / 2.0
+    # position of the pixel centers in the tile indices units
+    pos = np.interp(np.arange(n) + 0.5, centers, np.arange(ngrid, dtype=np.float64))
+    base = np.floor(pos).astype(int)
+    t = pos - base
+    if method == "bilinear":
+        offsets = np.arange(0, 2)
+        weights = np.column_stack((1 - t, t))
+    elif method == "bicubic":
+        offsets = np.arange(-1, 3)
+        weights = np.column_stack((((-0.5 * t + 1.0) * t - 0.5) * t,
+                                   (1.5 * t - 2.5) * t * t + 1.0,
+                                   ((-1.5 * t + 2.0) * t + 0.5) * t,
+                                   (0.5 * t - 0.5) * t * t))
+    else:
+        raise ValueError("Unknown interpolation method: " + str(method))
+    indices = np.clip(base[:, np.newaxis] + offsets[np.newaxis, :], 0, ngrid - 1)
+    return indices, weights
+
+
+def InterpolateGrid(values, rowweights, colweights, row_start=0, row_end=None):
+    """Interpolates the (gap free, see FillGaps) grid tile values (2D array,
+    or 3D array of stacked layers interpolated at once) to the region pixels
+    in rows row_start:row_end. rowweights and colweights are the (indices,
+    weights) returned by AxisWeights for the region rows and cols."""
+    rowidx, rowwts = rowweights
+    colidx, colwts = colweights
+    if row_end is None:
+        row_end = rowidx.shape[0]
+    rowidx = rowidx[row_start:row_end]
+    rowwts = rowwts[row_start:row_end]
+    # along the columns of the grid first (small), then along the rows of the region
+    cols = np.einsum('...gck,ck->...gc', values[..., colidx], colwts)
+    return np.einsum('...rkc,rk->...rc', cols[..., rowidx, :], rowwts)
+
+
+def EncodeReflectance(values, datatype, quantification, boaoffset):
+    """Returns the reflectance values encoded as the L2A products do, i.e.
+    values * quantification - boaoffset rounded and clipped to the valid range
+    of the datatype (a key of SCALED_TYPES), NaN set to its no-data value.
+    The reflectance is then read back by the scale 1 / quantification and the
+    offset boaoffset / quantification (as L2A_vrt-img.sh sets them)."""
+    dtype, low, high, nodata = SCALED_TYPES[datatype]
+    encoded = np.rint(values * quantification - boaoffset)
+    np.clip(encoded, low, high, out=encoded)
+    encoded[np.isnan(values)] = nodata
+    return encoded.astype(dtype)
+
+
+def RowWindowSums(values, halfwidths):
+    """Returns list of sums of the 2D array values over the horizontal
+    windows of 2 * halfwidth + 1 pixels centered on every pixel (zero 
+    padded) for each of the halfwidths (from single cumulative sum)."""
+    rows, cols = values.shape
+    maxwidth = max(halfwidths)
+    padded = np.zeros((rows, cols + 2 * maxwidth + 1), dtype=np.int32)
+    padded[:, maxwidth + 1:maxwidth + 1 + cols] = values
+    sums = np.cumsum(padded, axis=1, out=padded)
+    return [sums[:, maxwidth + halfwidth + 1:maxwidth + halfwidth + 1 + cols] - sums[:, maxwidth - halfwidth:maxwidth - halfwidth + cols]
+            for halfwidth in halfwidths]
+
+
+def AddShifted(result, values, shift):
+    """Adds (or ORs for boolean arrays) the 2D array values shifted by shift 
+    rows (row i of values to row i - shift of result) to result in place."""
+    rows = values.shape[0]
+    if abs(shift) >= rows:
+        return
+    target = result[max(-shift, 0):rows - max(shift, 0)]
+    source = values[max(shift, 0):rows - max(-shift, 0)]
+    if result.dtype == bool:
+        target |= source
+    else:
+        target += source
+
+
+def CircleMode(mask, size):
+    """Returns the mode (most frequent value) of the binary mask (0 and 
+    non-zero values, nulls as NaN) in the circular neighbourhood of size 
+    (odd number) pixels around every pixel, the same as r.neighbors -c 
+    method=mode. The result is 0 or 1, NaN where there is no valid pixel in
+    the neighbourhood. The equal counts give 0 (the smaller value). The
+    pixels outside the array are taken as nulls."""
+    radius = size // 2
+    valid = ~np.isnan(mask)
+    halfwidths = [int(np.sqrt(radius * radius - dy * dy)) for dy in range(-radius, radius + 1)]
+    nones = np.zeros(mask.shape, dtype=np.int32)
+    nvalid = np.zeros(mask.shape, dtype=np.int32)
+    for counts, values in ((nones, valid & (np.nan_to_num(mask) != 0)), (nvalid, valid)):
+        sums = RowWindowSums(values, sorted(set(halfwidths)))
+        bywidth = dict(zip(sorted(set(halfwidths)), sums))
+        for dy, halfwidth in zip(range(-radius, radius + 1), halfwidths):
+            AddShifted(counts, bywidth[halfwidth], dy)
+        del sums, bywidth
+    result = (2 * nones > nvalid).astype(np.float64)
+    result[nvalid == 0] = np.nan
+    return result
+
+
+def BoxMean(values, size):
+    """Returns the mean of the valid (not NaN) values of the 2D array in the
+    square neighbourhood of size (odd number) pixels around every pixel, the
+    same as r.neighbors method=average (NaN where there is no valid value).
+    The pixels outside the array are taken as nulls."""
+    radius = size // 2
+    valid = ~np.isnan(values)
+    sums = np.zeros(values.shape)
+    counts = np.zeros(values.shape)
+    padded = np.zeros((values.shape[0], values.shape[1] + size))
+    for total, layer in ((sums, np.where(valid, values, 0.0)), (counts, valid.astype(np.float64))):
+        padded[:, radius + 1:radius + 1 + values.shape[1]] = layer
+        cumulative = np.cumsum(padded, axis=1)
+        rowsums = cumulative[:, size:] - cumulative[:, :values.shape[1]]
+        for dy in range(-radius, radius + 1):
+            AddShifted(total, rowsums, dy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def RowDistances(source):
+    """Returns the horizontal distance (in pixels) of every pixel of the 2D
+    boolean array to the nearest source pixel in the same row (the number of
+    cols if there is none)."""
+    rows, cols = source.shape
+    index = np.arange(cols)[np.newaxis, :]
+    left = np.maximum.accumulate(np.where(source, index, -2 * cols), axis=1)
+    right = np.minimum.accumulate(np.where(source, index, 3 * cols)[:, ::-1], axis=1)[:, ::-1]
+    return np.minimum(np.minimum(index - left, right - index), cols)
+
+
+def BufferMask(source, distance, nsres, ewres):
+    """Returns boolean array of the pixels with center within distance (map
+    units, inclusive) from the center of any source pixel (2D boolean array),
+    the same area as r.buffer creates. The horizontal distances to the 
+    source pixels are computed in every row first, then the rows within the
+    distance are combined, so the cost does not depend on the number of the
+    source pixels or their edges. The pixels outside the array are not
+    taken as sources."""
+    rowdist = RowDistances(source)
+    radius = int(distance // nsres + 1e-9)
+    result = np.zeros(source.shape, dtype=bool)
+    for dy in range(0, radius + 1):
+        # max horizontal distance in pixels at dy rows from the source
+        halfwidth = int(np.sqrt(max(distance * distance - (dy * nsres) ** 2, 0.0)) / ewres + 1e-9)
+        within = rowdist <= halfwidth
+        AddShifted(result, within, dy)
+        if dy > 0:
+            AddShifted(result, within, -dy)
+    return result
+
+
+def MaskBits(inputs, offset, count, maxndmidiff, maxndmi, buffsize, circlesize, nsres, ewres):
+    """Returns the bit-packed mask of count rows starting at the row offset of
+    the dict of input arrays of the block (the block is read with overlap
+    rows above and below the rows to compute where available). The smoothed
+    reference NDMI is taken from refndmismooth if present. Used by
+    i.atcor.mask.py and L2A_gdal_atcor.py."""
+    bits = dict(MASKBITS)
+    rows = slice(offset, offset + count)
+    mask = np.zeros((count, inputs['scl'].shape[1]), dtype=np.int32)
+    # null inputs fail the rules (comparisons with NaN are False)
+    mask[inputs['scl'][rows] == inputs['refscl'][rows]] |= bits['scl']
+    # NDMI smoothed by 3x3 average to mitigate image noise, to get true PIFs as areas as opposed to scattered pixels
+    refsmooth = inputs['refndmismooth'] if 'refndmismooth' in inputs else BoxMean(inputs['refndmi'], 3)
+    ndmidiff = BoxMean(inputs['ndmi'], 3)[rows] - refsmooth[rows]
+    mask[(ndmidiff > -maxndmidiff) & (ndmidiff < maxndmidiff)] |= bits['ndmidiff']
+    mask[(inputs['ndmi'][rows] < maxndmi) & (inputs['refndmi'][rows] < maxndmi)] |= bits['ndmi']
+    mask[inputs['cloud'][rows] > 0] |= bits['cloud']
+    # despeckled and buffered clouds (the same as r.buff.cloudmask.py)
+    cleared = CircleMode(inputs['cloud'], circlesize)
+    mask[~BufferMask(cleared == 0, buffsize, nsres, ewres)[rows]] |= bits['cloudbuffer']
+    if 'refcloud' in inputs:
+        mask[inputs['refcloud'][rows] > 0] |= bits['refcloud']
+    else:
+        mask |= bits['refcloud']
+    return mask
+
+
+def RowExtents(valid):
+    """Returns arrays of the first and last+1 column of the valid pixels in
+    every row of the 2D boolean array (-1 for the rows without valid pixel)."""
+    cols = valid.shape[1]
+    anyvalid = valid.any(axis=1)
+    first = np.where(anyvalid, np.argmax(valid, axis=1), -1)
+    last = np.where(anyvalid, cols - np.argmax(valid[:, ::-1], axis=1), -1)
+    return first, last
+
+
+def ConvexHull(points):
+    """Returns the vertices of the convex hull of the points (array of shape
+    (n, 2)) in counter-clockwise order (monotone chain algorithm)."""
+    points = np.unique(np.asarray(points, dtype=np.float64), axis=0)
+    if len(points) <= 2:
+        return points
+
+    def half(sequence):
+        chain = []
+        for point in sequence:
+            while len(chain) >= 2 and ((chain[-1][0] - chain[-2][0]) * (point[1] - chain[-2][1])
+                                       - (chain[-1][1] - chain[-2][1]) * (point[0] - chain[-2][0])) <= 0:
+                chain.pop()
+            chain.append(point)
+        return chain
+
+    lower = half(points)
+    upper = half(points[::-1])
+    return np.array(lower[:-1] + upper[:-1])
+
+
+def HullSpans(first, last, cols):
+    """Returns arrays of the first and last+1 column of the pixels with center
+    inside the convex hull of the valid pixels (as polygons, i.e. of their
+    corners) for every row, given the first and last+1 column of the valid
+    pixels of the rows (see RowExtents). The rows without any pixel inside
+    have first == last. This is the raster equivalent of r.to.vect, v.hull
+    and v.to.rast of the valid pixels."""
+    rows = first.size
+    rowsvalid = np.flatnonzero(first >= 0)
+    start = np.zeros(rows, dtype=int)
+    end = np.zeros(rows, dtype=int)
+    if rowsvalid.size == 0:
+        return start, end
+    # corners of the first and last valid pixels of the rows (x = col, y = row)
+    points = np.concatenate([np.column_stack((first[rowsvalid], rowsvalid)), np.column_stack((first[rowsvalid], rowsvalid + 1)),
+                             np.column_stack((last[rowsvalid], rowsvalid)), np.column_stack((last[rowsvalid], rowsvalid + 1))])
+    hull = ConvexHull(points)
+    x0, y0 = hull[:, 0], hull[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    # intersections of the pixel center lines with the hull edges (not horizontal)
+    edges = y0 != y1
+    x0, y0, x1, y1 = x0[edges], y0[edges], x1[edges], y1[edges]
+    y = np.arange(rows)[:, np.newaxis] + 0.5
+    t = (y - y0) / (y1 - y0)
+    x = np.where((t >= 0) & (t <= 1), x0 + t * (x1 - x0), np.nan)
+    inside = ~np.isnan(x).all(axis=1)
+    with np.errstate(invalid='ignore'):
+        xmin = np.nanmin(np.where(inside[:, np.newaxis], x, 0.0), axis=1)
+        xmax = np.nanmax(np.where(inside[:, np.newaxis], x, 0.0), axis=1)
+    start[inside] = np.clip(np.ceil(xmin[inside] - 0.5), 0, cols)
+    end[inside] = np.clip(np.floor(xmax[inside] - 0.5) + 1, 0, cols)
+    end = np.maximum(end, start)
+    return start, end
+
+
+def CacheKey(parts):
+    """Returns hash (hex string) identifying the tile statistics computed from
+    the inputs described by the list of strings parts (map names, mask set,
+    region and grid geometry, map modification times, ...)."""
+    return hashlib.sha1("\n".join([str(p) for p in parts]).encode("utf-8")).hexdigest()
+
+
+def SaveMoments(filename, key, moments):
+    """Saves the per tile moments array together with its cache key into the
+    .npz sidecar file filename. The file is written under a temporary name
+    and renamed, so concurrent runs never read a partially written file."""
+    tmpname = filename + "." + str(os.getpid()) + ".tmp"
+    with open(tmpname, "wb") as f:
+        np.savez(f, key=np.array(key), moments=moments)
+    os.rename(tmpname, filename)
+
+
+def LoadMoments(filename, key, ntiles):
+    """Returns the per tile moments saved by SaveMoments in the filename, or
+    None if the file does not exist, is not readable or its key or the
+    number of tiles do not match."""
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with np.load(filename) as data:
+            if str(data["key"]) != key:
+                return None
+            moments = data["moments"]
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    if moments.shape != (len(MOMENTS), ntiles):
+        return None
+    return moments
+
+
+def IndexKey(stamp, kind):
+    """Returns key of the reference index array of the raster described by
+    stamp (full name and modification time) and kind of the values
+    ('boxmean3' for the 3x3 mean), see CacheKey. The region is not in the
+    key, the array covers the whole map and its region is stored with it
+    (see SaveIndexArray, IndexWindow)."""
+    return CacheKey([INDEX_FORMAT, stamp, kind])
+
+
+def IndexFile(directory, key):
+    """Returns the file name of the reference index array with the key."""
+    return os.path.join(directory, "refindex_" + key + ".npy")
+
+
+def SaveIndexArray(filename, region, blocks, dtype=np.float64):
+    """Writes the (rows, cols) array of the region (dict n, s, e, w, rows,
+    cols, nsres, ewres) of the reference index into the .npy file filename
+    from the iterable of (start row, 2D array) blocks, so the whole raster
+    never has to be held in memory. The region is written into the .region
+    file next to it. The dtype must hold the values exactly, so the index
+    gives the same results as the maps. Like SaveMoments, the array is
+    written under a temporary name and renamed (after the region file)."""
+    rows = int(region['rows'])
+    cols = int(region['cols'])
+    with open(filename[:-4] + ".region", "w") as f:
+        f.write("".join([name + "=" + repr(float(region[name])) + "\n" for name in ("n", "s", "e", "w", "rows", "cols")]))
+    tmpname = filename + "." + str(os.getpid()) + ".tmp"
+    values = np.lib.format.open_memmap(tmpname, mode="w+", dtype=dtype, shape=(rows, cols))
+    for start, block in blocks:
+        values[start:start + block.shape[0]] = block
+    values.flush()
+    del values
+    os.rename(tmpname, filename)
+
+
+def LoadIndexArray(filename):
+    """Returns the array saved by SaveIndexArray memory-mapped read only (the
+    rows are read from the disk only when used) and the dict of its region
+    (n, s, e, w, rows, cols), or None if the files do not exist, are not
+    readable or do not match."""
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with open(filename[:-4] + ".region") as f:
+            region = dict([line.strip().split("=", 1) for line in f if line.strip()])
+        region = dict([(name, float(region[name])) for name in ("n", "s", "e", "w", "rows", "cols")])
+        values = np.load(filename, mmap_mode="r")
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    if values.shape != (int(region['rows']), int(region['cols'])):
+        return None
+    return values, region
+
+
+def IndexWindow(indexregion, region, tolerance=1e-3):
+    """Returns (row offset, col offset, rows, cols) of the region (dict n, s,
+    e, w, rows, cols) within the index array of the indexregion (see
+    LoadIndexArray), or None if the region is not aligned to the cells of
+    the index (other resolution or the edges not on the cell boundaries).
+    The region may reach outside of the index (see IndexRows)."""
+    offsets = []
+    for first, last, count, indexfirst, indexlast, indexcount in ((region['n'], region['s'], region['rows'], indexregion['n'], indexregion['s'], indexregion['rows']),
+                                                                  (region['w'], region['e'], region['cols'], indexregion['w'], indexregion['e'], indexregion['cols'])):
+        res = (float(last) - float(first)) / int(count)
+        indexres = (float(indexlast) - float(indexfirst)) / int(indexcount)
+        offset = (float(first) - float(indexfirst)) / indexres
+        # tolerance in the fractions of the cell
+        if abs(res - indexres) * int(count) > tolerance * abs(indexres) or abs(offset - round(offset)) > tolerance:
+            return None
+        offsets.append(int(round(offset)))
+    return offsets[0], offsets[1], int(region['rows']), int(region['cols'])
+
+
+def IndexRows(values, start, end, window):
+    """Returns the rows start:end of the region window (see IndexWindow) of
+    the memory-mapped index array as float64 array (the same as ReadRows
+    gives for the raster), NaN outside of the index."""
+    row_offset, col_offset, rows, cols = window
+    result = np.full((end - start, cols), np.nan)
+    first = min(max(start + row_offset, 0), values.shape[0])
+    last = min(max(end + row_offset, 0), values.shape[0])
+    col_first = min(max(col_offset, 0), values.shape[1])
+    col_last = min(max(col_offset + cols, 0), values.shape[1])
+    result[first - start - row_offset:last - start - row_offset, col_first - col_offset:col_last - col_offset] = values[first:last, col_first:col_last]
+    return result
+
+
+def RowValues(raster, row):
+    """Returns the row of the open pygrass RasterRow as float64 array with
+    the nulls set to NaN."""
+    values = np.array(raster.get_row(row), dtype=np.float64)
+    if raster.mtype == 'CELL':
+        values[values == CELL_NULL] = np.nan
+    return values
+
+
+def ReadRows(raster, start, end):
+    """Returns the rows start:end of the open pygrass RasterRow as 2D
+    float64 array with the nulls set to NaN. Reading the maps by blocks of
+    rows keeps the memory used independent of the region size."""
+    values = None
+    for row in range(start, end):
+        rowvalues = RowValues(raster, row)
+        if values is None:
+            values = np.empty((end - start, rowvalues.size))
+        values[row - start] = rowvalues
+    return values
+
+
+def RasterStamp(name):
+    """Returns string with full name and modification time of the raster
+    (inside GRASS session only), for the keys of the caches and indexes."""
+    import grass.script as grass
+    found = grass.find_file(name, element="cell")
+    if not found['file']:
+        grass.fatal("Raster map <" + name + "> not found.")
+    return found['fullname'] + " " + repr(os.path.getmtime(found['file']))
+
+
+def SaveModel(filename, fields):
+    """Saves the correction model (dict of the arrays and values, i.e. the a,
+    b grid of the bands, per tile R and n, the region, grid and regression
+    settings, see SaveModel of i.grid.correl.atcor.py) together with the
+    MODEL_FORMAT into the .npz file filename. The file is written under a
+    temporary name and renamed, as in SaveMoments."""
+    tmpname = filename + "." + str(os.getpid()) + ".tmp"
+    arrays = dict([(name, np.asarray(value)) for name, value in fields.items()])
+    with open(tmpname, "wb") as f:
+        np.savez(f, format=np.array(MODEL_FORMAT), **arrays)
+    os.rename(tmpname, filename)
+
+
+def LoadModel(filename):
+    """Returns dict of the model saved by SaveModel, the single values as
+    python scalars. Raises ValueError if the file is not a model file."""
+    with np.load(filename) as data:
+        if "format" not in data.files or str(data["format"]) != MODEL_FORMAT:
+            raise ValueError(filename + " is not a correction model file")
+        return dict([(name, data[name].item() if data[name].ndim == 0 else data[name]) for name in data.files])
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+#
+##############################################################################
+#
+# MODULE:       i.atcor.mask.py
+#
+# AUTHOR(S):    Tomas Brunclik, brunclik(at)atlas.cz
+#
+# PURPOSE:      Script to build the pseudo-invariant pixels mask for
+#               i.grid.correl.atcor.py from Sentinel-2 L2A scene
+#               classification (SCL), NDMI and cloud mask of the input and
+#               reference images in single pass. It replaces the SCL and NDMI
+#               difference masks and r.buff.cloudmask.py steps of the
+#               L2A_grass_atcor.sh script.
+#               The output is single bit-packed raster, each bit set where
+#               the pixel passes one of the rules:
+#                1 - the SCL class is the same in input and reference
+#                2 - the smoothed NDMI difference is below maxndmidiff
+#                4 - the NDMI of input and reference is below maxndmi
+#                8 - not cloud in the input cloud mask
+#               16 - not within buffsize from (despeckled) input clouds
+#               32 - not cloud in the reference cloud mask (if given)
+#               The pseudo-invariant pixels have value 63 (all the bits).
+#               The mask is used by the pimask parameter of the
+#               i.grid.correl.atcor.py.
+#
+# DATE:         2023
+#
+##############################################################################
+
+#%module
+#% description: Builds bit-packed pseudo-invariant pixels mask from SCL, NDMI and cloud masks in single pass.
+#%end
+#%Option
+#% key: scl
+#% type: string
+#% required: yes
+#% multiple: no
+#% description: Scene classification (SCL) of the input image.
+#% gisprompt: old,cell,raster
+#%End
+#%Option
+#% key: refscl
+#% type: string
+#% required: yes
+#% multiple: no
+#% description: Scene classification (SCL) of the reference image.
+#% gisprompt: old,cell,raster
+#%End
+#%Option
+#% key: ndmi
+#% type: string
+#% required: yes
+#% multiple: no
+#% description: NDMI of the input image.
+#% gisprompt: old,cell,raster
+#%End
+#%Option
+#% key: refndmi
+#% type: string
+#% required: yes
+#% multiple: no
+#% description: NDMI of the reference image.
+#% gisprompt: old,cell,raster
+#%End
+#%Option
+#% key: cloud
+#% type: string
+#% required: yes
+#% multiple: no
+#% description: Cloud mask of the input image (0 - cloud, 1 - clear).
+#% gisprompt: old,cell,raster
+#%End
+#%Option
+#% key: refcloud
+#% type: string
+#% required: no
+#% multiple: no
+#% description: Cloud mask of the reference image (0 - cloud or snow, 1 - clear). Leave empty for clear reference image.
+#% gisprompt: old,cell,raster
+#%End
+#%Option G_OPT_R_OUTPUT
+#% key: output
+#% type: string
+#% required: yes
+#% multiple: no
+#% description: Name of output bit-packed mask raster.
+#% gisprompt: new,cell,raster
+#%End
+#%Option
+#% key: maxndmidiff
+#% type: double
+#% required: no
+#% multiple: no
+#% description: Max difference of the smoothed (3x3 average) NDMI of input and reference.
+#% answer: 0.1
+#%End
+#%Option
+#% key: maxndmi
+#% type: double
+#% required: no
+#% multiple: no
+#% description: Max NDMI of input and reference (1.0 effectively disables the rule).
+#% answer: 0.15
+#%End
+#%Option
+#% key: buffsize
+#% type: double
+#% required: no
+#% multiple: no
+#% description: Cloud buffer size in meters.
+#% answer: 300
+#%End
+#%Option
+#% key: circlesize
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Size of moving window circular area to filter out few pixel-sized clouds and holes before buffering. The value must be an odd number >= 3.
+#% answer: 9
+#%End
+#%Option
+#% key: memory
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Maximum memory (MB) for the blocks of rows processed at once.
+#% answer: 1024
+#%End
+#%Option
+#% key: refindex
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% description: Directory of the reference index made by i.atcor.refindex.py. The smoothed refndmi found there is memory-mapped instead of computed from the map.
+#% gisprompt: old,dir,dir
+#%End
+
+
+import sys
+import atexit
+
+import numpy as np
+from grass.script import parser, region, message, warning, fatal
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+import gridcorrel
+
+def cleanup():
+    pass
+
+def IndexArrays(directory, region_dict):
+    """Returns dict of the memory-mapped reference index arrays (the 3x3 mean
+    of refndmi as refndmismooth) found in the directory for the current
+    maps, with the window of the current region in them (see
+    gridcorrel.IndexWindow). A warning is given if the array is found, but
+    the region is not aligned to it."""
+    arrays = {}
+    found = gridcorrel.LoadIndexArray(gridcorrel.IndexFile(directory, gridcorrel.IndexKey(gridcorrel.RasterStamp(options['refndmi']), "boxmean3")))
+    if found is not None:
+        values, indexregion = found
+        window = gridcorrel.IndexWindow(indexregion, region_dict)
+        if window is None:
+            warning("The region is not aligned to the cells of " + options['refndmi'] + ", the reference index is not used.")
+        else:
+            arrays['refndmismooth'] = (values, window)
+    return arrays
+
+def main():
+    maxndmidiff = float(options['maxndmidiff'])
+    maxndmi = float(options['maxndmi'])
+    buffsize = float(options['buffsize'])
+    circlesize = int(options['circlesize'])
+    if circlesize < 3 or circlesize % 2 == 0:
+        fatal("circlesize must be an odd number >= 3, got " + options['circlesize'] + ".")
+    region_dict = region()
+    rows = int(region_dict['rows'])
+    cols = int(region_dict['cols'])
+    nsres = float(region_dict['nsres'])
+    ewres = float(region_dict['ewres'])
+    names = ['scl', 'refscl', 'ndmi', 'refndmi', 'cloud']
+    if options['refcloud']:
+        names.append('refcloud')
+    # overlap of the blocks: the cloud filter radius plus the buffer radius in rows
+    halo = circlesize // 2 + int(buffsize // nsres) + 1
+    # the inputs and about 14 arrays of the block size are held at once
+    blockrows = max(gridcorrel.MemoryRows(int(options['memory']), cols, len(names) + 14) - 2 * halo, 1)
+    # smoothed reference NDMI memory-mapped from the index instead of computing it
+    indexed = IndexArrays(options['refindex'], region_dict) if options['refindex'] else {}
+    if indexed:
+        message("Using reference index: " + ", ".join(sorted(indexed)))
+    maps = {}
+    for name in names:
+        maps[name] = RasterRow(options[name])
+        maps[name].open('r')
+    out = RasterRow(options['output'])
+    out.open('w', mtype = 'CELL', overwrite = True)
+    outrow = Buffer((cols,), mtype = 'CELL')
+    try:
+        for start in range(0, rows, blockrows):
+            end = min(start + blockrows, rows)
+            first = max(start - halo, 0)
+            last = min(end + halo, rows)
+            inputs = dict([(name, gridcorrel.ReadRows(maps[name], first, last)) for name in maps])
+            for name in indexed:
+                inputs[name] = gridcorrel.IndexRows(indexed[name][0], first, last, indexed[name][1])
+            mask = gridcorrel.MaskBits(inputs, start - first, end - start, maxndmidiff, maxndmi, buffsize, circlesize, nsres, ewres)
+            for row in range(end - start):
+                outrow[:] = mask[row]
+                out.put_row(outrow)
+    finally:
+        for name in maps:
+            maps[name].close()
+        out.close()
+    message("Mask " + options['output'] + " created (pseudo-invariant pixels have value " + str(gridcorrel.MASK_ALL) + ").")
+    return 0
+
+if __name__ == "__main__":
+    options, flags = parser()
+    atexit.register(cleanup)
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+##############################################################################
+#
+# MODULE:       i.atcor.refindex.py
+#
+# AUTHOR(S):    Tomas Brunclik, brunclik(at)atlas.cz
+#
+# PURPOSE:      Script to store the 3x3 smoothed NDMI of the reference image
+#               (as used by i.atcor.mask.py) as memory-mappable array (numpy
+#               .npy file) of the whole map, by default in the atcor_refindex
+#               directory of the PERMANENT mapset, next to the reference
+#               maps. The reference does not change across the scenes
+#               normalized to it, so i.atcor.mask.py (refindex parameter)
+#               then memory-maps the array instead of smoothing the
+#               reference NDMI in every run. Only the smoothed NDMI is
+#               stored: a copy of the reference bands and SCL would only
+#               duplicate the maps (their rows are read in every run anyway)
+#               and the per tile reference sums can not be reused, as the
+#               pixels used in the tiles depend on the mask of each scene.
+#               The file is named by the key built from the full name and
+#               modification time of the map, so the array of a changed map
+#               is never used. The array covers the region of the map and
+#               the region is stored with it, so any region aligned to the
+#               map cells can use it. An array already stored is skipped, so
+#               it is cheap to run the script before every normalization
+#               (as L2A_grass_atcor.sh does).
+#               The MASK must not be active, the index has to hold all the
+#               pixels.
+#
+# DATE:         2023
+#
+##############################################################################
+
+#%module
+#% description: Stores the smoothed reference NDMI as memory-mappable array for i.atcor.mask.py.
+#%end
+#%Option
+#% key: refndmi
+#% type: string
+#% required: yes
+#% multiple: no
+#% description: NDMI of the reference image (stored smoothed by 3x3 average).
+#% gisprompt: old,cell,raster
+#%End
+#%Option
+#% key: output
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% description: Directory to store the index in. Default: atcor_refindex directory of the PERMANENT mapset.
+#% gisprompt: old,dir,dir
+#%End
+#%Option
+#% key: memory
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Maximum memory (MB) for the blocks of rows processed at once.
+#% answer: 1024
+#%End
+
+
+import sys
+import os
+import atexit
+
+import numpy as np
+import grass.script as grass
+from grass.pygrass.raster import RasterRow
+
+import gridcorrel
+
+def cleanup():
+    pass
+
+def IndexBlocks(raster, rows, blockrows):
+    """Yields (start row, values) blocks of the raster smoothed by 3x3
+    average (read with one row overlap)."""
+    for start in range(0, rows, blockrows):
+        end = min(start + blockrows, rows)
+        first = max(start - 1, 0)
+        last = min(end + 1, rows)
+        yield start, gridcorrel.BoxMean(gridcorrel.ReadRows(raster, first, last), 3)[start - first:start - first + end - start]
+        grass.percent(end, rows, 1)
+
+def main():
+    directory = options['output']
+    if not directory:
+        env = grass.gisenv()
+        directory = os.path.join(env['GISDBASE'], env['LOCATION_NAME'], "PERMANENT", "atcor_refindex")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if grass.find_file("MASK", element = "cell", mapset = ".")['file']:
+        grass.fatal("MASK is active, the reference index has to hold all the pixels. Remove the MASK (r.mask -r) first.")
+    name = options['refndmi']
+    filename = gridcorrel.IndexFile(directory, gridcorrel.IndexKey(gridcorrel.RasterStamp(name), "boxmean3"))
+    if gridcorrel.LoadIndexArray(filename) is not None:
+        grass.message("Index of " + name + " is up to date.")
+        return 0
+    # the index covers the whole map, in its own region
+    grass.use_temp_region()
+    grass.run_command("g.region", raster = name, quiet = True)
+    region_dict = grass.region()
+    rows = int(region_dict['rows'])
+    cols = int(region_dict['cols'])
+    # the block, its smoothed copy and the temporary arrays of BoxMean
+    blockrows = max(gridcorrel.MemoryRows(int(options['memory']), cols, 8) - 2, 1)
+    grass.message("Indexing " + name + " (3x3 mean)...")
+    raster = RasterRow(name)
+    raster.open('r')
+    try:
+        # the smoothed values are kept in float64, as computed by i.atcor.mask.py without the index
+        gridcorrel.SaveIndexArray(filename, region_dict, IndexBlocks(raster, rows, blockrows), np.float64)
+    finally:
+        raster.close()
+    grass.message("Reference index stored in " + directory)
+    return 0
+
+if __name__ == "__main__":
+    options, flags = grass.parser()
+    atexit.register(cleanup)
+    sys.exit(main())
@@ -35,8 +35,11 @@ PURPOSE:      Script to atmospherically correct an image based on corrella-
               The raster maps for the MASK creation should contain pixels 
               with null/0 value for areas to remove (change-pixels), and 
               values 1-255 in areas to keep (no-change pixels).
-              Any existing MASK in the mapset will be ignored
-              and overwritten by the script, make backup!
+              Any existing MASK in the mapset is left untouched (and 
+              respected). The script does not use the MASK nor changes the 
+              region itself and all its temporary maps have run-unique 
+              names, so more instances of the script can run at once in 
+              the same mapset.
               The script also incorporates the input and reference layers to 
               create the MASK to ensure, that only overlapping regions 
               of the corrected and reference images are processed. The user 
@@ -67,24 +70,24 @@ VERSION:      0.95b
 #% key: input
 #% type: string
 #% required: yes
-#% multiple: no
-#% description: Select the band to be corrected.
+#% multiple: yes
+#% description: Select the band(s) or imagery group to be corrected.
 #% gisprompt: old,cell,raster
 #%End
 #%Option
 #% key: reference
 #% type: string
-#% required: yes
-#% multiple: no
-#% description: Select the reference band.
+#% required: no
+#% multiple: yes
+#% description: Select the reference band(s) or imagery group. Required unless the model is given.
 #% gisprompt: old,cell,raster
 #%End
 #%Option G_OPT_R_OUTPUT
 #% key: output
 #% type: string
-#% required: yes
-#% multiple: no
-#% description: Select name of output corrected band.
+#% required: no
+#% multiple: yes
+#% description: Select name of output corrected band(s). Single name for more input bands is used as the output imagery group name. Required unless more grid sizes are given.
 #% gisprompt: new,cell,raster
 #%End
 #%Option
@@ -97,11 +100,20 @@ VERSION:      0.95b
 #% gisprompt: old,cell,raster
 #%End
 #%Option
+#% key: pimask
+#% type: string
+#% required: no
+#% multiple: no
+#% description: Bit-packed pseudo-invariant pixels mask created by i.atcor.mask.py (used with the masks, if any).
+#% guisection: Advanced
+#% gisprompt: old,cell,raster
+#%End
+#%Option
 #% key: gridsize
 #% type: integer
 #% required: no
-#% multiple: no
-#% description: Approx. grid tile size in map units (6000 in m means box 6x6 km).
+#% multiple: yes
+#% description: Approx. grid tile size in map units (6000 in m means box 6x6 km). More sizes (e.g. 4000,5000,6000) only report the accepted tiles count and mean R of every size, no output is created.
 #% guisection: Advanced
 #% answer: 6000
 #%End
@@ -124,24 +136,151 @@ VERSION:      0.95b
 #% answer: 0.9
 #%End
 #%Option
+#% key: minrfloor
+#% type: double
+#% required: no
+#% multiple: no
+#% description: Lowest minimal correlation coefficient R of the adaptive mode (array engine). If fewer than mintiles tiles pass minr, the highest R threshold down to minrfloor accepting mintiles tiles is used instead (chosen from the R of the tiles computed already, without another pass over the bands).
+#% guisection: Advanced
+#%End
+#%Option
+#% key: mintiles
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Target number of accepted tiles of the adaptive mode (see minrfloor).
+#% guisection: Advanced
+#% answer: 1
+#%End
+#%Option
+#% key: sample
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Maximum number of valid pixels per tile the R and regression are computed from (array engine): stratified sample spread over the tile, deterministic for the seed. Must be greater than pixels.
+#% guisection: Advanced
+#%End
+#%Option
+#% key: seed
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Seed of the pixel sample (see sample).
+#% guisection: Advanced
+#% answer: 0
+#%End
+#%Option
 #% key: regression
 #% type: string
 #% required: no
-#% options: theil_sen,orthogonal,least_sq
+#% options: theil_sen,orthogonal,least_sq,huber,tukey
 #% multiple: no
-#% description: Regression method: theil_sen - TheilSen regression, orthogonal - orthogonal regression, least_sq - ordinary least squares.
+#% description: Regression method: theil_sen - TheilSen regression, orthogonal - orthogonal regression, least_sq - ordinary least squares, huber, tukey - robust orthogonal regression with Huber or Tukey biweight weights, all tiles at once (array engine).
 #% guisection: Advanced
 #% answer: orthogonal
 #%End
 #%Option
+#% key: engine
+#% type: string
+#% required: no
+#% options: tiles,array
+#% multiple: no
+#% description: Computation of tile statistics: tiles - GRASS commands run in every grid tile, array - all tiles at once in single pass over the bands read into memory.
+#% guisection: Advanced
+#% answer: tiles
+#%End
+#%Option
+#% key: nprocs
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Number of processes to compute the grid tiles regression in parallel.
+#% guisection: Advanced
+#% answer: 1
+#%End
+#%Option
+#% key: cache
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% description: Directory to store the grid tile statistics in (array engine). Later runs with the same bands, masks, region and grid reuse them and only redo the thresholding and fitting.
+#% gisprompt: old,dir,dir
+#% guisection: Advanced
+#%End
+#%Option
 #% key: interpolation
 #% type: string
 #% required: no
 #% options: bilinear,bicubic
 #% multiple: no
-#% description: Select correction parameteres interpolation method (v.surf.bspline).
+#% description: Interpolation method of the correction parameters (v.surf.bspline method with interpolator=bspline, in-process interpolation of the grid of tiles with interpolator=grid and model). Default: bicubic, with model the interpolation the model was saved with.
+#% guisection: Advanced
+#%End
+#%Option
+#% key: interpolator
+#% type: string
+#% required: no
+#% options: bspline,grid
+#% multiple: no
+#% description: Interpolation of correction parameters: bspline - v.surf.bspline on the tile center points, grid - in-process interpolation of the regular grid of tiles (the missing tiles filled from the neighbouring ones).
+#% guisection: Advanced
+#% answer: bspline
+#%End
+#%Option
+#% key: blockrows
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Number of raster rows interpolated and corrected at once (interpolator=grid), limits the memory used.
+#% guisection: Advanced
+#% answer: 512
+#%End
+#%Option
+#% key: memory
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Maximum memory (MB) for the blocks of rows read at once by the array engine, the grid size sweep and interpolator=grid.
 #% guisection: Advanced
-#% answer: bicubic
+#% answer: 1024
+#%End
+#%Option
+#% key: savemodel
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% description: File to save the fitted correction model in (a, b grid, grid geometry, regression method and thresholds, per tile R and n), to correct other bands of the same extent by the model parameter later (e.g. 10 m bands by the model fitted at 20 m).
+#% gisprompt: new,file,file
+#% guisection: Model
+#%End
+#%Option
+#% key: model
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% description: Correction model file saved by savemodel. The input bands are corrected by the model without any regression (the reference, masks and regression parameters are not used, the interpolator is grid).
+#% gisprompt: old,file,file
+#% guisection: Model
+#%End
+#%Option
+#% key: modelbands
+#% type: integer
+#% required: no
+#% multiple: yes
+#% description: Numbers of the model bands (1 for the first band of the fit) to correct the input bands by, one per input band. Default: the bands in the order of the fit.
+#% guisection: Model
+#%End
+#%Option
+#% key: report
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% description: JSON file to write the run report to: time of the processing stages and of the grid tiles (blocks of rows for the array engine), numbers of GRASS commands launched and peak memory.
+#% gisprompt: new,file,file
 #%End
 #%Option
 #% key: lambda_i
@@ -160,6 +299,10 @@ VERSION:      0.95b
 #% key: v
 #% description: Verbose processing information.
 #%End
+#%Flag
+#% key: r
+#% description: Resume: reuse the tiles and bands finished by an interrupted run with the same inputs and parameters (recorded in the journal in the current mapset).
+#%End
 
 
 # __future__ makes python3 syntax work in python2 (version 2.7+)
@@ -170,15 +313,120 @@ import sys
 import os
 import atexit
 import math
+import multiprocessing
+import contextlib
+import itertools
+import json
+import time
 
-from scipy import stats
 import numpy as np
 import grass.script as grass
 import grass.script.array as garray
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+import gridcorrel
+
+
+# Run report (report parameter), see Stage, CountCommands and WriteReport
+REPORT = {'script': "i.grid.correl.atcor.py", 'status': "failed", 'started': time.time(), 'stages': [], 'tiles': [], 'blocks': [], 'commands': {}}
+
+
+# Journal of the finished tiles, blocks of rows and bands (see OpenJournal)
+JOURNAL = {'filename': None, 'handle': None}
 
 
 def cleanup():
-    pass
+    if JOURNAL['handle']:
+        JOURNAL['handle'].close()
+
+
+@contextlib.contextmanager
+def Stage(name):
+    """Context of the processing stage name timed for the run report."""
+    started = time.time()
+    try:
+        yield
+    finally:
+        REPORT['stages'].append({'stage': name, 'seconds': time.time() - started})
+
+
+def CountCommands():
+    """Makes all the GRASS commands started by grass.script (run_command,
+    read_command, mapcalc, ...) counted per module in the run report."""
+    start_command = grass.core.start_command
+    def Counted(prog, *args, **kwargs):
+        REPORT['commands'][prog] = REPORT['commands'].get(prog, 0) + 1
+        return start_command(prog, *args, **kwargs)
+    grass.core.start_command = Counted
+
+
+def AddCounts(commands):
+    """Adds the counts of the GRASS commands launched by a worker process."""
+    for prog, count in commands.items():
+        REPORT['commands'][prog] = REPORT['commands'].get(prog, 0) + count
+
+
+def PeakMemory():
+    """Returns dict of the peak resident memory (MB) of the script and of the
+    largest of the GRASS modules and worker processes it ran, None where
+    not available (the resource module is Unix only)."""
+    try:
+        import resource
+    except ImportError:
+        return {'script': None, 'children': None}
+    # ru_maxrss is in kB, except of OS X (bytes)
+    unit = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+    return {'script': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit}
+
+
+def WriteReport(filename):
+    """Writes the run report as JSON into filename (registered by atexit, so
+    the report is written with status failed if the script ends with an 
+    error)."""
+    REPORT['seconds'] = time.time() - REPORT['started']
+    REPORT['peak_memory_mb'] = PeakMemory()
+    REPORT['commands_total'] = sum(REPORT['commands'].values())
+    tmpname = filename + "." + str(os.getpid()) + ".tmp"
+    with open(tmpname, "w") as f:
+        # numpy numbers as python ones
+        json.dump(REPORT, f, indent = 1, sort_keys = True, default = lambda value: value.item() if hasattr(value, 'item') else str(value))
+    os.rename(tmpname, filename)
+
+
+def BandList(names):
+    """Expands the comma separated list of raster maps and/or imagery groups
+    (i.group) into list of raster maps."""
+    bands = []
+    for name in names.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        if grass.find_file(name, element = "group")['name']:
+            bands.extend(grass.read_command("i.group", group = name, flags = 'g', quiet = True).split())
+        else:
+            bands.append(name)
+    return bands
+
+
+def CoefColumns(nbands):
+    """Returns list of names of the grid attribute columns (a, b) to store the
+    regression parameters of each band."""
+    if nbands == 1:
+        return [("a", "b")]
+    return [("a" + str(k + 1), "b" + str(k + 1)) for k in range(nbands)]
+
+
+def DiagColumns(nbands):
+    """Returns list of names of the grid attribute columns (r, reject) to store
+    the correlation coefficient R and the reason the tile was rejected 
+    ('pixels' - too few valid pixels, 'r' - low correlation, empty for the 
+    accepted tiles) of each band. The number of valid pixels is stored in 
+    the column n common for all the bands."""
+    if nbands == 1:
+        return [("r", "reject")]
+    return [("r" + str(k + 1), "reject" + str(k + 1)) for k in range(nbands)]
 
 
 def MkGrid(name, size):
@@ -186,8 +434,7 @@ def MkGrid(name, size):
     user (aligned to existing region size)"""
     grass.message("*** Creating the grid: ***")
     region_dict = grass.region()
-    grid_rows = int( round( int( region_dict['rows'] ) * float( region_dict['nsres'] ) / size ) )
-    grid_cols = int( round( int( region_dict['cols'] ) * float( region_dict['ewres'] ) / size ) )
+    grid_rows, grid_cols = gridcorrel.GridShape(int(region_dict['rows']), int(region_dict['cols']), float(region_dict['nsres']), float(region_dict['ewres']), size)
     # grid tile width
     grid_width_px = int( round( int( region_dict['cols'] ) / grid_cols ) ) + 1
     # grid tile height
@@ -195,83 +442,80 @@ def MkGrid(name, size):
     grass.message("Grid size: " + str(grid_rows) + " rows, " + str(grid_cols) + " cols.")
     grass.message("Actual grid tile size (W x H): " + str( float( region_dict['ewres'] ) * grid_width_px ) + " x " + str( float( region_dict['nsres'] ) * grid_height_px ) + " map units. (" + str( grid_width_px ) + " x " +  str( grid_height_px ) + " px)" )
     grass.run_command("v.mkgrid", overwrite = True, map = name, position = "region", grid = [grid_rows,grid_cols], quiet = True)
+    return grid_rows, grid_cols
     
     
-def MkMask(masks, inpmap, refmap):
-    """Makes a temporary tmpmask to mask out changing pixels between the dates. 
-    The user supplies the layers to include in the MASK. The areas to keep 
-    should have values betwen 1-255, the areas to mask out values 0 or null. 
-    The resulting MASK has always value 1 in not-masked areas.
+def MkMask(name, masks, inpmaps, refmaps, pimask = None):
+    """Makes a temporary mask raster 'name' to mask out changing pixels between
+    the dates. The user supplies the layers to include in the mask. The areas
+    to keep should have values betwen 1-255, the areas to mask out values 0 
+    or null. The resulting mask has always value 1 in not-masked areas.
     The mask also incorporates the areas of valid pixels of input and refrence
-    bands."""
-    grass.message("*** Creating aggregate MASK ***")
-    if grass.read_command("g.list", type="rast", pattern="MASK", mapset="."):
-        grass.message("MASK is already present, removing...")
-        grass.run_command("r.mask", flags = 'r')
+    bands (lists of bands, the mask is common for all of them) and of the
+    pimask (bit-packed mask of i.atcor.mask.py) pixels with all the bits set.
+    The mask is not set as the MASK, it is used explicitly by the functions
+    below."""
+    grass.message("*** Creating aggregate mask ***")
     # Initial calc string masks out areas which are null in either the reference or the corrected image
-    calc_string = "tmpmask = ! isnull(" + inpmap + ") && ! isnull(" + refmap + ")"
+    calc_string = name + " = " + " && ".join(["! isnull(" + i + ")" for i in inpmaps + refmaps])
     # If the masks string is not blank, split it and add the parts to calc_string to mask out changing pixels (incl. clouds etc) 
     if masks and masks.strip(): 
         masks_list = masks.split(',')
         for i in masks_list:
             calc_string = calc_string + " && " + i + " > 0" # NEW 2021-02: Added the part ' + " > 0"' - makes the calculation robust to FCELL and other types of raster not appropriate as argument to '&&' (and) operator. Such raster could be for example supplied when alternative cloud mask is created in GUI instead of by the L2A script.
+    if pimask:
+        calc_string = calc_string + " && " + pimask + " == " + str(gridcorrel.MASK_ALL)
     grass.mapcalc(calc_string, overwrite = True)
 
     
-def GridRegression(grid, xraster, yraster, minpixels, minr, method):
-    """ Iterates over grid tiles and computes the regression parameters a, b 
-    of the formula 'yraster = a + b * xraster' within each tile region. The 
-    computation is carried on only if there is more than 'minpixels' valid 
-    pixels (not masked out) in the tile region. The regresion parameters are 
-    stored into the grid tiles attribute columns a, b created earlier. The 
-    regression parameters are stored only if the correllation coefficient R is 
-    higher or equals to 'minr'. The function returns number of tiles processed. """
-    # Strip the "@mapset" part of grid name, as it makes problems with some grass versions
-    grid = grid.rsplit('@',1)[0]
-    # This creates string with lines (\n divided), which is not iterable
-    categories = grass.read_command("v.category", input = grid, option = "print")
-    # This turns the string into list of its lines
-    catlist = categories.split('\n')
-    # This removes empty list items.
-    catlist = list(filter(lambda x: x is not None, catlist))
-    catlist = list(filter(lambda x: x != '', catlist))
-    # This should store last category number
-    catmax = catlist[-1]
-    # DEVNOTE: This is here to test creation of correct tmpmap in the loop below
-    envdict = grass.parse_command("g.gisenv", flags = 'n')
-    #tmpmaploc = envdict['GISDBASE'] + "/" + envdict['LOCATION_NAME'] + "/" + envdict['MAPSET'] + "/vector/tmpmap"
-    tmpmaploc = os.path.join(envdict['GISDBASE'], envdict['LOCATION_NAME'], envdict['MAPSET'], 'vector', 'tmpmap')
-    tmpmapheadloc = os.path.join(tmpmaploc, 'head')
-    
-    # Loop over polygon grid features
-    grass.message("*** Processing grid tiles: ***")
-    numprocessed=0
-    numskipped=0
-    lowr=0
-    for category in catlist:
-        # Show progress in tiles
-        grass.message("Tile " + category + " of " + str(catmax) )
-        # Extracts one tile out of the grid
-        grass.run_command("v.extract", overwrite = True, input = grid, output = "tmpmap", cats = category, quiet = True)
-        #############################
-        # DEVNOTE: (***DOES THIS STILL HAPPEN?***) It seems there is a race condition causing the previous command fail to create output file randomly (looks like 1 out of 50-90 calls), creating just empty subdirectory for the map in the vector directory of the mapset. The map is then not readable, nor it can be deleted by GRASS tools. It happens especially when using grass database stored on NTFS from linux. Trying to avoid this simlply by repeating the failed command:
-        n = 0
-        while not os.path.exists(tmpmapheadloc):
-            if n > 20:
-                sys.exit("There is fatal problem to create temporary file tmpmap, exiting..")
-            grass.warning("tmpmap invalid, trying to recreate...")
-            os.rmdir(tmpmaploc)
-            # Try extract the tile again
-            grass.run_command("v.extract", overwrite = True, input = grid, output = "tmpmap", cats = category, quiet = True)
-            n += 1
-        ##############################
-        # Set region to the tile
-        grass.run_command("g.region", vect = "tmpmap")
-        # Check number of valid pixels in the tile (in the MASK reduced to the tile region, that is) - goes in dict containing 'sum=<number>'
-        # NOTE: depends on value 1 only in valid MASK pixels.
-        # First just check if the region is empty 
-        
-        valpixels_dict = grass.parse_command("r.univar", map = "MASK", flags = 'g', quiet = True)
+def SqlValue(value):
+    """Returns the value (number, string or None) as SQL literal, None and 
+    NaN as NULL."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, str):
+        if value.lower() in ("nan", "-nan"):
+            return "NULL"
+        try:
+            float(value)
+            return value
+        except ValueError:
+            return "'" + value.replace("'", "''") + "'"
+    if value != value:
+        return "NULL"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def WriteTileValues(grid, tilevalues):
+    """Stores the tile values into the grid attribute table. tilevalues is 
+    dict {category: list of (column, value)}. All the UPDATE statements are
+    sent to single db.execute run, which executes them in one transaction
+    (instead of db.execute run per tile and column)."""
+    sql = []
+    for category in sorted(tilevalues, key = int):
+        sql.append("UPDATE " + grid + " SET " + ", ".join([column + "=" + SqlValue(value) for column, value in tilevalues[category]]) + " WHERE cat=" + str(category) + ";")
+    if sql:
+        grass.write_command("db.execute", input = "-", stdin = "\n".join(sql) + "\n")
+
+
+def TileRegression(task):
+    """Computes the regression parameters of all the bands within one grid 
+    tile. The task is tuple (category, tile region (dict of g.region 
+    parameters n, s, e, w, rows, cols), maskraster, xrasters (masked by the
+    maskraster), yrasters, minpixels, minr, method).
+    The tile region is set only for this process by the GRASS_REGION 
+    variable, so the tiles can be processed in parallel (the function is run
+    by the worker processes of the pool). No temporary maps are created.
+    Returns tuple (category, number of valid pixels, list of (R, a, b) of the
+    bands) where R is None for tiles with too few valid pixels and a, b are 
+    None for tiles with R below minr."""
+    category, tile_region, maskraster, xrasters, yrasters, minpixels, minr, method = task
+    # Set region to the tile
+    os.environ['GRASS_REGION'] = grass.region_env(**tile_region)
+    try:
+        # Check number of valid pixels in the tile (in the mask reduced to the tile region, that is) - goes in dict containing 'sum=<number>'
+        # NOTE: depends on value 1 only in valid mask pixels.
+        valpixels_dict = grass.parse_command("r.univar", map = maskraster, flags = 'g', quiet = True)
         # Get valid pixels count as integer number
         valpixels = valpixels_dict.get("sum", 0)
         if valpixels is None:
@@ -282,226 +526,979 @@ def GridRegression(grid, xraster, yraster, minpixels, minr, method):
                 valpixels = 0
         else:
                 valpixels = int(valpixels)
-        
-        #~ #############DEVTEST:
-        #~ grass.message("DEVMESSAGE: valpixels_dict: " + str(valpixels_dict))
-        #~ grass.message("DEVMESSAGE: valpixels: " + str(valpixels))
-        #~ #input("DEVTEST: Press Enter to continue, CTRL-C to abort...")
-        #~ ######################
-        
-        if valpixels > minpixels:
+        results = []
+        for xraster, yraster in zip(xrasters, yrasters):
+            if valpixels <= minpixels:
+                results.append((None, None, None))
+                continue
             # Compute the least_sq regression #### DEVNOTE: least_sq regression line is computed here even if not used. While it is least computer intensive method, maybe it would be still more effective to compute it only in least_sq method branch and compute only the correlation coefficient R using numpy here. ### UPDATE 20200311: added the quiet parameter in r.regression.line, should take care of the progress indicators in the logs.
             regression_dict = grass.parse_command("r.regression.line", flags = 'g', mapx = xraster, mapy = yraster, quiet = True)
-            if float(regression_dict['R']) >= minr:
-                if numskipped > 0:
-                     # Line break to separate the next message from the progress percents - allows to filter these out in a log.
-                     print("\n")
-                     grass.message(" (" + str(numskipped) + " skipped: " + str(numskipped - lowr) + " too few valid pixels + " + str(lowr) + " low correlation)")
-                else:
-                     # Line break to separate the next message from the progress percents - allows to filter these out in a log.
-                     print("\n")
-                     grass.message("Tile " + category + " of " + str(catmax))
-                numskipped=0
-                lowr=0
-                if method == "least_sq":
-                     # Get the gain and slope from r.regression.line
-                     ka = regression_dict['a']
-                     kb = regression_dict['b']
-                elif method == "orthogonal":
-                     # Get the Sxx Syy and Sxy from covariance matrix
-                     covar_list = []
-                     covar_list = grass.read_command("r.covar", map = yraster + "," + xraster, quiet = True).split( )
-                     Sxx = float(covar_list[6])
-                     Syy = float(covar_list[3])
-                     Sxy = float(covar_list[4])
-                     #CHECK
-                     #grass.message("Syy,Sxx,Sxy: " + str(Syy) + "," + str(Sxx) + "," + str(Sxy))
-                     # slope
-                     kb = str(  (Syy - Sxx + math.sqrt((Syy - Sxx)**2 + 4 * Sxy**2))/(2 * Sxy)    )
-                     # intercept
-                     ka = str(float(regression_dict['meanY']) - float(kb) * float(regression_dict['meanX']))
-                elif method == "theil_sen":
-                     #THEIL-SEN Regression 
-                     # Get arrarys from the raster names
-                     # Create tile rasters #DEVNOTE: garray.array uses GRASS region, so this is not needed and we can read from the rasters directly. SEE: https://grass.osgeo.org/grass79/manuals/libpython/_modules/script/array.html
-                     grass.mapcalc("${omap} = ${imap}", omap = "xtile", imap = xraster, overwrite = True)
-                     grass.mapcalc("${omap} = ${imap}", omap = "ytile", imap = yraster, overwrite = True)
-                     # Read raster values to one-dimensional arrays (one dimension practical for the filtering of zeroes)
-                     x = garray.array(mapname="xtile").reshape(-1)
-                     y = garray.array(mapname="ytile").reshape(-1)
-                     # Now the null values are changed to zeroes. Let us filter them out by pairs of x, y values.
-                     xfiltered = np.array([])
-                     yfiltered = np.array([])
-                     i = 0
-                     for xi in np.nditer(x):
-                        if x[i] > 0:
-                           if y[i] > 0:
-                              xfiltered = np.append(xfiltered, [x[i]])
-                              yfiltered = np.append(yfiltered, [y[i]])
-                        i += 1
-                     # Compute the regression.
-                     res_list = stats.theilslopes(yfiltered, xfiltered)
-                     # slope
-                     kb = str(res_list[0])
-                     # intercept
-                     ka = str(res_list[1])
-                      
-                # Add the values to the a and b columns of the grid.
-                # do it in a manner like this shell example: echo "UPDATE grid SET a=0.1 WHERE cat=111" | db.execute
-                #   1) create the SQL query string
-                sqla = "UPDATE " + grid + " SET a=" + ka + " WHERE cat=" + category
-                sqlb = "UPDATE " + grid + " SET b=" + kb + " WHERE cat=" + category
-                #   2) send it to db.execute
-                grass.run_command("db.execute", sql = sqla)
-                grass.run_command("db.execute", sql = sqlb)
-                grass.message("Done. a=" + ka + " b=" + kb + " R=" + regression_dict['R'] + " n=" + str(valpixels) )
-                numprocessed = numprocessed + 1
-            else:
+            if float(regression_dict['R']) < minr:
+                results.append((regression_dict['R'], None, None))
+                continue
+            if method == "least_sq":
+                 # Get the gain and slope from r.regression.line
+                 ka = regression_dict['a']
+                 kb = regression_dict['b']
+            elif method == "orthogonal":
+                 # Get the Sxx Syy and Sxy from covariance matrix
+                 covar_list = []
+                 covar_list = grass.read_command("r.covar", map = yraster + "," + xraster, quiet = True).split( )
+                 Sxx = float(covar_list[6])
+                 Syy = float(covar_list[3])
+                 Sxy = float(covar_list[4])
+                 # slope
+                 kb = str(  (Syy - Sxx + math.sqrt((Syy - Sxx)**2 + 4 * Sxy**2))/(2 * Sxy)    )
+                 # intercept
+                 ka = str(float(regression_dict['meanY']) - float(kb) * float(regression_dict['meanX']))
+            elif method == "theil_sen":
+                 #THEIL-SEN Regression 
+                 # Read raster values within the tile region to one-dimensional arrays (one dimension practical for the filtering of zeroes)
+                 x = garray.array(mapname = xraster).reshape(-1)
+                 y = garray.array(mapname = yraster).reshape(-1)
+                 # Now the null (and masked out) values are changed to zeroes. Let us filter them out by pairs of x, y values.
+                 valid = (x > 0) & (y > 0)
+                 # Compute the regression.
+                 res_list = gridcorrel.TheilSen(x[valid], y[valid])
+                 # intercept
+                 ka = str(res_list[0])
+                 # slope
+                 kb = str(res_list[1])
+            results.append((regression_dict['R'], ka, kb))
+    finally:
+        del os.environ['GRASS_REGION']
+    return category, valpixels, results
+
+
+def TimedTileRegression(task):
+    """TileRegression of the task together with its time and the counts of
+    the GRASS commands it launched (dict), for the run report."""
+    before = dict(REPORT['commands'])
+    started = time.time()
+    result = TileRegression(task)
+    commands = dict([(prog, count - before.get(prog, 0)) for prog, count in REPORT['commands'].items() if count != before.get(prog, 0)])
+    return result, time.time() - started, commands
+
+
+def GridRegression(grid, grid_shape, xrasters, xmasked, yrasters, columns, maskraster, minpixels, minr, method, nprocs, journal = None):
+    """ Iterates over grid tiles and computes the regression parameters a, b 
+    of the formula 'yraster = a + b * xraster' within each tile region. The 
+    computation is carried on only if there is more than 'minpixels' valid 
+    pixels (not masked out) in the tile region. The regresion parameters are 
+    stored into the grid tiles attribute columns a, b created earlier. The 
+    regression parameters are stored only if the correllation coefficient R is 
+    higher or equals to 'minr'. xrasters, yrasters and columns are lists, 
+    all the bands are processed within the tile at once. xmasked are the 
+    xrasters with pixels masked out by maskraster set to null (the 
+    regression modules use only pixels valid in both maps). The tiles are 
+    processed by nprocs worker processes, each with its own region. The
+    results of every tile are recorded in the journal (see JournalRecord),
+    the tiles found in the journal entries of an interrupted run are not
+    computed again. The function returns list of numbers of tiles
+    processed for the bands. """
+    # Strip the "@mapset" part of grid name, as it makes problems with some grass versions
+    grid = grid.rsplit('@',1)[0]
+    nbands = len(xrasters)
+    grid_rows, grid_cols = grid_shape
+    tilecats = TileCats(grid, grid_rows, grid_cols)
+    catmax = max(int(c) for c in tilecats if c is not None)
+    # Tile regions aligned to the region pixels (each pixel belongs to the tile containing its center)
+    region_dict = grass.region()
+    rows = int(region_dict['rows'])
+    cols = int(region_dict['cols'])
+    north = float(region_dict['n'])
+    west = float(region_dict['w'])
+    nsres = float(region_dict['nsres'])
+    ewres = float(region_dict['ewres'])
+    row_first, row_last = gridcorrel.TileRanges(rows, grid_rows)
+    col_first, col_last = gridcorrel.TileRanges(cols, grid_cols)
+    tasks = []
+    for tile in sorted(range(grid_rows * grid_cols), key = lambda t: int(tilecats[t])):
+        r, c = divmod(tile, grid_cols)
+        if row_last[r] == row_first[r] or col_last[c] == col_first[c]:
+            continue
+        tile_region = {'n': north - row_first[r] * nsres, 's': north - row_last[r] * nsres,
+                       'w': west + col_first[c] * ewres, 'e': west + col_last[c] * ewres,
+                       'rows': row_last[r] - row_first[r], 'cols': col_last[c] - col_first[c]}
+        tasks.append((tilecats[tile], tile_region, maskraster, xmasked, yrasters, minpixels, minr, method))
+    # Tiles finished by the interrupted run (no time, no commands)
+    categories = set([task[0] for task in tasks])
+    resumed = [((entry['tile'], entry['n'], [tuple(result) for result in entry['results']]), None, {}) for entry in journal or [] if entry.get('tile') in categories]
+    if resumed:
+        grass.message("Resuming: " + str(len(resumed)) + " tiles of " + str(len(tasks)) + " finished by the interrupted run.")
+        REPORT['resumed_tiles'] = len(resumed)
+        done = set([result[0][0] for result in resumed])
+        tasks = [task for task in tasks if task[0] not in done]
+
+    # Loop over grid tiles
+    grass.message("*** Processing grid tiles: ***")
+    if nprocs > 1:
+        grass.message("Using " + str(nprocs) + " processes.")
+        pool = multiprocessing.Pool(nprocs)
+        tileresults = itertools.chain(resumed, pool.imap(TimedTileRegression, tasks))
+    else:
+        pool = None
+        tileresults = itertools.chain(resumed, (TimedTileRegression(task) for task in tasks))
+    numprocessed = [0] * nbands
+    numskipped = [0] * nbands
+    lowr = [0] * nbands
+    # values to store into the grid table at once
+    diagcolumns = DiagColumns(nbands)
+    tilevalues = {}
+    for (category, valpixels, results), seconds, commands in tileresults:
+        if seconds is not None:
+            REPORT['tiles'].append({'tile': int(category), 'seconds': seconds, 'n': valpixels, 'commands': sum(commands.values())})
+            JournalRecord({'tile': category, 'n': valpixels, 'results': results})
+        if pool:
+            # the commands of the worker processes are not counted here
+            AddCounts(commands)
+        # Show progress in tiles
+        grass.message("Tile " + category + " of " + str(catmax) )
+        tilevalues[category] = [("n", valpixels)]
+        for k in range(nbands):
+            rvalue, ka, kb = results[k]
+            tilevalues[category].extend([(diagcolumns[k][0], rvalue), (diagcolumns[k][1], "pixels" if rvalue is None else "r" if ka is None else None)])
+        if valpixels <= minpixels:
+            # Verbose option: inform about reason tile skipped:
+            if flags['v']:
+               grass.message("Too few valid pixels, tile skipped.")
+            numskipped = [i + 1 for i in numskipped]
+            continue
+        for k in range(nbands):
+            # Band name to prefix messages with (if there are more bands)
+            label = xrasters[k] + ": " if nbands > 1 else ""
+            rvalue, ka, kb = results[k]
+            if ka is None:
                 # Verbose option: inform about reason tile skipped:
                 if flags['v']:
-                   grass.message("Low correlation, tile skipped. R=" + regression_dict['R'])
-                numskipped = numskipped + 1
-                lowr = lowr + 1
+                   grass.message(label + "Low correlation, tile skipped. R=" + rvalue)
+                numskipped[k] = numskipped[k] + 1
+                lowr[k] = lowr[k] + 1
+                continue
+            if numskipped[k] > 0:
+                 # Line break to separate the next message from the progress percents - allows to filter these out in a log.
+                 print("\n")
+                 grass.message(label + " (" + str(numskipped[k]) + " skipped: " + str(numskipped[k] - lowr[k]) + " too few valid pixels + " + str(lowr[k]) + " low correlation)")
+            numskipped[k]=0
+            lowr[k]=0
+            # Add the values to the a and b columns of the grid.
+            tilevalues[category].extend([(columns[k][0], ka), (columns[k][1], kb)])
+            grass.message(label + "Done. a=" + ka + " b=" + kb + " R=" + rvalue + " n=" + str(valpixels) )
+            numprocessed[k] = numprocessed[k] + 1
+    if pool:
+        pool.close()
+        pool.join()
+    WriteTileValues(grid, tilevalues)
+
+    # Summary of the regression
+    for k in range(nbands):
+        label = xrasters[k] + ": " if nbands > 1 else ""
+        if numskipped[k] > 0:
+             # Line break to separate the next message from the progress percents - allows to filter these out in a log.
+             print("\n")
+             grass.message(label + " (" + str(numskipped[k]) + " skipped: " + str(numskipped[k] - lowr[k]) + " too few valid pixels + " + str(lowr[k]) + " low correlation)")
+        grass.message("*** " + label + "Regression computed in " + str(numprocessed[k]) + " of " + str(catmax) + " grid tiles. (method: " + method + ") ***")
+    return numprocessed
+
+
+def TileCats(grid, grid_rows, grid_cols):
+    """Returns list of grid categories ordered by tile number (row by row from
+    the top left tile, as used by gridcorrel.TileIndex). The tile of each 
+    category is found from the position of its centroid within the region."""
+    region_dict = grass.region()
+    north = float(region_dict['n'])
+    south = float(region_dict['s'])
+    east = float(region_dict['e'])
+    west = float(region_dict['w'])
+    tilecats = [None] * (grid_rows * grid_cols)
+    centroids = grass.read_command("v.out.ascii", input = grid, type = "centroid", format = "point", separator = "|", quiet = True)
+    for line in centroids.splitlines():
+        if not line.strip():
+            continue
+        x, y, category = line.split('|')[:3]
+        tile_row = min(int((north - float(y)) / (north - south) * grid_rows), grid_rows - 1)
+        tile_col = min(int((float(x) - west) / (east - west) * grid_cols), grid_cols - 1)
+        tilecats[tile_row * grid_cols + tile_col] = category
+    return tilecats
+
+
+def GridSweep(xrasters, yrasters, maskraster, gridsizes, minpixels, minr, memory):
+    """Evaluates the grid tile sizes gridsizes (list of sizes in map units)
+    from single read of every band pair. The bands are read by blocks of
+    rows as large as fits in memory (MB) and the valid pixels count and
+    sums of every tile of every grid are accumulated from each block (see
+    gridcorrel.TileMoments), so no whole band is held in memory. For every
+    band and grid size prints the grid size, number of tiles, number of
+    accepted tiles (more than minpixels valid pixels and R >= minr) and
+    mean R of the accepted tiles."""
+    region_dict = grass.region()
+    rows = int(region_dict['rows'])
+    cols = int(region_dict['cols'])
+    shapes = [gridcorrel.GridShape(rows, cols, float(region_dict['nsres']), float(region_dict['ewres']), size) for size in gridsizes]
+    moments = [[np.zeros((len(gridcorrel.MOMENTS), grid_rows * grid_cols)) for grid_rows, grid_cols in shapes] for xraster in xrasters]
+    # mask, x, y, the tile numbers of every grid and the temporary arrays of a block
+    blockrows = gridcorrel.MemoryRows(memory, cols, 8 + len(gridsizes))
+    grass.message("*** Computing statistics of the grid tiles of " + str(len(gridsizes)) + " grid sizes ***")
+    maps = [RasterRow(name) for name in [maskraster] + xrasters + yrasters]
+    for rastermap in maps:
+        rastermap.open('r')
+    try:
+        for start in range(0, rows, blockrows):
+            end = min(start + blockrows, rows)
+            grass.percent(start, rows, 1)
+            # Valid pixels are those with value 1 in the mask
+            valid = gridcorrel.ReadRows(maps[0], start, end) > 0
+            tiles = [gridcorrel.TileIndex(rows, cols, grid_rows, grid_cols, start, end)[valid] for grid_rows, grid_cols in shapes]
+            for k in range(len(xrasters)):
+                x = gridcorrel.ReadRows(maps[1 + k], start, end)[valid]
+                y = gridcorrel.ReadRows(maps[1 + len(xrasters) + k], start, end)[valid]
+                for g in range(len(gridsizes)):
+                    gridcorrel.TileMoments(tiles[g], x, y, shapes[g][0] * shapes[g][1], moments[k][g])
+                del x, y
+            del valid, tiles
+        grass.percent(1, 1, 1)
+    finally:
+        for rastermap in maps:
+            rastermap.close()
+    print("band|gridsize|grid_rows|grid_cols|tiles|accepted|mean_r")
+    for k in range(len(xrasters)):
+        for g, (grid_rows, grid_cols) in enumerate(shapes):
+            rvalues = gridcorrel.Correlation(moments[k][g])
+            accepted = (moments[k][g][0] > minpixels) & (rvalues >= minr)
+            mean_r = str(np.mean(rvalues[accepted])) if accepted.any() else "-"
+            print(xrasters[k] + "|" + str(gridsizes[g]) + "|" + str(grid_rows) + "|" + str(grid_cols) + "|" + str(grid_rows * grid_cols) + "|" + str(int(accepted.sum())) + "|" + mean_r)
+    sys.stdout.flush()
+
+
+def MomentsCache(cache, xrasters, yrasters, masks, grid_shape, sample = None, seed = 0):
+    """Returns list of (file name, key) of the tile statistics cache files in
+    the cache directory for the bands xrasters, yrasters. The key is built
+    from the full names and modification times of the bands, the mask layers
+    and the MASK (if present), the region, the grid geometry and the pixel
+    sample, so any change of these makes the cached statistics unusable. The common mask (see MkMask) is built from the
+    valid pixels of all the bands, so the stamps of all of them are in the
+    key of every band."""
+    region_dict = grass.region()
+    common = ["masks=" + (masks or "").strip()]
+    common.extend(["band=" + gridcorrel.RasterStamp(name) for name in xrasters + yrasters])
+    common.extend([name + "=" + str(region_dict[name]) for name in ("n", "s", "e", "w", "rows", "cols")])
+    common.append("grid=" + str(grid_shape[0]) + "x" + str(grid_shape[1]))
+    if sample:
+        common.append("sample=" + str(sample) + " seed=" + str(seed))
+    common.extend(MaskStamps(masks))
+    cachefiles = []
+    for xraster, yraster in zip(xrasters, yrasters):
+        key = gridcorrel.CacheKey([gridcorrel.RasterStamp(xraster), gridcorrel.RasterStamp(yraster)] + common)
+        cachefiles.append((os.path.join(cache, "atcor_" + key + ".npz"), key))
+    return cachefiles
+
+
+def MaskStamps(masks):
+    """Returns list of the RasterStamp of the mask layers (comma separated
+    string) and of the MASK (if present)."""
+    maskmaps = [m.strip() for m in (masks or "").split(',') if m.strip()]
+    if grass.find_file("MASK", element = "cell", mapset = ".")['file']:
+        maskmaps.append("MASK")
+    return [gridcorrel.RasterStamp(name) for name in maskmaps]
+
+
+def JournalFile(inpmaps, refmaps, masks, outmaps, engine):
+    """Returns the name of the journal file in the atcor_journal directory of
+    the current mapset for the run. The name is the key built from the full
+    names and modification times of the bands and masks, the region, the
+    outputs and the parameters of the regression and correction, so only a
+    rerun with the same inputs and parameters finds the journal."""
+    env = grass.gisenv()
+    region_dict = grass.region()
+    parts = ["journal", "engine=" + engine, "outputs=" + ",".join(outmaps)]
+    parts.extend([gridcorrel.RasterStamp(name) for name in inpmaps + refmaps] + MaskStamps(masks))
+    parts.extend([name + "=" + str(region_dict[name]) for name in ("n", "s", "e", "w", "rows", "cols")])
+    parts.extend([name + "=" + options[name] for name in ("gridsize", "pixels", "minr", "minrfloor", "mintiles", "sample", "seed", "regression",
+                                                          "interpolation", "interpolator", "lambda_i", "memory")])
+    directory = os.path.join(env['GISDBASE'], env['LOCATION_NAME'], env['MAPSET'], "atcor_journal")
+    return os.path.join(directory, "journal_" + gridcorrel.CacheKey(parts) + ".jsonl")
+
+
+def OpenJournal(filename, resume):
+    """Opens the journal file for appending the finished tiles, blocks of
+    rows and bands (see JournalRecord). With resume the entries recorded by
+    an interrupted run are returned (list of dicts, the line cut by the
+    interruption is ignored), otherwise the journal starts empty (the
+    journal of an interrupted run is discarded with a warning)."""
+    entries = []
+    if not resume and os.path.isfile(filename):
+        grass.warning("Discarding the journal of an unfinished run with the same inputs and parameters, use -r to resume it instead.")
+    if resume and os.path.isfile(filename):
+        with open(filename) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    JOURNAL['filename'] = filename
+    JOURNAL['handle'] = open(filename, "w")
+    # the valid entries rewritten, so the cut line does not stay in between
+    for entry in entries:
+        JournalRecord(entry)
+    return entries
+
+
+def JournalRecord(entry):
+    """Appends the entry (dict) to the journal, if open. The line is flushed
+    at once, so it survives the interruption of the run."""
+    if JOURNAL['handle']:
+        JOURNAL['handle'].write(json.dumps(entry) + "\n")
+        JOURNAL['handle'].flush()
+
+
+def CloseJournal():
+    """Closes and removes the journal of the finished run."""
+    if JOURNAL['handle']:
+        JOURNAL['handle'].close()
+        JOURNAL['handle'] = None
+        os.remove(JOURNAL['filename'])
+
+
+def TheilSenTask(task):
+    """Theil-Sen regression of the (x, y) arrays tuple, to be run by the 
+    worker processes of the pool. Only the pixels with x > 0 and y > 0 are
+    used, as in TileRegression."""
+    x, y = task
+    valid = (x > 0) & (y > 0)
+    return gridcorrel.TheilSen(x[valid], y[valid])
+
+
+def GridRegressionArray(grid, grid_shape, xrasters, yrasters, columns, maskraster, minpixels, minr, method, nprocs, memory, cachefiles = None, minrfloor = None, mintiles = 1, sample = None, seed = 0, journal = None):
+    """ The same as GridRegression, but instead of running GRASS commands in 
+    every tile, the maskraster and the xraster, yraster bands are read once
+    by blocks of whole grid tile rows (see gridcorrel.ReadRows) and the valid pixels 
+    count and sums needed for the regression (n, Sum(x), Sum(y), Sum(x^2),
+    Sum(y^2), Sum(x*y)) are accumulated for all tiles keyed by tile number.
+    The blocks are as large as fits in memory (MB). The least_sq and 
+    orthogonal regression and R are then computed directly from these sums.
+    The Theil-Sen regression of the tiles of each block (complete there) is
+    computed by nprocs worker processes, the huber and tukey regression of
+    all the tiles of the block at once (see gridcorrel.RobustFit).
+    If cachefiles (list of (file name, key) per band, see MomentsCache) is
+    given, the sums are saved there and the bands with sums already saved
+    are not read at all (except for the Theil-Sen and robust regressions,
+    which need the pixel values).
+    If minrfloor is given (adaptive mode), the bands with fewer than 
+    mintiles tiles passing minr use the highest threshold down to minrfloor
+    accepting mintiles tiles (see gridcorrel.AdaptiveMinr), chosen from the
+    R and fits of all the tiles kept from the single pass.
+    If sample is given, only the stratified sample of at most sample valid
+    pixels per tile (see gridcorrel.SampleTiles) is used for the sums and
+    the fits of all the bands, drawn from the mask in the same pass.
+    The sums and fits of the tiles of every block are recorded in the
+    journal (see JournalRecord), the blocks found in the journal entries
+    of an interrupted run are not read again.
+    The function returns list of numbers of tiles processed for the bands. """
+    # Strip the "@mapset" part of grid name, as it makes problems with some grass versions
+    grid = grid.rsplit('@',1)[0]
+    nbands = len(xrasters)
+    grid_rows, grid_cols = grid_shape
+    ntiles = grid_rows * grid_cols
+    tilecats = TileCats(grid, grid_rows, grid_cols)
+    catmax = max(int(c) for c in tilecats if c is not None)
+    region_dict = grass.region()
+    rows = int(region_dict['rows'])
+    cols = int(region_dict['cols'])
+
+    # Tile statistics saved by earlier runs (None for the bands to compute)
+    cached = [None] * nbands
+    if cachefiles:
+        cached = [gridcorrel.LoadMoments(filename, key, ntiles) for filename, key in cachefiles]
+        for k in range(nbands):
+            if cached[k] is not None:
+                grass.message("Using cached statistics of grid tiles: " + xrasters[k])
+    moments = [np.zeros((len(gridcorrel.MOMENTS), ntiles)) if m is None else m for m in cached]
+    # R threshold of the tiles to fit (Theil-Sen, robust), lower in the adaptive mode
+    fitminr = minr if minrfloor is None else min(minr, minrfloor)
+    # the methods fitted from the pixel values, not from the sums
+    pixelfit = method == "theil_sen" or method in gridcorrel.ROBUST_METHODS
+    # Bands to read (all of them for Theil-Sen and robust regression)
+    readbands = [k for k in range(nbands) if cached[k] is None or pixelfit]
+
+    # Regression parameters and R of the tiles, one row per band
+    avalues = np.full((nbands, ntiles), np.nan)
+    bvalues = np.full((nbands, ntiles), np.nan)
+    rvalues = np.full((nbands, ntiles), np.nan)
+    if readbands:
+        if method == "theil_sen" and nprocs > 1:
+            grass.message("Using " + str(nprocs) + " processes.")
+            pool = multiprocessing.Pool(nprocs)
+        # mask, x, y, tile numbers and the temporary arrays of a block
+        blocks = gridcorrel.TileRowBlocks(rows, grid_rows, gridcorrel.MemoryRows(memory, cols, 8))
+        grass.message("*** Computing statistics of grid tiles in " + str(len(blocks)) + " block(s) of rows ***")
+        maps = [RasterRow(name) for name in [maskraster] + xrasters + yrasters]
+        for rastermap in maps:
+            rastermap.open('r')
+        validpixels = sampledpixels = 0
+        # blocks finished by the interrupted run
+        resumed = dict([(tuple(entry['block']), entry) for entry in journal or [] if 'block' in entry])
+        if resumed:
+            grass.message("Resuming: " + str(len([block for block in blocks if block in resumed])) + " blocks of rows of " + str(len(blocks)) + " finished by the interrupted run.")
+        try:
+            for start, end in blocks:
+                blockstarted = time.time()
+                grass.percent(start, rows, 1)
+                # the tiles of the block (whole grid tile rows)
+                tilesfirst = ((2 * start + 1) * grid_rows) // (2 * rows) * grid_cols
+                tileslast = (((2 * end - 1) * grid_rows) // (2 * rows) + 1) * grid_cols
+                if (start, end) in resumed and all([resumed[(start, end)]['moments'][k] is not None for k in readbands]):
+                    entry = resumed[(start, end)]
+                    for k in readbands:
+                        moments[k][:, tilesfirst:tileslast] = entry['moments'][k]
+                        avalues[k, tilesfirst:tileslast] = entry['a'][k]
+                        bvalues[k, tilesfirst:tileslast] = entry['b'][k]
+                    # the pixel counts of the sample message and report
+                    validpixels += entry.get('valid_pixels', 0)
+                    sampledpixels += entry.get('sampled_pixels', 0)
+                    continue
+                # Valid pixels are those with value 1 in the mask
+                valid = gridcorrel.ReadRows(maps[0], start, end) > 0
+                blockvalid = blocksampled = int(valid.sum())
+                if sample:
+                    # the blocks hold whole tiles, the sample of every tile is drawn at once
+                    valid = gridcorrel.SampleTiles(valid, rows, cols, grid_rows, grid_cols, sample, seed, start)
+                    blocksampled = int(valid.sum())
+                validpixels += blockvalid
+                sampledpixels += blocksampled
+                tiles = gridcorrel.TileIndex(rows, cols, grid_rows, grid_cols, start, end)[valid]
+                if pixelfit:
+                    # tiles lying in this block
+                    blocktiles = np.unique(tiles)
+                if method == "theil_sen":
+                    order, first = gridcorrel.GroupByTile(tiles, ntiles)
+                for k in readbands:
+                    x = gridcorrel.ReadRows(maps[1 + k], start, end)[valid]
+                    y = gridcorrel.ReadRows(maps[1 + nbands + k], start, end)[valid]
+                    if cached[k] is None:
+                        gridcorrel.TileMoments(tiles, x, y, ntiles, moments[k])
+                    if pixelfit:
+                        rblock = gridcorrel.Correlation(moments[k][:, blocktiles])
+                        fittiles = blocktiles[(moments[k][0, blocktiles] > minpixels) & (rblock >= fitminr)]
+                    if method in gridcorrel.ROBUST_METHODS:
+                        # pixels of the tiles to fit, all of them at once
+                        fit = np.zeros(ntiles, dtype = bool)
+                        fit[fittiles] = True
+                        fit = fit[tiles]
+                        robusta, robustb = gridcorrel.RobustFit(tiles[fit], x[fit], y[fit], ntiles, method)
+                        avalues[k, fittiles] = robusta[fittiles]
+                        bvalues[k, fittiles] = robustb[fittiles]
+                    elif method == "theil_sen":
+                        tasks = [(x[order[first[tile]:first[tile + 1]]], y[order[first[tile]:first[tile + 1]]]) for tile in fittiles]
+                        if nprocs > 1:
+                            fits = pool.map(TheilSenTask, tasks)
+                        else:
+                            fits = [TheilSenTask(task) for task in tasks]
+                        for tile, fit in zip(fittiles, fits):
+                            avalues[k, tile], bvalues[k, tile] = fit
+                    del x, y
+                del valid, tiles
+                JournalRecord({'block': [start, end], 'moments': [moments[k][:, tilesfirst:tileslast].tolist() if k in readbands else None for k in range(nbands)],
+                               'a': [avalues[k, tilesfirst:tileslast].tolist() if k in readbands else None for k in range(nbands)],
+                               'b': [bvalues[k, tilesfirst:tileslast].tolist() if k in readbands else None for k in range(nbands)],
+                               'valid_pixels': blockvalid, 'sampled_pixels': blocksampled})
+                REPORT['blocks'].append({'rows': [start, end], 'seconds': time.time() - blockstarted})
+            grass.percent(1, 1, 1)
+        finally:
+            for rastermap in maps:
+                rastermap.close()
+        if sample:
+            grass.message("Sample of at most " + str(sample) + " pixels per tile (seed " + str(seed) + "): " + str(sampledpixels) + " of " + str(validpixels) + " valid pixels used.")
+            REPORT['sample'] = {'sample': sample, 'seed': seed, 'valid_pixels': validpixels, 'sampled_pixels': sampledpixels}
+        if method == "theil_sen" and nprocs > 1:
+            pool.close()
+            pool.join()
+    for k in range(nbands):
+        if cachefiles and cached[k] is None:
+            gridcorrel.SaveMoments(cachefiles[k][0], cachefiles[k][1], moments[k])
+        rvalues[k] = gridcorrel.Correlation(moments[k])
+        if not pixelfit:
+            avalues[k], bvalues[k] = gridcorrel.FitMoments(moments[k], method)
+    valpixels = moments[0][0]
+    # R threshold of the bands (lowered by the adaptive mode)
+    bandminr = [minr] * nbands
+    if minrfloor is not None:
+        for k in range(nbands):
+            bandminr[k] = gridcorrel.AdaptiveMinr(rvalues[k], valpixels, minpixels, minr, minrfloor, mintiles)
+            if bandminr[k] < minr:
+                label = xrasters[k] + ": " if nbands > 1 else ""
+                grass.message(label + "Only " + str(int(((valpixels > minpixels) & (rvalues[k] >= minr)).sum())) + " tiles with R >= " + str(minr) + ", adaptive minr=" + str(bandminr[k]) + " used.")
+
+    numprocessed = [0] * nbands
+    numskipped = [0] * nbands
+    lowr = [0] * nbands
+    # values to store into the grid table at once
+    diagcolumns = DiagColumns(nbands)
+    tilevalues = {}
+    for tile in sorted(range(ntiles), key = lambda t: int(tilecats[t])):
+        category = tilecats[tile]
+        tilevalues[category] = [("n", int(valpixels[tile]))]
+        for k in range(nbands):
+            accepted = valpixels[tile] > minpixels and rvalues[k, tile] >= bandminr[k]
+            tilevalues[category].extend([(diagcolumns[k][0], rvalues[k, tile]), (diagcolumns[k][1], None if accepted else "pixels" if valpixels[tile] <= minpixels else "r")])
+        if valpixels[tile] > minpixels:
+            for k in range(nbands):
+                label = xrasters[k] + ": " if nbands > 1 else ""
+                if rvalues[k, tile] >= bandminr[k]:
+                    if numskipped[k] > 0:
+                         grass.message(label + " (" + str(numskipped[k]) + " skipped: " + str(numskipped[k] - lowr[k]) + " too few valid pixels + " + str(lowr[k]) + " low correlation)")
+                    grass.message(label + "Tile " + category + " of " + str(catmax))
+                    numskipped[k]=0
+                    lowr[k]=0
+                    ka = str(avalues[k, tile])
+                    kb = str(bvalues[k, tile])
+                    tilevalues[category].extend([(columns[k][0], avalues[k, tile]), (columns[k][1], bvalues[k, tile])])
+                    grass.message(label + "Done. a=" + ka + " b=" + kb + " R=" + str(rvalues[k, tile]) + " n=" + str(int(valpixels[tile])) )
+                    numprocessed[k] = numprocessed[k] + 1
+                else:
+                    if flags['v']:
+                       grass.message(label + "Tile " + category + ": Low correlation, tile skipped. R=" + str(rvalues[k, tile]))
+                    numskipped[k] = numskipped[k] + 1
+                    lowr[k] = lowr[k] + 1
         else:
-            # Verbose option: inform about reason tile skipped:
             if flags['v']:
-               grass.message("Too few valid pixels, tile skipped.")
-            numskipped = numskipped + 1
-            
-            
-
-        # remove tmpmap, forceremove in case of problems.
-        if os.path.exists(tmpmapheadloc): 
-            try: 
-                grass.run_command("g.remove", flags = 'f', type = "vector", name = "tmpmap", quiet = True)
-            except:
-                if os.path.exists(tmpmaploc):
-                    grass.warning("Forcing invalid tmpmap to be removed.")
-                    os.rmdir(tmpmaploc)
-        elif os.path.exists(tmpmaploc):
-            grass.warning("Forcing invalid tmpmap to be removed.")
-            os.rmdir(tmpmaploc)
-            pass
-        pass
+               grass.message("Tile " + category + ": Too few valid pixels, tile skipped.")
+            numskipped = [i + 1 for i in numskipped]
+    WriteTileValues(grid, tilevalues)
 
     # Summary of the regression
-    if numskipped > 0:
-         # Line break to separate the next message from the progress percents - allows to filter these out in a log.
-         print("\n")
-         grass.message(" (" + str(numskipped) + " skipped: " + str(numskipped - lowr) + " too few valid pixels + " + str(lowr) + " low correlation)")
-    grass.message("*** Regression computed in " + str(numprocessed) + " of " + str(catmax) + " grid tiles. (method: " + method + ") ***")
+    for k in range(nbands):
+        label = xrasters[k] + ": " if nbands > 1 else ""
+        if numskipped[k] > 0:
+             grass.message(label + " (" + str(numskipped[k]) + " skipped: " + str(numskipped[k] - lowr[k]) + " too few valid pixels + " + str(lowr[k]) + " low correlation)")
+        grass.message("*** " + label + "Regression computed in " + str(numprocessed[k]) + " of " + str(catmax) + " grid tiles. (method: " + method + ", engine: array) ***")
     return numprocessed
 
 
+def Footprint(raster, memory):
+    """Returns the (first, last+1) columns arrays of the pixels of every row
+    within the convex hull of the raster pixels with value > 0 (see 
+    gridcorrel.HullSpans). The raster is read by blocks of rows fitting in
+    memory (MB)."""
+    region_dict = grass.region()
+    rows = int(region_dict['rows'])
+    cols = int(region_dict['cols'])
+    first = np.empty(rows, dtype = int)
+    last = np.empty(rows, dtype = int)
+    blockrows = gridcorrel.MemoryRows(memory, cols, 3)
+    rastermap = RasterRow(raster)
+    rastermap.open('r')
+    try:
+        for start in range(0, rows, blockrows):
+            end = min(start + blockrows, rows)
+            first[start:end], last[start:end] = gridcorrel.RowExtents(gridcorrel.ReadRows(rastermap, start, end) > 0)
+    finally:
+        rastermap.close()
+    return gridcorrel.HullSpans(first, last, cols)
+
+
+def WriteFootprint(name, hullspans):
+    """Writes the hull (see Footprint) as raster name (1 inside, null outside)."""
+    start, end = hullspans
+    cols = int(grass.region()['cols'])
+    colindex = np.arange(cols)
+    out = RasterRow(name)
+    out.open('w', mtype = 'CELL', overwrite = True)
+    outrow = Buffer((cols,), mtype = 'CELL')
+    try:
+        for row in range(start.size):
+            outrow[:] = np.where((colindex >= start[row]) & (colindex < end[row]), 1, gridcorrel.CELL_NULL)
+            out.put_row(outrow)
+    finally:
+        out.close()
+
+
+def TileValues(grid, grid_shape, columns):
+    """Returns the values of the grid table columns (list of names) as array
+    of shape (number of columns, grid rows, grid cols) of the regular grid 
+    of grid_shape (grid rows, grid cols), NaN for the empty values."""
+    grid_rows, grid_cols = grid_shape
+    tilecats = TileCats(grid.rsplit('@',1)[0], grid_rows, grid_cols)
+    table = grass.vector_db_select(grid, columns = ",".join(columns))['values']
+    values = np.full((len(columns), grid_rows * grid_cols), np.nan)
+    for tile, category in enumerate(tilecats):
+        if category is None:
+            continue
+        for k, value in enumerate(table[int(category)][:len(columns)]):
+            if value:
+                values[k, tile] = float(value)
+    return values.reshape(len(columns), grid_rows, grid_cols)
+
+
+def CoefGrid(grid, grid_shape, columns):
+    """Returns the regression parameters stored in the grid columns (pair of
+    a and b column names) as array of shape (2, grid rows, grid cols) of the
+    regular grid of grid_shape (grid rows, grid cols). Only the tiles with 
+    b > 0 are used, the other tiles are filled from the neighbouring ones."""
+    coefs = TileValues(grid, grid_shape, columns)
+    # the b parameter is empty for the skipped tiles, in the "good" tiles it should be always positive
+    coefs[:, ~(coefs[1] > 0)] = np.nan
+    return gridcorrel.FillGaps(coefs)
+
+
+def SaveModel(filename, grid, grid_shape, inpmaps, refmaps, columns, gridsize, method, minr, minpixels, interpolation):
+    """Saves the fitted correction model of the bands (see gridcorrel.SaveModel):
+    the a, b grid of the accepted tiles with b > 0 (NaN elsewhere) of shape
+    (bands, 2, grid rows, grid cols), per tile R of the bands and the valid
+    pixels count n, the region and the grid and regression settings."""
+    nbands = len(inpmaps)
+    grid_rows, grid_cols = grid_shape
+    values = TileValues(grid, grid_shape, ["n"] + [name for pair in columns for name in pair] + [r for r, reject in DiagColumns(nbands)])
+    coefs = values[1:1 + 2 * nbands].reshape(nbands, 2, grid_rows, grid_cols)
+    for k in range(nbands):
+        coefs[k][:, ~(coefs[k][1] > 0)] = np.nan
+    region_dict = grass.region()
+    fields = {'inputs': inpmaps, 'references': refmaps, 'coefs': coefs, 'r': values[1 + 2 * nbands:], 'n': values[0],
+              'gridsize': gridsize, 'method': method, 'minr': minr, 'pixels': minpixels, 'interpolation': interpolation}
+    for name in ("n", "s", "e", "w", "nsres", "ewres", "rows", "cols"):
+        fields["region_" + name] = float(region_dict[name])
+    gridcorrel.SaveModel(filename, fields)
+    grass.message("Correction model saved: " + filename)
+
+
+def ApplyModel(modelfile, inpmaps, outmaps, modelbands, footprint, interpolation, blockrows, memory):
+    """Corrects the inpmaps bands into outmaps by the a, b grid of the model
+    bands modelbands (indices into the model bands) of the model file saved
+    by SaveModel, without any regression. The region extent has to be the
+    same as the extent of the fit (within half of the coarser pixel), the 
+    resolution may differ. The output is limited to the convex hull of the 
+    valid pixels of the inputs (the raster footprint is created for it).
+    The a, b grid is interpolated by the interpolation stored in the model,
+    unless other interpolation is given (with a warning).
+    Returns the list of numbers of the model tiles used for the bands."""
+    try:
+        model = gridcorrel.LoadModel(modelfile)
+    except (IOError, OSError, ValueError) as e:
+        grass.fatal("Can not read the correction model " + modelfile + ": " + str(e))
+    nmodelbands = model['coefs'].shape[0]
+    for band in modelbands:
+        if band < 0 or band >= nmodelbands:
+            grass.fatal("Model band " + str(band + 1) + " out of range, the model has " + str(nmodelbands) + " bands.")
+    region_dict = grass.region()
+    tolerance = max(float(region_dict['nsres']), float(region_dict['ewres']), model['region_nsres'], model['region_ewres']) / 2
+    for name in ("n", "s", "e", "w"):
+        if abs(float(region_dict[name]) - model["region_" + name]) > tolerance:
+            grass.fatal("The region extent differs from the extent of the model (" + name + "=" + str(model["region_" + name]) + "). Set the region to the extent the model was fitted in.")
+    if not interpolation:
+        interpolation = str(model['interpolation'])
+    elif interpolation != str(model['interpolation']):
+        grass.warning("The model was saved with interpolation=" + str(model['interpolation']) + ", interpolating it by " + interpolation + " as given.")
+    grass.message("*** Correction model " + modelfile + " (regression: " + str(model['method']) + ", grid: " + str(model['coefs'].shape[2]) + " rows, " + str(model['coefs'].shape[3]) + " cols, minr: " + str(model['minr']) + ") ***")
+    MkMask(footprint, "", inpmaps, [])
+    hullspans = Footprint(footprint, memory)
+    success = []
+    for k in range(len(inpmaps)):
+        coefs = model['coefs'][modelbands[k]]
+        success.append(int((coefs[1] > 0).sum()))
+        if success[k] == 0:
+            continue
+        grass.message("*** Correcting raster map " + inpmaps[k] + " by model band " + str(modelbands[k] + 1) + " (" + str(model['inputs'][modelbands[k]]) + ", " + str(success[k]) + " tiles) ***")
+        coefstats = ApplyCoefs(inpmaps[k], outmaps[k], hullspans, gridcorrel.FillGaps(coefs), interpolation, blockrows, memory)
+        grass.message("Output map created: " + outmaps[k])
+        if flags['v']:
+            grass.message("a (intercept): min=" + str(coefstats[0][0]) + " mean=" + str(coefstats[0][1]) + " max=" + str(coefstats[0][2]))
+            grass.message("b (slope): min=" + str(coefstats[1][0]) + " mean=" + str(coefstats[1][1]) + " max=" + str(coefstats[1][2]))
+    return success
+
+
+def ApplyCoefs(inpmap, outmap, hullspans, coefs, interpolation, blockrows, memory):
+    """Computes the corrected output band outmap = b * inpmap + a within the
+    hullspans (first and last+1 column of the rows inside, see Footprint) in
+    single streaming pass. The a, b parameters are 
+    interpolated (bilinear or bicubic) from the coefs grid (see CoefGrid) 
+    for blocks of blockrows rows only (less if the a, b blocks would not fit
+    in memory (MB)), and the input rows are read, 
+    corrected and written by the same blocks, so no full size raster is 
+    held in memory or written except the output (FCELL).
+    Returns the (min, mean, max) of a and b within the hull."""
+    region_dict = grass.region()
+    rows = int(region_dict['rows'])
+    cols = int(region_dict['cols'])
+    # a, b blocks and the temporary arrays
+    blockrows = min(blockrows, gridcorrel.MemoryRows(memory, cols, 4))
+    rowweights = gridcorrel.AxisWeights(rows, coefs.shape[1], interpolation)
+    colweights = gridcorrel.AxisWeights(cols, coefs.shape[2], interpolation)
+    inp = RasterRow(inpmap)
+    inp.open('r')
+    out = RasterRow(outmap)
+    out.open('w', mtype = 'FCELL', overwrite = True)
+    outrow = Buffer((cols,), mtype = 'FCELL')
+    colindex = np.arange(cols)
+    # a, b statistics (count, sum, min, max)
+    stats = [[0, 0.0, np.inf, -np.inf], [0, 0.0, np.inf, -np.inf]]
+    try:
+        for start in range(0, rows, blockrows):
+            end = min(start + blockrows, rows)
+            block = gridcorrel.InterpolateGrid(coefs, rowweights, colweights, start, end)
+            for row in range(start, end):
+                ka = block[0, row - start]
+                kb = block[1, row - start]
+                inside = (colindex >= hullspans[0][row]) & (colindex < hullspans[1][row])
+                outrow[:] = np.where(inside, kb * gridcorrel.RowValues(inp, row) + ka, np.nan)
+                out.put_row(outrow)
+                for k, values in ((0, ka[inside]), (1, kb[inside])):
+                    if values.size:
+                        stats[k] = [stats[k][0] + values.size, stats[k][1] + values.sum(), min(stats[k][2], values.min()), max(stats[k][3], values.max())]
+    finally:
+        inp.close()
+        out.close()
+    return [(k_min, k_sum / k_n if k_n else np.nan, k_max) for k_n, k_sum, k_min, k_max in stats]
+
+
+def CorrectBand(inpmap, outmap, grid, grid_shape, columns, hull, hullspans, runid, gridsize, interpolator, interpolation, lambda_i, blockrows, memory):
+    """Interpolates the regression parameters stored in the grid columns (pair
+    of a and b column names) of the band inpmap and computes the corrected 
+    output band outmap within the hull (raster name hull, hullspans for the
+    grid interpolator, see Footprint). The interpolator is bspline 
+    (v.surf.bspline into rasters and r.mapcalc) or grid (CoefGrid and 
+    ApplyCoefs by blocks of blockrows rows within memory MB). Returns list
+    of the temporary maps created."""
+    inpmap_mod = inpmap.split('@')[0].replace(".", "_")
+    #variables with tmpfile names containing input name (replacing dots by underscores) and the run id
+    tmpa = "tmpa_" + inpmap_mod + "_" + runid
+    tmpb = "tmpb_" + inpmap_mod + "_" + runid
+    tmpgrid2 = "tmpgrid2_" + inpmap_mod + "_" + runid
+    tmppoints = "tmppoints_" + inpmap_mod + "_" + runid
+    acol, bcol = columns
+    if interpolator == "grid":
+        # Interpolate a, b and compute the correction in one pass by blocks of rows
+        grass.message("*** Interpolating regression parameters and creating corrected output band ***")
+        with Stage(inpmap + ": apply"):
+            coefs = CoefGrid(grid, grid_shape, columns)
+            coefstats = ApplyCoefs(inpmap, outmap, hullspans, coefs, interpolation, blockrows, memory)
+        grass.message("Output map created: " + outmap)
+        if flags['v']:
+            grass.message("*** Statistics of slope and gain ***")
+            grass.message("a (intercept): min=" + str(coefstats[0][0]) + " mean=" + str(coefstats[0][1]) + " max=" + str(coefstats[0][2]))
+            grass.message("b (slope): min=" + str(coefstats[1][0]) + " mean=" + str(coefstats[1][1]) + " max=" + str(coefstats[1][2]))
+        return []
+    else:
+        # Extract fetures with b>0 into tmpgrid2 (v.extract) (the b parameter (it is regression line slope) is empty for not-enough-valid-pixels and poor-correlation tiles, in the "good" tiles it should be always positive)
+        grass.message("*** Extracting correlation parameters ***")
+        with Stage(inpmap + ": extract"):
+            grass.run_command("v.extract", overwrite = True, input = grid, output = tmpgrid2, where = bcol + " > 0", quiet = True, type = "area")
+            # Turn the tile grid into grid of central points with the attributes a,b tranfered to it
+            # ****DEVIDEA**** This is where should occur creation of points in center of gravity of valid pixels instead, or after that, shifting the position of the central points to the center of gravity position
+            grass.run_command("v.type",  overwrite = True, input = tmpgrid2, output = tmppoints, from_type = "centroid", to_type = "point", quiet = True)
+        tmpmaps = [("raster", tmpa), ("raster", tmpb), ("vector", tmpgrid2), ("vector", tmppoints)]
+
+        # Interpolate a, b in tmppoints into rasters tmpa, tmpb (v.surf.rst/.bspline/...) within the hull
+        grass.message("*** Interpolating regression parameters ***")
+        with Stage(inpmap + ": spline"):
+            grass.message("a (intercept)")
+            grass.run_command("v.surf.bspline", input = tmppoints, raster_output = tmpa, layer = 1, column = acol, ew_step = gridsize, ns_step = gridsize, method = interpolation, lambda_i = lambda_i, mask = hull, overwrite = True)
+            grass.message("b (slope)")
+            grass.run_command("v.surf.bspline", input = tmppoints, raster_output = tmpb, layer = 1, column = bcol, ew_step = gridsize, ns_step = gridsize, method = interpolation, lambda_i = lambda_i, mask = hull, overwrite = True)
+
+    # Compute the correction using correlation formula (r.mapcalc)
+    grass.message("*** Creating corrected output band ***")
+    with Stage(inpmap + ": mapcalc"):
+        grass.mapcalc("${omap} = if(isnull(${hull}), null(), ${bmap} * ${imap} + ${amap})", omap = outmap, amap = tmpa, bmap = tmpb, imap = inpmap, hull = hull, overwrite = True)
+    grass.message("Output map created: " + outmap)
+    
+    # If verbose selected, run statistics
+    if flags['v']:
+         grass.message("*** Univariate statistics of slope and gain rasters ***")
+         grass.message("a (intercept)")
+         grass.run_command("r.univar", map = tmpa)
+         grass.message("b (slope)")
+         grass.run_command("r.univar", map = tmpb)
+    return tmpmaps
+
+
+def Finish(tmpmaps, success, inpmaps, outmaps, outgroup):
+    """Removes the temporary maps (list of (type, name)) unless the -k flag
+    is set, copies the input bands without any tile with valid correlation
+    (success count 0) to the output as is and creates the output group."""
+    # Remove all tmp* maps (tmpmask, tmpgrid, tmpgrid2, tmphull, ...), 
+    grass.message("*** Cleanup ***")
+    if not flags['k']:
+        with Stage("cleanup"):
+            grass.run_command("g.remove", flags = 'f', type = ",".join([t for t, name in tmpmaps]), name = ",".join([name for t, name in tmpmaps]), quiet = True)
+        grass.message("Temporary files removed")
+
+    for k in range(len(inpmaps)):
+        if success[k] == 0:
+            grass.message("*** WARNING: There were no tiles with valid correlation (" + inpmaps[k] + ") ***")
+            grass.message("The source band will be copied to corrected output as is. This is probably not the result you expect, to get corrected band, try to decrease the minimal correlation (or set minrfloor for the adaptive mode) or change other parameters.") 
+            grass.mapcalc("${omap} = ${imap}", omap = outmaps[k], imap = inpmaps[k], overwrite = True) 
+
+    if outgroup:
+        grass.run_command("i.group", group = outgroup, input = ",".join(outmaps), quiet = True)
+        grass.message("Output group created: " + outgroup)
+    REPORT['tilesprocessed'] = success
+    REPORT['status'] = "ok"
+
+
 def main():
     "The main program."
+    if options['report']:
+        atexit.register(WriteReport, options['report'])
     #Variables
-    refmap = options['reference']
-    inpmap = options['input']
-    inpmap_mod = inpmap.replace(".", "_")
-    outmap = options['output']
-    gridsize = int(options['gridsize'])
+    # input, reference and output may be lists of bands or imagery groups, the bands are processed all at once
+    refmaps = BandList(options['reference'])
+    inpmaps = BandList(options['input'])
+    gridsizes = [int(size) for size in options['gridsize'].split(',')]
+    # More grid sizes is the grid size sweep mode, no output is created then
+    if len(gridsizes) == 1 and not options['output']:
+        grass.fatal("Required parameter <output> not set")
+    outmaps = options['output'].split(',') if options['output'] else list(inpmaps)
+    outgroup = None
+    if len(outmaps) == 1 and len(inpmaps) > 1:
+        # Single output name for more bands is the output group name, the bands are named <output>.1, <output>.2, ...
+        outgroup = outmaps[0]
+        outmaps = [outgroup + "." + str(k + 1) for k in range(len(inpmaps))]
+    # With the model there is no regression, so no reference is needed
+    modelfile = options['model']
+    if not modelfile and not refmaps:
+        grass.fatal("Required parameter <reference> not set")
+    if (not modelfile and len(refmaps) != len(inpmaps)) or len(outmaps) != len(inpmaps):
+        grass.fatal("Number of input (" + str(len(inpmaps)) + "), reference (" + str(len(refmaps)) + ") and output (" + str(len(outmaps)) + ") bands differ.")
+    nbands = len(inpmaps)
+    REPORT.update({'inputs': inpmaps, 'references': refmaps, 'outputs': outmaps, 'parameters': dict(options), 'flags': dict(flags)})
+    gridsize = gridsizes[0]
     minpixels = int(options['pixels'])
     masks = options['masks']
+    pimask = options['pimask']
     minr = float(options['minr']) # Note: it is R, not R squared.
-    interpolation = options['interpolation']
+    interpolation = options['interpolation'] or "bicubic"
     lambda_i = float(options['lambda_i'])
+    interpolator = options['interpolator']
+    blockrows = int(options['blockrows'])
+    memory = int(options['memory'])
     method = options['regression']
-    #variables with tmpfile names containing input name (replacing dots by underscores) 
-    tmpa = "tmpa_" + inpmap_mod
-    tmpb = "tmpb_" + inpmap_mod
-    tmpmask = "tmpmask" #not using the inmap in filename, because the filename is used in other functions, so it is easier to have it static. *** Neded to take care it is done in a way not causing problem with cyclic/repeated runs of the program over different input files. Even more so in possible parralel processing ***
-    #tmpmaskareas = "tmpmaskareas" + inpmap_mod # IS IT USED ANYWHERE?
-    tmpgrid = "tmpgrid_" + inpmap_mod
-    tmpgrid2 = "tmpgrid2_" + inpmap_mod
-    #tmpcentroids = "tmpcentroids" + inpmap_mod # IS IT USED ANYWHERE?
-    tmppoints = "tmppoints_" + inpmap_mod
-    tmphull = "tmphull_" + inpmap_mod
-    tmpreg = "tmpreg_" + inpmap_mod
-    tmpvect = "tmpvect_" + inpmap_mod
+    engine = options['engine']
+    nprocs = int(options['nprocs'])
+    cache = options['cache']
+    if cache and engine != "array":
+        grass.warning("The tile statistics cache works with the array engine only, using engine=array.")
+        engine = "array"
+    minrfloor = float(options['minrfloor']) if options['minrfloor'] else None
+    mintiles = int(options['mintiles'])
+    sample = int(options['sample']) if options['sample'] else None
+    seed = int(options['seed'])
+    if sample is not None and sample <= minpixels:
+        grass.fatal("sample (" + str(sample) + ") must be greater than pixels (" + str(minpixels) + "), no tile would be accepted.")
+    if sample and engine != "array":
+        grass.warning("The pixel sample works with the array engine only, using engine=array.")
+        engine = "array"
+    if minrfloor is not None and minrfloor >= minr:
+        grass.warning("minrfloor is not lower than minr, the adaptive mode is off.")
+        minrfloor = None
+    if minrfloor is not None and engine != "array":
+        grass.warning("The adaptive minr works with the array engine only, using engine=array.")
+        engine = "array"
+    if method in gridcorrel.ROBUST_METHODS and engine != "array":
+        grass.warning("The " + method + " regression works with the array engine only, using engine=array.")
+        engine = "array"
+    if cache and not os.path.isdir(cache):
+        os.makedirs(cache)
+    # Run id unique for the script run (node name and process id) is part of all temporary map names, so that more runs can go at once in one mapset
+    runid = grass.append_node_pid("atcor")
+    tmpmask = "tmpmask_" + runid
+    tmpgrid = "tmpgrid_" + runid
+    tmphull = "tmphull_" + runid
+    tmpfoot = "tmpfoot_" + runid
+    columns = CoefColumns(nbands)
 
     # Print mapset path
     grass.message("MAPSET path:")
     grass.run_command("g.gisenv", get = "GISDBASE,LOCATION_NAME,MAPSET", sep = '/')
     # Print input file name
-    grass.message("*** Processing raster map " + inpmap + " ***")
-    # Save existing region to restore it at the end
-    grass.run_command("g.region", save = tmpreg, overwrite = True)
-    # Build the MASK
-    if not masks or not masks.strip():
-        grass.warning("No mask layers supplied! MASK will be created only based on valid (non-null) pixels of input and reference maps.")
-    MkMask(masks, inpmap, refmap)
-    grass.run_command("r.mask", overwrite = True, raster = tmpmask, maskcats = "1")
+    grass.message("*** Processing raster map " + ", ".join(inpmaps) + " ***")
+    if modelfile:
+        modelbands = [int(band) - 1 for band in options['modelbands'].split(',')] if options['modelbands'] else list(range(nbands))
+        if len(modelbands) != nbands:
+            grass.fatal("Number of input bands (" + str(nbands) + ") and model bands (" + str(len(modelbands)) + ") differ.")
+        with Stage("model"):
+            success = ApplyModel(modelfile, inpmaps, outmaps, modelbands, tmpfoot, options['interpolation'], blockrows, memory)
+        Finish([("raster", tmpfoot)], success, inpmaps, outmaps, outgroup)
+        return 0
+    # Build the mask
+    if (not masks or not masks.strip()) and not pimask:
+        grass.warning("No mask layers supplied! Mask will be created only based on valid (non-null) pixels of input and reference maps.")
+    with Stage("mask"):
+        MkMask(tmpmask, masks, inpmaps, refmaps, pimask)
+    tmpmaps = [("raster", tmpmask)]
+
+    if len(gridsizes) > 1:
+        with Stage("sweep"):
+            GridSweep(inpmaps, refmaps, tmpmask, gridsizes, minpixels, minr, memory)
+        if not flags['k']:
+            grass.run_command("g.remove", flags = 'f', type = "raster", name = tmpmask, quiet = True)
+        REPORT['status'] = "ok"
+        return 0
+
+    # Journal of the finished tiles and bands, with -r those of the interrupted run are reused
+    journal = OpenJournal(JournalFile(inpmaps, refmaps, ",".join([m for m in (masks, pimask) if m]), outmaps, engine), flags['r'])
+    if flags['r'] and not journal:
+        grass.message("Nothing to resume, no journal of an interrupted run with the same inputs and parameters found.")
 
     # Create the grid
-    MkGrid(tmpgrid, gridsize)
-    # Add attribute table columns to store regression parameters a, b
-    grass.run_command("v.db.addcolumn", map = tmpgrid, columns = "a double precision, b double precision")
+    with Stage("grid"):
+        grid_shape = MkGrid(tmpgrid, gridsize)
+        tmpmaps.append(("vector", tmpgrid))
+        # Add attribute table columns to store regression parameters a, b
+        # and the diagnostic columns (valid pixels count, R and the reason of rejecting the tile)
+        grass.run_command("v.db.addcolumn", map = tmpgrid, columns = ", ".join(["n integer"] + [a + " double precision, " + b + " double precision" for a, b in columns] + [r + " double precision, " + reject + " varchar(10)" for r, reject in DiagColumns(nbands)]))
     # Compute the 'reference = a + b * input' regression per grid tiles
-    success = GridRegression(tmpgrid, inpmap, refmap, minpixels, minr, method)
-    # Restore original region
-    grass.run_command("g.region", region = tmpreg)
+    with Stage("regression"):
+        if engine == "array":
+            cachefiles = MomentsCache(cache, inpmaps, refmaps, ",".join([m for m in (masks, pimask) if m]), grid_shape, sample, seed) if cache else None
+            success = GridRegressionArray(tmpgrid, grid_shape, inpmaps, refmaps, columns, tmpmask, minpixels, minr, method, nprocs, memory, cachefiles, minrfloor, mintiles, sample, seed, journal)
+        else:
+            # Input bands with the masked out pixels set to null (the regression modules then skip them)
+            xmasked = []
+            for inpmap in inpmaps:
+                xmasked.append("tmpx_" + inpmap.split('@')[0].replace(".", "_") + "_" + runid)
+                grass.mapcalc("${omap} = if(${mask} == 1, ${imap}, null())", omap = xmasked[-1], mask = tmpmask, imap = inpmap, overwrite = True)
+                tmpmaps.append(("raster", xmasked[-1]))
+            success = GridRegression(tmpgrid, grid_shape, inpmaps, xmasked, refmaps, columns, tmpmask, minpixels, minr, method, nprocs, journal)
+    if options['savemodel']:
+        with Stage("savemodel"):
+            SaveModel(options['savemodel'], tmpgrid, grid_shape, inpmaps, refmaps, columns, gridsize, method, minr, minpixels, interpolation)
+
+    # Bands corrected by the interrupted run (the output map still present)
+    donebands = set([entry['band'] for entry in journal if 'band' in entry])
+    bands = []
+    for k in range(nbands):
+        if success[k] > 0 and outmaps[k] in donebands and grass.find_file(outmaps[k], element = "cell", mapset = ".")['file']:
+            grass.message("Resuming: " + outmaps[k] + " corrected by the interrupted run.")
+        elif success[k] > 0:
+            bands.append(k)
+    REPORT['resumed_bands'] = nbands - len(bands) - success.count(0)
+
+    if bands:
+        # Create hull of the overlap of ref/input layers valid pixels to limit the output to (computed from the raster rows, no vector is created)
+        grass.message("*** Creating the hull of the input and reference overlap ***")
+        with Stage("hull"):
+            # create tmpfoot based on inpmap/refmap valid pixels overlap
+            MkMask(tmpfoot, "", inpmaps, refmaps)
+            tmpmaps.append(("raster", tmpfoot))
+            hullspans = Footprint(tmpfoot, memory)
+            if interpolator == "bspline":
+                # the hull raster for v.surf.bspline and r.mapcalc
+                WriteFootprint(tmphull, hullspans)
+                tmpmaps.append(("raster", tmphull))
+
+        for k in bands:
+            grass.message("*** Correcting raster map " + inpmaps[k] + " ***")
+            tmpmaps.extend(CorrectBand(inpmaps[k], outmaps[k], tmpgrid, grid_shape, columns[k], tmphull, hullspans, runid, gridsize, interpolator, interpolation, lambda_i, blockrows, memory))
+            JournalRecord({'band': outmaps[k]})
+
+    Finish(tmpmaps, success, inpmaps, outmaps, outgroup)
+    CloseJournal()
+    return 0
+
 
-    if success > 0:
-        # Extract fetures with b>0 into tmpgrid2 (v.extract) (the b parameter (it is regression line slope) is empty for not-enough-valid-pixels and poor-correlation tiles, in the "good" tiles it should be always positive)
-        grass.message("*** Extracting correlation parameters ***")
-        grass.run_command("v.extract", overwrite = True, input = tmpgrid, output = tmpgrid2, where = "b > 0", quiet = True, type = "area")
-        # Turn the tile grid into grid of central points with the attributes a,b tranfered to it
-        # ****DEVIDEA**** This is where should occur creation of points in center of gravity of valid pixels instead, or after that, shifting the position of the central points to the center of gravity position
-        grass.run_command("v.type",  overwrite = True, input = tmpgrid2, output = tmppoints, from_type = "centroid", to_type = "point", quiet = True)
-    
-        # Replace the original mask with one based on extent of overlap of ref/input layers (r.to.vect on overlap, v.hull on the result, v.to.rast->MASK on the hull)
-        grass.message("*** Replacing computed MASK ***")
-        grass.run_command("r.mask", flags='r')
-        # create tmpmask based on inpmap/refmap valid pixels overlap
-        MkMask("", inpmap, refmap)
-        # create the hull
-        grass.run_command("r.to.vect", overwrite = True, input = tmpmask, output = tmpvect, type = "area", quiet = True)
-        grass.run_command("v.hull", input = tmpvect, output = tmphull, overwrite = True, quiet = True)
-        # create the MASK
-        grass.run_command("v.to.rast", input = tmphull, output = "MASK", use = "val", overwrite = True, quiet = True)
-        grass.run_command("g.remove", flags = 'f', type = "rast,vect,vect", name = tmpmask + "," + tmpvect + "," + tmphull )
-        
-        # Interpolate a, b in tmppoints into rasters tmpa, tmpb (v.surf.rst/.bspline/...)
-        grass.message("*** Interpolating regression parameters ***")
-        grass.message("a (intercept)")
-        grass.run_command("v.surf.bspline", input = tmppoints, raster_output = tmpa, layer = 1, column = "a", ew_step = gridsize, ns_step = gridsize, method = interpolation, lambda_i = lambda_i, overwrite = True)
-        grass.message("b (slope)")
-        grass.run_command("v.surf.bspline", input = tmppoints, raster_output = tmpb, layer = 1, column = "b", ew_step = gridsize, ns_step = gridsize, method = interpolation, lambda_i = lambda_i, overwrite = True)
-    
-        # Compute the correction using correlation formula (r.mapcalc)
-        grass.message("*** Creating corrected output band ***")
-        grass.mapcalc("${omap} = ${bmap} * ${imap} + ${amap}", omap = outmap, amap = tmpa, bmap = tmpb, imap = inpmap, overwrite = True)
-        grass.message("Output map created: " + outmap)
-        
-        # If verbose selected, run statistics
-        if flags['v']:
-             grass.message("*** Univariate statistics of slope and gain rasters ***")
-             grass.message("a (intercept)")
-             grass.run_command("r.univar", map = tmpa)
-             grass.message("b (slope)")
-             grass.run_command("r.univar", map = tmpb)
-        
-        # Remove all tmp* maps (tmpgrid, tmpgrid2, tmphull, tmpmaskareas, tmpreg...), 
-        grass.message("*** Cleanup ***")
-        grass.run_command("r.mask", flags = 'r')
-        if not flags['k']:
-            grass.run_command("g.remove", flags = 'f', type = "raster,raster,raster,vector,vector,vector,vector,region", name = tmpa + "," + tmpb + "," + tmpmask + "," + tmpgrid + "," + tmpgrid2 + "," + tmppoints + "," + tmphull + "," + tmpreg )
-            grass.message("Temporary files removed")
-    else:
-        grass.message("*** WARNING: There were no tiles with valid correlation ***")
-        grass.message("The source band will be copied to corrected output as is. This is probably not the result you expect, to get corrected band, try to decrease the minimal correlation or change other parameters.") 
-        # Remove all tmp* files (tmpgrid, tmpgrid2, tmphull, tmpreg...), 
-        grass.message("*** Cleanup ***")
-        grass.run_command("r.mask", flags = 'r')
-        if not flags['k']:
-            grass.run_command("g.remove", flags = 'f', type = "raster,region", name = tmpgrid + "," + tmpreg)
-            grass.message("Temporary files removed")
-        ##### DEVIDEA: Maybe it would be practical to decrease minR automatically, ie. by 0.05 and rerun the grid computation (possibly repeating the process in a loop). That would imply to put the tasks into functions, which is needed anyway, the function main() is too complex. ######
-        grass.mapcalc("${omap} = ${imap}", omap = outmap, imap = inpmap, overwrite = True) 
-        
-    
 if __name__ == "__main__":
     options, flags = grass.parser()
     atexit.register(cleanup)
+    CountCommands()
     sys.exit(main())
@@ -59,20 +59,85 @@
 #% description: Size of moving window circular area to filter out few pixel-sized clouds and holes. The value must be an odd number >= 3.
 #% answer: 9
 #%End
-
-
-
+#%Option
+#% key: engine
+#% type: string
+#% required: no
+#% multiple: no
+#% options: modules,array
+#% description: Computation: modules - r.neighbors and r.buffer, array - in memory by blocks of rows (binary masks only).
+#% answer: modules
+#%End
+#%Option
+#% key: memory
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Maximum memory (MB) for the blocks of rows processed at once (engine=array).
+#% answer: 1024
+#%End
 
 import sys
-import os
 import atexit
 
-from grass.script import parser, run_command
+import numpy as np
+from grass.script import parser, run_command, append_node_pid, region, fatal
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+import gridcorrel
+
+# temporary maps of the modules engine, removed at exit if the run fails
+TMPMAPS = []
 
 def cleanup():
-    pass
+    if TMPMAPS:
+        run_command("g.remove", flags = 'f', type = "raster", name = ",".join(TMPMAPS), quiet = True)
+
+def BufferArray(inmap, clmask, output, size, buffsize, memory):
+    """Mode filter and buffer of the inmap mask computed in memory by blocks
+    of rows (with overlap of the filter and buffer size), writing only the
+    clmask and output maps. The same result as the modules engine for masks
+    with values 0 (cloud) and 1 (or other non-zero values)."""
+    region_dict = region()
+    rows = int(region_dict['rows'])
+    cols = int(region_dict['cols'])
+    nsres = float(region_dict['nsres'])
+    ewres = float(region_dict['ewres'])
+    # overlap of the blocks: the filter radius plus the buffer radius in rows
+    halo = size // 2 + int(buffsize // nsres) + 1
+    # about 12 arrays of the block size are held at once
+    blockrows = max(gridcorrel.MemoryRows(memory, cols, 12) - 2 * halo, 1)
+    inp = RasterRow(inmap)
+    inp.open('r')
+    clout = RasterRow(clmask)
+    clout.open('w', mtype = 'CELL', overwrite = True)
+    out = RasterRow(output)
+    out.open('w', mtype = 'CELL', overwrite = True)
+    outrow = Buffer((cols,), mtype = 'CELL')
+    try:
+        for start in range(0, rows, blockrows):
+            end = min(start + blockrows, rows)
+            first = max(start - halo, 0)
+            last = min(end + halo, rows)
+            # Clean small clouds
+            cleared = gridcorrel.CircleMode(gridcorrel.ReadRows(inp, first, last), size)
+            # Buffer clouds (the output is 0 within the buffsize from cloud pixels, 1 elsewhere)
+            buffered = gridcorrel.BufferMask(cleared == 0, buffsize, nsres, ewres)
+            for row in range(start, end):
+                outrow[:] = np.where(np.isnan(cleared[row - first]), gridcorrel.CELL_NULL, cleared[row - first])
+                clout.put_row(outrow)
+            for row in range(start, end):
+                outrow[:] = ~buffered[row - first]
+                out.put_row(outrow)
+    finally:
+        inp.close()
+        clout.close()
+        out.close()
 
 def main():
+    if int(options['circlesize']) < 3 or int(options['circlesize']) % 2 == 0:
+        fatal("circlesize must be an odd number >= 3, got " + options['circlesize'] + ".")
     # define output names
     # clmask - cleared mask
     if options['clmask']:
@@ -84,6 +149,14 @@ def main():
     	output = options['output']
     else:	
     	output = options['input'] + "_buff" + options['buffsize']
+    if options['engine'] == "array":
+        BufferArray(options['input'], clmask, output, int(options['circlesize']), float(options['buffsize']), int(options['memory']))
+        return 0
+
+    # temporary maps names unique for the run (more runs may go at once in one mapset)
+    invmask = append_node_pid("invmask")
+    buffinvmask = append_node_pid("buffinvmask")
+    TMPMAPS.extend([invmask, buffinvmask])
 
     # Clean small clouds
     run_command("r.neighbors",
@@ -96,22 +169,22 @@ def main():
 
     # Invert mask before buffering
     run_command("r.mapcalc",
-                expression = "invmask = " + clmask + " == 0",
+                expression = invmask + " = " + clmask + " == 0",
                 region = "current", 
                 overwrite = True)
 
     # Buffer clouds in inverted mask
     run_command("r.buffer",
                 flags = 'z',
-                input = "invmask",
-                output = "buffinvmask",
+                input = invmask,
+                output = buffinvmask,
                 distances = int(options['buffsize']),
                 units = "meters", 
                 overwrite = True)
 
     # Create output (inverting back the buffer output, ie. setting nulls to 1)
     run_command("r.mapcalc",
-    	        expression = output + " = isnull(buffinvmask)",
+    	        expression = output + " = isnull(" + buffinvmask + ")",
                 region = "current",
                 overwrite = True)
 
@@ -119,8 +192,8 @@ def main():
     run_command("g.remove",
                 flags = 'f',
                 type = "raster",
-                name = "invmask,buffinvmask")
-
+                name = invmask + "," + buffinvmask)
+    del TMPMAPS[:]
 
     return 0
 
@@ -0,0 +1,27 @@
+# The scripts and gridcorrel.py are in the directory above the tests, the
+# scripts are loaded against fakegrass.py (see the fakegrass fixture).
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+
+import pytest
+
+SCRIPTDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SCRIPTDIR not in sys.path:
+    sys.path.insert(0, SCRIPTDIR)
+
+
+@pytest.fixture
+def fakegrass(tmpdir):
+    """fakegrass.py installed in place of the grass modules for the test, the
+    modules imported before put back in the end."""
+    import fakegrass
+    saved = dict([(name, module) for name, module in sys.modules.items() if name == "grass" or name.startswith("grass.")])
+    fakegrass.Install(str(tmpdir.mkdir("fakegrass")))
+    yield fakegrass
+    for name in [name for name in sys.modules if name == "grass" or name.startswith("grass.")]:
+        del sys.modules[name]
+    sys.modules.update(saved)
@@ -0,0 +1,126 @@
+# L2A_gdal_atcor.py against the GRASS path of L2A_grass_atcor.sh
+# (i.atcor.mask.py and i.grid.correl.atcor.py engine=array interpolator=grid,
+# run against fakegrass.py) on one small synthetic scene.
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from conftest import SCRIPTDIR
+
+gdal = pytest.importorskip("osgeo.gdal")
+
+ROWS = COLS = 150
+RES = 20.0
+NORTH = 5600000.0
+WEST = 500000.0
+NBANDS = 3
+# the same parameters for both paths
+PARAMETERS = {'gridsize': "1000", 'pixels': "300", 'minr': "0.88"}
+
+
+def Scene(seed):
+    """Returns dict of the arrays of the input and reference scene as
+    L2A_vrt-img.sh creates them: raw UInt16 bands (0 for no-data), SCL,
+    NDMI and cloud mask (0 - cloud, 1 - clear)."""
+    rng = np.random.RandomState(seed)
+    v, u = np.mgrid[0:ROWS, 0:COLS] / float(ROWS)
+    patches = (np.sin(7 * u) * np.cos(5 * v) > 0).astype(int)
+    scene = {'bands': [], 'refbands': []}
+    for k in range(NBANDS):
+        x = rng.uniform(300, 3000, 2)[patches] + rng.normal(0, 150, (ROWS, COLS))
+        y = 100 * np.sin(3 * u + k) + (1 + 0.1 * np.cos(2 * v + k)) * x + rng.normal(0, 30, (ROWS, COLS))
+        # no-data corner of the input and no-data patch of the reference
+        x[u + v < 0.2] = 0
+        y[100:110, 60:75] = 0
+        scene['bands'].append(np.round(x).astype(np.uint16))
+        scene['refbands'].append(np.round(y).astype(np.uint16))
+    scene['scl'] = np.where(patches == 1, 4, 5).astype(np.uint8)
+    scene['refscl'] = scene['scl'].copy()
+    scene['refscl'][rng.rand(ROWS, COLS) < 0.05] = 6
+    # no-data strip of the input (SCL 0, masked out by the MASK in L2A_grass_atcor.sh)
+    scene['scl'][:, :4] = 0
+    scene['ndmi'] = rng.uniform(-0.3, 0.2, (ROWS, COLS)).astype(np.float32)
+    scene['refndmi'] = (scene['ndmi'] + rng.normal(0, 0.03, (ROWS, COLS))).astype(np.float32)
+    scene['cloud'] = np.ones((ROWS, COLS), dtype = np.uint8)
+    scene['cloud'][(u - 0.6)**2 + (v - 0.4)**2 < 0.01] = 0
+    scene['cloud'][rng.rand(ROWS, COLS) < 0.002] = 0
+    return scene
+
+
+def WriteRaster(filename, bands, datatype, driver = "HFA", nodata = None, scale = None, offset = None):
+    dataset = gdal.GetDriverByName(driver).Create(filename, COLS, ROWS, len(bands), datatype)
+    dataset.SetGeoTransform((WEST, RES, 0.0, NORTH, 0.0, -RES))
+    for k, values in enumerate(bands):
+        band = dataset.GetRasterBand(k + 1)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        if scale is not None:
+            band.SetScale(scale)
+            band.SetOffset(offset)
+        band.WriteArray(values)
+    dataset.FlushCache()
+
+
+def WriteScene(scene, base, prefix):
+    """Writes the files of the scene (the arrays of prefix) as L2A_vrt-img.sh
+    names them, with the scale and offset of the bands set as on its .vrt."""
+    WriteRaster(base + "_20m.img", scene[prefix + 'bands'], gdal.GDT_UInt16, nodata = 0, scale = 0.0001, offset = -0.1)
+    WriteRaster(base + "_SCL_20m.tif", [scene[prefix + 'scl']], gdal.GDT_Byte, driver = "GTiff")
+    gdal.Translate(base + "_SCL_20m.vrt", base + "_SCL_20m.tif", format = "VRT")
+    WriteRaster(base + "_ndmi_20m.img", [scene[prefix + 'ndmi']], gdal.GDT_Float32)
+    if prefix == "":
+        WriteRaster(base + "_cloud_mask_20m.img", [scene['cloud']], gdal.GDT_Byte)
+
+
+def GrassPath(fakegrass, scene, regression):
+    """Returns the corrected bands of the GRASS path: the maps imported as
+    r.in.gdal does (raw values, the no-data of the bands null), the MASK of
+    the SCL 0 applied to every map, i.atcor.mask.py and
+    i.grid.correl.atcor.py run with the ATCOR_PARMS of L2A_grass_atcor.sh."""
+    fakegrass.SetRegion(NORTH, NORTH - ROWS * RES, WEST + COLS * RES, WEST, RES)
+    masked = scene['scl'] == 0
+    maps = {}
+    for name in ('bands', 'refbands', 'scl', 'refscl', 'ndmi', 'refndmi', 'cloud'):
+        layers = scene[name] if name in ('bands', 'refbands') else [scene[name]]
+        maps[name] = []
+        for k, values in enumerate(layers):
+            values = values.astype(np.float64)
+            if name in ('bands', 'refbands'):
+                values[values == 0] = np.nan
+            values[masked] = np.nan
+            maps[name].append(name + "." + str(k + 1))
+            fakegrass.StoreMap(maps[name][-1], values, 'DCELL' if name in ('ndmi', 'refndmi') else 'CELL')
+    fakegrass.LoadScript(os.path.join(SCRIPTDIR, "i.atcor.mask.py"), {'scl': maps['scl'][0], 'refscl': maps['refscl'][0], 'ndmi': maps['ndmi'][0],
+                                                                        'refndmi': maps['refndmi'][0], 'cloud': maps['cloud'][0], 'output': "pimask"}).main()
+    outputs = ["output." + str(k + 1) for k in range(NBANDS)]
+    options = {'input': ",".join(maps['bands']), 'reference': ",".join(maps['refbands']), 'output': ",".join(outputs), 'pimask': "pimask",
+               'engine': "array", 'interpolator': "grid", 'regression': regression}
+    options.update(PARAMETERS)
+    fakegrass.LoadScript(os.path.join(SCRIPTDIR, "i.grid.correl.atcor.py"), options, {'k': True}).main()
+    return np.array([fakegrass.MapValues(name)[0] for name in outputs])
+
+
+@pytest.mark.parametrize("regression", ["orthogonal", "theil_sen"])
+def test_same_as_grass_path(fakegrass, tmpdir, regression):
+    scene = Scene(1)
+    WriteScene(scene, str(tmpdir.join("input")), "")
+    WriteScene(scene, str(tmpdir.join("reference")), "ref")
+    output = str(tmpdir.join("output.tif"))
+    subprocess.check_call([sys.executable, os.path.join(SCRIPTDIR, "L2A_gdal_atcor.py"), str(tmpdir.join("input_20m.img")), str(tmpdir.join("reference_20m.img")),
+                           "-o", output, "--format", "GTiff", "--regression", regression]
+                          + ["--" + name + "=" + value for name, value in sorted(PARAMETERS.items())])
+    dataset = gdal.Open(output)
+    gdalbands = np.array([dataset.GetRasterBand(k + 1).ReadAsArray() for k in range(NBANDS)], dtype = np.float64)
+    dataset = None
+    grassbands = GrassPath(fakegrass, scene, regression)
+    # corrected, not copied as is
+    assert np.nanmax(np.abs(gdalbands - np.array(scene['bands']))) > 1
+    assert np.array_equal(np.isnan(gdalbands), np.isnan(grassbands))
+    np.testing.assert_allclose(gdalbands, grassbands, rtol = 1e-5)
@@ -0,0 +1,250 @@
+# gridcorrel.py functions against their brute-force equivalents.
+
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+import gridcorrel
+
+
+def BruteTheilSen(x, y):
+    """Median of the slopes of all the pairs with different x (O(n^2)), the
+    intercept from the medians as scipy.stats.theilslopes."""
+    i, j = np.triu_indices(x.size, 1)
+    dx = x[j] - x[i]
+    keep = dx != 0
+    b = np.median((y[j][keep] - y[i][keep]) / dx[keep])
+    return np.median(y) - b * np.median(x), b
+
+
+def BruteInversions(values):
+    i, j = np.triu_indices(values.size, 1)
+    inverted = values[j] < values[i]
+    return int(inverted.sum()), set(zip(i[inverted], j[inverted]))
+
+
+@pytest.mark.parametrize("n", [50, 400, 1500])
+def test_theilsen_random(n):
+    rng = np.random.RandomState(n)
+    x = rng.uniform(0, 0.4, n)
+    y = 0.01 + 1.1 * x + rng.standard_t(2, n) * 0.01
+    np.testing.assert_allclose(gridcorrel.TheilSen(x, y), BruteTheilSen(x, y), rtol = 1e-9, atol = 1e-12)
+
+
+@pytest.mark.parametrize("n", [60, 500, 1200])
+def test_theilsen_ties(n):
+    # quantized reflectance: many equal x, equal y and equal slopes
+    rng = np.random.RandomState(n)
+    x = rng.randint(1, 30, n).astype(np.float64)
+    y = np.round(2 * x + rng.normal(0, 2, n))
+    np.testing.assert_allclose(gridcorrel.TheilSen(x, y), BruteTheilSen(x, y), rtol = 1e-9, atol = 1e-12)
+
+
+def test_theilsen_even_and_odd_slopes():
+    # the median of the even number of slopes is the mean of the middle two
+    for n in (4, 5, 160, 161):
+        rng = np.random.RandomState(n)
+        x = rng.uniform(0, 1, n)
+        y = rng.uniform(0, 1, n)
+        np.testing.assert_allclose(gridcorrel.TheilSen(x, y), BruteTheilSen(x, y), rtol = 1e-9, atol = 1e-12)
+
+
+def test_theilsen_exact_line():
+    x = np.arange(300, dtype = np.float64)
+    a, b = gridcorrel.TheilSen(x, 3 - 0.5 * x)
+    assert a == pytest.approx(3)
+    assert b == pytest.approx(-0.5)
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize("x, y", [([], []), ([2.0], [1.0]), ([2.0] * 50, list(range(50)))])
+def test_theilsen_degenerate(x, y):
+    # no pair with different x: empty input, single point, all x equal
+    a, b = gridcorrel.TheilSen(np.array(x, dtype = np.float64), np.array(y, dtype = np.float64))
+    assert np.isnan(a) and np.isnan(b)
+
+
+def test_strict_inversions():
+    rng = np.random.RandomState(0)
+    for n in (1, 2, 7, 64, 333):
+        values = rng.randint(0, 10, n)
+        count, pairs = BruteInversions(values)
+        assert gridcorrel.StrictInversions(values) == count
+        listed, i, j = gridcorrel.StrictInversions(values, pairs = True)
+        assert listed == count
+        assert set(zip(i, j)) == pairs
+        assert len(i) == count
+
+
+def test_slopes_below_and_between():
+    rng = np.random.RandomState(1)
+    x = np.sort(rng.randint(0, 15, 200).astype(np.float64))
+    y = np.round(x + rng.normal(0, 3, 200))
+    i, j = np.triu_indices(x.size, 1)
+    keep = x[j] != x[i]
+    slopes = (y[j][keep] - y[i][keep]) / (x[j][keep] - x[i][keep])
+    # the thresholds exact in binary, so the slopes equal to them are counted exactly
+    for t in (-1.0, 0.0, 0.5, 1.0, 1.25, 10.0):
+        assert gridcorrel.SlopesBelow(x, y, t) == int((slopes <= t).sum())
+        assert gridcorrel.SlopesBelow(x, y, t, strict = True) == int((slopes < t).sum())
+    between = gridcorrel.SlopesBetween(x, y, 0.5, 1.5)
+    np.testing.assert_allclose(np.sort(between), np.sort(slopes[(slopes > 0.5) & (slopes < 1.5)]))
+
+
+def WeightedOrthogonal(x, y, weights):
+    """Orthogonal regression of the weighted points from the principal axis
+    of the weighted covariance matrix."""
+    meanx = np.average(x, weights = weights)
+    meany = np.average(y, weights = weights)
+    covariance = np.cov(np.array([x - meanx, y - meany]), aweights = weights, bias = True)
+    axis = np.linalg.eigh(covariance)[1][:, 1]
+    b = axis[1] / axis[0]
+    return meany - b * meanx, b
+
+
+def BruteRobust(x, y, method, iterations = 10, tolerance = 1e-6):
+    """The iteratively reweighted orthogonal regression of RobustFit for a
+    single tile, the scale from np.median."""
+    a, b = WeightedOrthogonal(x, y, np.ones(x.size))
+    for iteration in range(iterations):
+        residuals = np.abs(y - a - b * x) / np.sqrt(1 + b * b)
+        if iteration < 3:
+            scale = max(1.4826 * np.median(residuals), 1e-12 * (1 + abs(a)))
+        u = residuals / scale
+        if method == "huber" or iteration < 3:
+            c = gridcorrel.ROBUST_METHODS['huber']
+            weights = np.where(u <= c, 1.0, c / np.maximum(u, c))
+        else:
+            c = gridcorrel.ROBUST_METHODS['tukey']
+            weights = np.where(u < c, (1 - (u / c) ** 2) ** 2, 0.0)
+        newa, newb = WeightedOrthogonal(x, y, weights)
+        change = max(abs(newa - a), abs(newb - b))
+        a, b = newa, newb
+        if change <= tolerance and (method == "huber" or iteration >= 3):
+            break
+    return a, b
+
+
+def test_tile_medians():
+    rng = np.random.RandomState(2)
+    tiles = rng.randint(0, 12, 3000)
+    tiles[tiles == 5] = 6
+    values = rng.normal(0, 1, 3000)
+    medians = gridcorrel.TileMedians(tiles, values, 12)
+    for tile in range(12):
+        if tile == 5:
+            assert np.isnan(medians[tile])
+        else:
+            assert medians[tile] == pytest.approx(np.median(values[tiles == tile]), abs = 1e-10)
+
+
+@pytest.mark.parametrize("method", sorted(gridcorrel.ROBUST_METHODS))
+def test_robust_fit(method):
+    rng = np.random.RandomState(3)
+    ntiles = 6
+    tiles = rng.randint(0, ntiles - 1, 4000)
+    x = rng.uniform(0.02, 0.4, tiles.size)
+    y = 0.01 * tiles + (1 + 0.05 * tiles) * x + rng.normal(0, 0.003, tiles.size)
+    # changed pixels
+    changed = rng.rand(tiles.size) < 0.1
+    y[changed] += rng.uniform(0.05, 0.2, changed.sum())
+    a, b = gridcorrel.RobustFit(tiles, x, y, ntiles, method)
+    for tile in range(ntiles - 1):
+        pixels = tiles == tile
+        np.testing.assert_allclose((a[tile], b[tile]), BruteRobust(x[pixels], y[pixels], method), atol = 1e-5)
+        # closer to the true line than the orthogonal regression of all the pixels
+        assert abs(b[tile] - (1 + 0.05 * tile)) < abs(WeightedOrthogonal(x[pixels], y[pixels], np.ones(pixels.sum()))[1] - (1 + 0.05 * tile))
+    # the tile without pixels
+    assert np.isnan(a[ntiles - 1]) and np.isnan(b[ntiles - 1])
+
+
+def test_sample_tiles():
+    rows, cols, grid_rows, grid_cols, sample = 120, 90, 4, 3, 200
+    rng = np.random.RandomState(4)
+    valid = rng.rand(rows, cols) < 0.7
+    # the tile with fewer valid pixels than the sample
+    valid[:30, :30] &= rng.rand(30, 30) < 0.1
+    selected = gridcorrel.SampleTiles(valid, rows, cols, grid_rows, grid_cols, sample, 7)
+    assert not (selected & ~valid).any()
+    tiles = gridcorrel.TileIndex(rows, cols, grid_rows, grid_cols)
+    counts = np.bincount(tiles[selected], minlength = grid_rows * grid_cols)
+    np.testing.assert_array_equal(counts, np.minimum(np.bincount(tiles[valid], minlength = grid_rows * grid_cols), sample))
+    # deterministic for the seed, other seed gives other sample
+    np.testing.assert_array_equal(selected, gridcorrel.SampleTiles(valid, rows, cols, grid_rows, grid_cols, sample, 7))
+    assert (selected != gridcorrel.SampleTiles(valid, rows, cols, grid_rows, grid_cols, sample, 8)).any()
+    # the same by the blocks of whole tile rows started at any block (as on resume of the journal)
+    for blockrows in (30, 60):
+        for start, end in gridcorrel.TileRowBlocks(rows, grid_rows, blockrows):
+            np.testing.assert_array_equal(gridcorrel.SampleTiles(valid[start:end], rows, cols, grid_rows, grid_cols, sample, 7, start), selected[start:end])
+
+
+def test_hull_spans():
+    spatial = pytest.importorskip("scipy.spatial")
+    rng = np.random.RandomState(5)
+    rows, cols = 60, 80
+    v, u = np.mgrid[0:rows, 0:cols]
+    for trial in range(5):
+        cy, cx = rng.uniform(10, 50), rng.uniform(10, 70)
+        valid = ((v - cy) / rng.uniform(5, 30)) ** 2 + ((u - cx) / rng.uniform(5, 30)) ** 2 < 1
+        valid |= rng.rand(rows, cols) < 0.002
+        first, last = gridcorrel.RowExtents(valid)
+        start, end = gridcorrel.HullSpans(first, last, cols)
+        # the pixel centers inside the hull of the corners of the valid pixels
+        vrows, vcols = np.nonzero(valid)
+        corners = np.concatenate([np.column_stack((vcols + dx, vrows + dy)) for dx in (0, 1) for dy in (0, 1)])
+        inside = spatial.Delaunay(corners).find_simplex(np.column_stack((u.ravel() + 0.5, v.ravel() + 0.5))) >= 0
+        np.testing.assert_array_equal((u >= start[:, np.newaxis]) & (u < end[:, np.newaxis]), inside.reshape(rows, cols))
+
+
+def BruteCircleMode(mask, size):
+    """Mode of the circular neighbourhood of every pixel (0 for equal counts,
+    NaN without any valid pixel), pixel by pixel."""
+    radius = size // 2
+    rows, cols = mask.shape
+    result = np.full(mask.shape, np.nan)
+    for row in range(rows):
+        for col in range(cols):
+            ones = total = 0
+            for dy in range(-radius, radius + 1):
+                for dx in range(-radius, radius + 1):
+                    if dx * dx + dy * dy <= radius * radius and 0 <= row + dy < rows and 0 <= col + dx < cols and not np.isnan(mask[row + dy, col + dx]):
+                        total += 1
+                        ones += mask[row + dy, col + dx] != 0
+            if total:
+                result[row, col] = 1.0 if 2 * ones > total else 0.0
+    return result
+
+
+@pytest.mark.parametrize("size", [3, 5, 9])
+def test_circle_mode(size):
+    rng = np.random.RandomState(size)
+    mask = (rng.rand(30, 25) < 0.6).astype(np.float64)
+    mask[rng.rand(30, 25) < 0.2] = np.nan
+    mask[10:20, 5:15] = np.nan
+    np.testing.assert_array_equal(gridcorrel.CircleMode(mask, size), BruteCircleMode(mask, size))
+
+
+@pytest.mark.parametrize("distance, nsres, ewres", [(300, 20, 20), (300, 20, 10), (45, 10, 20), (0, 20, 20)])
+def test_buffer_mask(distance, nsres, ewres):
+    ndimage = pytest.importorskip("scipy.ndimage")
+    rng = np.random.RandomState(6)
+    source = rng.rand(70, 60) < 0.004
+    source[30:35, 20:28] = True
+    distances = ndimage.distance_transform_edt(~source, sampling = (nsres, ewres))
+    np.testing.assert_array_equal(gridcorrel.BufferMask(source, distance, nsres, ewres), distances <= distance + 1e-9)
+
+
+def test_adaptive_minr():
+    rng = np.random.RandomState(7)
+    for trial in range(200):
+        rvalues = np.round(rng.uniform(0.3, 1.0, 40), 2)
+        rvalues[rng.rand(40) < 0.1] = np.nan
+        counts = rng.randint(0, 600, 40)
+        minr, floor, target = 0.9, rng.uniform(0.3, 0.9), rng.randint(0, 8)
+        # the highest threshold in [floor, minr] accepting target tiles, floor if none does
+        thresholds = [t for t in np.concatenate(([minr, floor], rvalues[~np.isnan(rvalues)])) if floor <= t <= minr]
+        accepting = [t for t in thresholds if ((counts > 300) & (rvalues >= t)).sum() >= target]
+        expected = max(accepting) if accepting and target >= 1 else floor
+        assert gridcorrel.AdaptiveMinr(rvalues, counts, 300, minr, floor, target) == pytest.approx(expected)